@@ -3,23 +3,14 @@
 
 # Local imports
 import utils.pulsarUtilities as pu
-import utils.plotUtils as pltu
 import utils.otherUtilities as u
 import utils.mathUtils as mathu
+import utils.timingUtils as tu
 
-# PyPulse imports
-from pypulse.archive import Archive
-from pypulse.singlepulse import SinglePulse
-from pypulse.utils import get_toa3
-
-# Plotting imports
-import matplotlib.pyplot as plt
-import scipy.stats as spyst
-import scipy.optimize as opt
+# PyPulse, plotting and scipy are imported where they are first used, so headless runs don't load them.
 
 # Other imports
 import numpy as np
-from scipy.fftpack import fft, fftshift
 import math
 import os
 import sys
@@ -36,7 +27,7 @@ class DataCull:
     Main class for data culling pulsar fits files to get a less noisy data set.
     '''
 
-    def __init__( self, filename, template, directory = None, SNLim = 3000, verbose = False ):
+    def __init__( self, filename, template, directory = None, SNLim = 3000, verbose = False, archive = None ):
 
         '''
         Initializes all archives and parameters in the data cube for a given file.
@@ -46,6 +37,8 @@ class DataCull:
         lower than the threshold.
         One can also set whether long arrays and other bits of console text
         are to be printed in full or in shorthand.
+        An archive already loaded by PyPulse can be given to cull it without
+        loading the file again.
         '''
 
         if verbose:
@@ -74,8 +67,12 @@ class DataCull:
         # Parse SNLim
         self.SNLim = SNLim
 
-        # Load the file in the archive
-        self.ar = Archive( self.__str__(), verbose = self.verbose )
+        # Load the file in the archive (unless it has been loaded already)
+        if archive is not None:
+            self.ar = archive
+        else:
+            from pypulse.archive import Archive
+            self.ar = Archive( self.__str__(), verbose = self.verbose )
 
         # Togglable print options
         if self.verbose:
@@ -105,6 +102,8 @@ class DataCull:
         Loads a template specified by the user. If no extension is given, the
         extension .npy will be used. Note that this code is designed for numpy
         arrays so it would be wise to use them.
+        Portrait templates (.npz files made by Template.createTemplate) also
+        load the 2D portrait and its per-channel FFTs.
         Returns the template.
         '''
 
@@ -113,7 +112,14 @@ class DataCull:
         self.templateName = u.addExtension( self.templateName, 'npy' )
 
         # Load the template
-        template = np.load( self.templateName )
+        if os.path.splitext( self.templateName )[1] == '.npz':
+            with np.load( self.templateName ) as portraitFile:
+                template = portraitFile['profile']
+                self.portrait = portraitFile['portrait']
+                self.portraitFFT = portraitFile['portraitFFT']
+        else:
+            template = np.load( self.templateName )
+            self.portrait, self.portraitFFT = None, None
 
         return template
 
@@ -141,7 +147,11 @@ class DataCull:
 
             for i in np.arange( iterations ):
 
-                self.fourierTransformRejection( criterion, showPlots, showPlots )
+                # Portrait templates allow each channel to be matched against its own template channel
+                if self.portraitFFT is not None:
+                    self.portraitRejection( criterion, showPlots )
+                else:
+                    self.fourierTransformRejection( criterion, showPlots, showPlots )
 
                 # If all possible outliers have been found and the flag is set to true, don't bother doing any more iterations.
                 if self.rejectionCompletionFlag:
@@ -204,6 +214,19 @@ class DataCull:
         self.data = self.ar.getData()
 
 
+    def scrunch( self, nsubint = 1, nchan = 1 ):
+
+        '''
+        Returns the profiles of the archive scrunched to nsubint sub-integrations
+        and nchan channels as a record ready to be timed (see timingUtils.archiveRecord).
+        The data cube is scrunched with the weights left by the rejection
+        (see timingUtils.scrunchRecord), so fully zapped blocks are skipped and
+        the archive itself is left as it is.
+        '''
+
+        return tu.scrunchRecord( tu.archiveRecord( self.ar, weighted = False ), nsubint, nchan )
+
+
     def rmsRejection( self, criterion, showPlot = False ):
 
         '''
@@ -220,6 +243,9 @@ class DataCull:
 
         if showPlot == True:
 
+            import scipy.stats as spyst
+            import utils.plotUtils as pltu
+
             # Creates the histogram
             pltu.histogram_and_curves( linearRmsArray, mean = mu, std_dev = sigma, x_axis = 'Root Mean Squared', y_axis = 'Frequency Density', title = r'$\mu={},\ \sigma={}$'.format( mu, sigma ), show = True, curve_list = [spyst.norm.pdf, mathu.test_dist.test_pdf] )
 
@@ -254,6 +280,12 @@ class DataCull:
         profile and compares to the the template.
         '''
 
+        import scipy.optimize as opt
+        from scipy.fftpack import fft, fftshift
+
+        if showTempPlot or showOtherPlots:
+            import utils.plotUtils as pltu
+
         # Re-load the data cube
         data = self.ar.getData()
         tempData = self.template
@@ -342,6 +374,78 @@ class DataCull:
 
 
 
+    def portraitRejection( self, criterion, showPlot = False ):
+
+        '''
+        Compares the FFT amplitudes of every profile with those of the matching
+        channel of the portrait template and rejects outlying RMS differences.
+        All subints and channels are compared at once using the template's
+        stored per-channel FFTs.
+        '''
+
+        # Re-load the data cube
+        self.data = self.ar.getData()
+        data = self.ar.getData( squeeze = False )[:, 0]
+        nsub, nchan, nbin = data.shape
+
+        portraitNchan = self.portraitFFT.shape[0]
+
+        if nchan % portraitNchan != 0:
+            raise ValueError( "Number of channels in {} ({}) must be a multiple of the number of portrait channels ({})".format( self.filename, nchan, portraitNchan ) )
+
+        # Amplitude spectra without the DC term, normalized to their maximum. Each portrait channel covers nchan / portraitNchan archive channels.
+        tempAmps = np.abs( self.portraitFFT[:, 1:] )
+        tempAmps = tempAmps / ( np.max( tempAmps, axis = 1, keepdims = True ) + np.spacing( 0 ) )
+        tempAmps = np.repeat( tempAmps, nchan // portraitNchan, axis = 0 )
+
+        profAmps = np.abs( np.fft.rfft( data, axis = 2 )[:, :, 1:] )
+        profAmps = profAmps / ( np.max( profAmps, axis = 2, keepdims = True ) + np.spacing( 0 ) )
+
+        # RMS difference between each profile's spectrum and its template channel's spectrum
+        rmsArray = np.sqrt( np.mean( ( profAmps - tempAmps )**2, axis = 2 ) )
+
+        # Zapped profiles take no part in the statistics
+        rmsArray[np.all( data == 0, axis = 2 )] = np.nan
+        rmsArray = np.ma.array( rmsArray, mask = np.isnan( rmsArray ) )
+
+        linearRmsArray = np.reshape( rmsArray, ( nsub * nchan ) )
+        mu, sigma = np.nanmean( linearRmsArray ), np.nanstd( linearRmsArray )
+
+        if showPlot == True:
+
+            import scipy.stats as spyst
+            import utils.plotUtils as pltu
+
+            # Creates the histogram
+            pltu.histogram_and_curves( linearRmsArray, mean = mu, std_dev = sigma, x_axis = 'FFT Root Mean Squared Difference', y_axis = 'Frequency Density', title = r'$\mu={},\ \sigma={}$'.format( mu, sigma ), show = True, curve_list = [spyst.norm.pdf] )
+
+        # Determine which criterion to use to reject data
+        if criterion == 'chauvenet': # Chauvenet's Criterion
+
+            rejectionCriterion = mathu.chauvenet( rmsArray, mu, sigma, 3 )
+
+        elif criterion == 'DMAD': # Double Median Absolute Deviation
+
+            rejectionCriterion = mathu.doubleMAD( linearRmsArray )
+            rejectionCriterion = np.reshape( rejectionCriterion, ( nsub, nchan ) )
+
+        else:
+            raise ValueError( "Allowed rejection criteria are either 'chauvenet' or 'DMAD'. Please use one of these..." )
+
+        # Set the weights of potential noise in each profile to 0
+        u.zeroWeights( rejectionCriterion, self.ar, self.verbose )
+
+        # Checks to see if there were any data to reject. If this array has length 0, all data was good and the completion flag is set to true.
+        if( len( np.where( rejectionCriterion )[0] ) == 0 ):
+            self.rejectionCompletionFlag = True
+
+        # Re-load the data cube
+        self.data = self.ar.getData()
+
+        if self.verbose:
+            print( "Data rejection cycle complete..." )
+
+
     def binShiftRejection( self, showPlot = False ):
 
         '''
@@ -363,6 +467,9 @@ class DataCull:
 
         if showPlot == True:
 
+            import scipy.stats as spyst
+            import utils.plotUtils as pltu
+
             # Create the histograms as two subplots
             pltu.histogram_and_curves( linearNBinShift, mean = muS, std_dev = sigmaS, x_axis = r'Bin Shift from Template, $\hat{\tau}$', y_axis = 'Frequency Density', title = r'$\mu={},\ \sigma={}$'.format( muS, sigmaS ), show = True, curve_list = [spyst.norm.pdf] )
             pltu.histogram_and_curves( linearNBinError, mean = muE, std_dev = sigmaE, x_axis = r'Bin Shift Error, $\sigma_{\tau}$', y_axis = 'Frequency Density', title = r'$\mu={},\ \sigma={}$'.format( muE, sigmaE ), show = True, curve_list = [spyst.maxwell.pdf] )
@@ -392,6 +499,8 @@ class DataCull:
         if self.verbose:
             print( "Getting bin shifts and errors from the template..." )
 
+        from pypulse.utils import get_toa3
+
         # Re-load the data cube
         self.data = self.ar.getData()
 
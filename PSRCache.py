@@ -0,0 +1,157 @@
+# Profile cache class, Python 3
+
+# Local imports
+import utils.timingUtils as tu
+
+# Other imports
+import os
+import hashlib
+import numpy as np
+
+
+# Profile cache class
+class ProfileCache:
+
+    '''
+    Class for a compact on-disk cache of post-rejection, scrunched profiles.
+    Each PSRFITS file is stored as a single .npz file holding its
+    (nsubint x nsubfreq x nbin) profiles, their weights and the timing metadata
+    (epoch, period, frequencies...) so the data can be re-timed against a new
+    template or jump string without reloading, re-culling or re-scrunching the
+    archive.
+    '''
+
+    def __init__( self, directory, verbose = False ):
+
+        '''
+        Initializes the cache in the directory given, creating it if necessary.
+        '''
+
+        self.directory = str( directory )
+        self.verbose = verbose
+
+        os.makedirs( self.directory, exist_ok = True )
+
+    def __repr__( self ):
+        return "ProfileCache( directory = {}, verbose = {} )".format( self.directory, self.verbose )
+
+    def __str__( self ):
+        return self.directory
+
+
+    def _cachePath( self, filename ):
+
+        '''
+        Returns the path of the cache entry for a PSRFITS file. The absolute path
+        is hashed into the name so files with the same name in different
+        directories don't collide.
+        '''
+
+        path = os.path.abspath( filename )
+        key = hashlib.sha1( path.encode() ).hexdigest()[:12]
+
+        return os.path.join( self.directory, "{}_{}.npz".format( os.path.basename( path ), key ) )
+
+
+    def store( self, archive, nsubint, nsubfreq, rfi = None ):
+
+        '''
+        Stores the scrunched profiles of a loaded (and culled) PyPulse archive
+        along with its timing metadata and the settings used to produce them.
+        '''
+
+        self.storeRecord( tu.archiveRecord( archive ), nsubint, nsubfreq, rfi )
+
+
+    def storeRecord( self, record, nsubint, nsubfreq, rfi = None ):
+
+        '''
+        Stores a record made by timingUtils.archiveRecord along with the
+        settings used to produce it.
+        '''
+
+        source = os.stat( record['filename'] )
+
+        np.savez( self._cachePath( record['filename'] ),
+                  mtime = source.st_mtime,
+                  size = source.st_size,
+                  nsubint = nsubint,
+                  nsubfreq = nsubfreq,
+                  rfi = -1 if rfi is None else rfi,
+                  **record )
+
+        if self.verbose:
+            print( "Cached scrunched profiles for {}...".format( record['filename'] ) )
+
+
+    def load( self, filename, nsubint = None, nsubfreq = None, rfi = None ):
+
+        '''
+        Returns the cache entry for a PSRFITS file as a dictionary, or None if
+        there is no entry, the file has changed since it was cached, or the entry
+        was made with different scrunch or RFI settings.
+        '''
+
+        path = self._cachePath( filename )
+
+        if not os.path.isfile( path ):
+            return None
+
+        with np.load( path ) as entry:
+            record = { key: entry[key] for key in entry.files }
+
+        # Reject entries for source files that have since been modified
+        try:
+            source = os.stat( filename )
+        except OSError:
+            return None
+        if source.st_mtime != record['mtime'] or source.st_size != record['size']:
+            if self.verbose:
+                print( "Cache entry for {} is out of date...".format( filename ) )
+            return None
+
+        # Reject entries made with different settings
+        if ( nsubint is not None and nsubint != record['nsubint'] ) or ( nsubfreq is not None and nsubfreq != record['nsubfreq'] ) or ( -1 if rfi is None else rfi ) != record['rfi']:
+            if self.verbose:
+                print( "Cache entry for {} was made with different settings...".format( filename ) )
+            return None
+
+        # Unpack the scalar entries
+        for key, value in record.items():
+            if value.ndim == 0:
+                record[key] = value.item()
+
+        return record
+
+
+    def time( self, record, template, filename, flags = "", appendto = True ):
+
+        '''
+        Times the cached profiles of one record against a 1D template and writes
+        the TOAs in TEMPO2 format, the same way PyPulse Archive.time does.
+        Use timingUtils.timeRecords to time many records at once instead.
+        '''
+
+        # Imported here so the cache can be read without PyPulse
+        from pypulse.singlepulse import SinglePulse
+        import pypulse.utils as pyu
+
+        # Normalize and center the template as Archive.time does
+        rollval, template = pyu.center_max( pyu.normalize( template, simple = True ), full = True )
+        opw = SinglePulse( template, windowsize = len( template ) // 8 ).opw
+
+        profiles = record['profiles']
+        nsubint, nchan = profiles.shape[:2]
+
+        tauhat, bhat, sigma_tau, sigma_b, snr = [ np.full( ( nsubint, nchan ), np.nan ) for i in np.arange( 5 ) ]
+
+        for i in np.arange( nsubint ):
+            for j in np.arange( nchan ):
+                fit = SinglePulse( profiles[i, j], period = record['period'], opw = opw ).fitPulse( template )
+                if fit is not None:
+                    tauhat[i, j], bhat[i, j], sigma_tau[i, j], sigma_b[i, j], snr[i, j] = fit[1:6]
+
+        lines = tu.toaLines( record, tauhat + rollval, sigma_tau, snr, bhat, sigma_b, flags = flags )
+        tu.writeTOAs( lines, filename, appendto )
+
+        return lines
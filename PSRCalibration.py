@@ -0,0 +1,435 @@
+# Flux calibration planner class, Python 3
+
+# Local imports
+import utils.calibrationUtils as calu
+import utils.calculate_flux as cf
+import utils.schedulerUtils as sch
+
+# PyPulse is imported where archives are loaded, so planning and solving from the cache don't load it
+
+# Other imports
+import os
+import re
+import hashlib
+import numpy as np
+from astropy.io import fits
+
+
+# Flux calibration planner class
+class CalibrationPlanner:
+
+    '''
+    Class to plan and cache the flux calibration of a set of PSRFITS files.
+    CAL files are indexed by (MJD, frontend, mode) from their primary headers in
+    a single pass, where the mode is 'ON' (pointing at a flux calibrator in the
+    catalog), 'OFF' (a flux calibrator observation pointing away from it) or
+    'PSR' (a noise diode observation at the pulsar). ON and OFF files at the same
+    MJD and frontend make a pair whose F_cal solution is solved once and stored
+    in the solution cache, so every PSR file of an epoch (and of nearby epochs
+    without their own pair) reuses it.
+    '''
+
+    def __init__( self, inputs, cache = None, G = 10.0, tolerance = 0.1, verbose = False ):
+
+        '''
+        Initializes the planner with a list of files and / or directories to index.
+        cache is an optional directory to persist F_cal solutions in, G is the
+        telescope gain and tolerance is the largest separation (in degrees)
+        between a CAL pointing and a catalog source for it to count as ON.
+        '''
+
+        self.G = G
+        self.tolerance = tolerance
+        self.verbose = verbose
+
+        if cache is not None:
+            self.cache = str( cache )
+            os.makedirs( self.cache, exist_ok = True )
+        else:
+            self.cache = None
+
+        self.catalog = cf.getCatalog()
+        self._catalogPositions = np.array( [ _parseCoordinates( ra, dec ) for ra, dec in zip( self.catalog.ra, self.catalog.dec ) ] )
+
+        self.index = {}
+        self.sources = {}
+        self.psrFiles = {}
+        self.pairs = {}
+        self._indexed = set()
+        self._solutions = {}
+        self._factors = {}
+
+        self.add( inputs )
+
+    def __repr__( self ):
+        return "CalibrationPlanner( cache = {}, G = {}, tolerance = {}, verbose = {} )".format( self.cache, self.G, self.tolerance, self.verbose )
+
+    def __str__( self ):
+        return str( self.pairs )
+
+
+    def add( self, inputs ):
+
+        '''
+        Indexes more files and / or directories (e.g. CAL files that arrived
+        after the planner was made), skipping files already indexed. If any CAL
+        files are new, the ON / OFF pairs are rebuilt and the Jy per count
+        factors worked out so far are dropped, so every epoch is calibrated
+        against its nearest pair again. Solved F_cal pairs are kept.
+        Returns the number of new CAL files.
+        '''
+
+        ncal = sum( len( files ) for files in self.index.values() )
+
+        for input in ( [ inputs ] if isinstance( inputs, str ) else inputs ):
+            if os.path.isdir( input ):
+                files = [ os.path.join( input, file ) for file in sorted( os.listdir( input ) ) ]
+            else:
+                files = [ input ]
+            for file in files:
+                if os.path.abspath( file ) not in self._indexed:
+                    self._indexed.add( os.path.abspath( file ) )
+                    self._indexFile( file )
+
+        new = sum( len( files ) for files in self.index.values() ) - ncal
+
+        if new:
+            self.pairs = { key[:2]: ( files[0], self.index[key[:2] + ( 'OFF', )][0] ) for key, files in self.index.items() if key[2] == 'ON' and key[:2] + ( 'OFF', ) in self.index }
+            self._factors = {}
+
+        if self.verbose:
+            print( "Indexed {} CAL files and found {} ON / OFF pairs...".format( ncal + new, len( self.pairs ) ) )
+
+        return new
+
+
+    def _indexFile( self, file ):
+
+        '''
+        Reads the primary header of a file and adds it to the CAL index, or to the
+        PSR file list for its epoch. Files that aren't FITS are skipped.
+        '''
+
+        try:
+            header = fits.getheader( file, 0 )
+            obs, frontend, mjd = header['OBS_MODE'], header['FRONTEND'], int( header['STT_IMJD'] )
+        except ( OSError, KeyError ):
+            if self.verbose:
+                print( "Skipping {}...".format( file ) )
+            return
+
+        if obs == 'PSR':
+            self.psrFiles.setdefault( ( mjd, frontend ), [] ).append( file )
+            return
+        elif obs not in [ 'CAL', 'FON', 'FOF' ]:
+            return
+
+        mode, source = self._calMode( header )
+
+        # Flux calibrator observations may already be labelled as on (FON) or off (FOF) source
+        if obs == 'FON':
+            mode = 'ON'
+        elif obs == 'FOF':
+            mode = 'OFF'
+
+        self.index.setdefault( ( mjd, frontend, mode ), [] ).append( file )
+
+        if mode == 'ON':
+            self.sources[( mjd, frontend )] = source
+
+
+    def _calMode( self, header ):
+
+        '''
+        Returns the mode of a CAL file ('ON', 'OFF' or 'PSR') and the catalog name
+        of its flux calibrator (None for PSR cals).
+        '''
+
+        position = _parseCoordinates( header.get( 'RA', '' ), header.get( 'DEC', '' ) )
+
+        # ON if the telescope points at any catalog source
+        if position is not None:
+            separations = _separation( position, self._catalogPositions )
+            closest = np.nanargmin( separations )
+            if separations[closest] < self.tolerance:
+                return 'ON', str( self.catalog.names[closest] )
+
+        # OFF if the source is a catalog flux calibrator (the name may end in on / off)
+        name = str( header.get( 'SRC_NAME', '' ) ).strip()
+        for candidate in [ name, re.sub( r'[_\-]?(on|off)$', '', name, flags = re.IGNORECASE ) ]:
+            if candidate in self.catalog:
+                return 'OFF', self.catalog.entry( candidate )['name']
+
+        return 'PSR', None
+
+
+    def _nearestPair( self, mjd, frontend ):
+
+        '''
+        Returns the key of the ON / OFF pair at the nearest MJD with the same frontend.
+        '''
+
+        keys = [ key for key in self.pairs if key[1] == frontend ]
+
+        if not keys:
+            raise ValueError( "No ON / OFF calibrator pair found for frontend {}".format( frontend ) )
+
+        return min( keys, key = lambda key: abs( key[0] - mjd ) )
+
+
+    def _solutionPath( self, on, off ):
+
+        '''
+        Returns the path of the cached solution of an ON / OFF pair.
+        '''
+
+        key = hashlib.sha1( "{}|{}|{}".format( os.path.abspath( on ), os.path.abspath( off ), self.G ).encode() ).hexdigest()[:12]
+
+        return os.path.join( self.cache, "fcal_{}.npz".format( key ) )
+
+
+    def solve( self, mjd, frontend ):
+
+        '''
+        Returns the channel frequencies and F_cal of the AA and BB polarisations,
+        as a (2, nchan) array, for the ON / OFF pair nearest to the given epoch.
+        Solutions are kept in memory and, if there is a cache directory, on disk
+        until either CAL file changes.
+        '''
+
+        key = self._nearestPair( mjd, frontend )
+
+        if key in self._solutions:
+            return self._solutions[key]
+
+        on, off = self.pairs[key]
+        stamps = np.array( [ [ os.stat( file ).st_mtime, os.stat( file ).st_size ] for file in ( on, off ) ] )
+
+        if self.cache is not None and os.path.isfile( self._solutionPath( on, off ) ):
+            with np.load( self._solutionPath( on, off ) ) as solution:
+                if np.array_equal( solution['stamps'], stamps ):
+                    self._solutions[key] = ( solution['frequencies'], solution['F_cal'] )
+                    return self._solutions[key]
+
+        if self.verbose:
+            print( "Solving F_cal for {} and {}...".format( on, off ) )
+
+        from pypulse.archive import Archive
+
+        data = []
+        for file in ( on, off ):
+            ar = Archive( file, verbose = False )
+            frequencies = calu.chan_to_freq( ar.getCenterFrequency( weighted = True ), ar.getBandwidth(), ar.getNchan() )
+            ar.tscrunch()
+            data.append( ( ar.getData( squeeze = False )[0], ar.getValue( "CAL_PHS" ), ar.getValue( "CAL_DCYC" ), frequencies ) )
+
+        ( data_on, s_duty_on, duty_on, frequencies ), ( data_off, s_duty_off, duty_off, _ ) = data
+
+        # The calibrator flux is evaluated for every channel (frequencies in MHz, catalog in GHz)
+        T0 = self.catalog.fluxes( np.abs( frequencies ) / 1000, self.sources[key] )[0]
+        F_cal = calu.solve_Fcal( data_on, data_off, s_duty_on, duty_on, s_duty_off, duty_off, self.G, T0 )
+
+        # Written to a temporary file and renamed, as parallel epochs can share a pair
+        if self.cache is not None:
+            temporary = self._solutionPath( on, off ) + ".{}.tmp.npz".format( os.getpid() )
+            np.savez( temporary, frequencies = frequencies, F_cal = F_cal, stamps = stamps, on = on, off = off, G = self.G )
+            os.replace( temporary, self._solutionPath( on, off ) )
+
+        self._solutions[key] = ( frequencies, F_cal )
+
+        return self._solutions[key]
+
+
+    def interpolators( self, mjd, frontend ):
+
+        '''
+        Returns the F_cal interpolants of the AA and BB polarisations for an epoch.
+        '''
+
+        return calu.Fcal_interpolators( *self.solve( mjd, frontend ) )
+
+
+    def jyPerCount( self, mjd, frontend ):
+
+        '''
+        Returns the (2, nchan) Jy per count factors for an epoch from its PSR cal
+        file, or None if the epoch has no PSR cal.
+        '''
+
+        key = ( mjd, frontend )
+
+        if key in self._factors:
+            return self._factors[key]
+
+        if key + ( 'PSR', ) not in self.index:
+            if self.verbose:
+                print( "No pulsar cal file for MJD {} with frontend {}...".format( mjd, frontend ) )
+            self._factors[key] = None
+            return None
+
+        fitAA, fitBB = self.interpolators( mjd, frontend )
+
+        from pypulse.archive import Archive
+        ar = Archive( self.index[key + ( 'PSR', )][0], verbose = False )
+        frequencies = calu.chan_to_freq( ar.getCenterFrequency( weighted = True ), ar.getBandwidth(), ar.getNchan() )
+        ar.tscrunch()
+
+        F_cal = np.array( [ fitAA( frequencies ), fitBB( frequencies ) ] )
+        self._factors[key] = calu.solve_Jy_per_count( ar.getData( squeeze = False )[0], F_cal, ar.getValue( "CAL_PHS" ), ar.getValue( "CAL_DCYC" ) )
+
+        return self._factors[key]
+
+
+    def calibrate( self, archive ):
+
+        '''
+        Flux calibrates a loaded PyPulse archive in place using the solution for
+        its epoch and frontend. Returns False (leaving the archive alone) if the
+        epoch can't be calibrated.
+        '''
+
+        mjd, frontend = int( archive.header['STT_IMJD'] ), archive.getFrontend()
+
+        try:
+            factors = self.jyPerCount( mjd, frontend )
+        except ValueError as e:
+            if self.verbose:
+                print( e )
+            return False
+
+        if factors is None:
+            return False
+
+        # Reassigning the data makes PyPulse recalculate its weighted copy
+        archive.data = calu.apply_flux_scale( archive.data, factors )
+
+        return True
+
+
+    def calibrateEpoch( self, job ):
+
+        '''
+        Flux calibrates every PSR file of one epoch and saves them in their own
+        directory, <outputDirectory>/<MJD>_<frontend>/, so epochs never write to
+        the same place. job is a ( ( MJD, frontend ), outputDirectory ) tuple.
+        Returns a list of ( file, calibrated file ) tuples, with None for files
+        that couldn't be calibrated.
+        '''
+
+        ( mjd, frontend ), outputDirectory = job
+
+        from pypulse.archive import Archive
+
+        epochDirectory = os.path.join( outputDirectory, "{}_{}".format( mjd, frontend ) )
+        os.makedirs( epochDirectory, exist_ok = True )
+
+        results = []
+        for file in self.psrFiles[( mjd, frontend )]:
+
+            ar = Archive( file, prepare = False, verbose = False )
+
+            if self.calibrate( ar ):
+                output = os.path.join( epochDirectory, os.path.basename( file ) )
+                ar.save( output )
+                results.append( ( file, output ) )
+            else:
+                results.append( ( file, None ) )
+
+            if self.verbose:
+                print( "Calibrated {}...".format( file ) if results[-1][1] is not None else "Could not calibrate {}...".format( file ) )
+
+        return results
+
+
+    def calibrateBatch( self, outputDirectory, processes = 1, memory = None ):
+
+        '''
+        Flux calibrates every indexed PSR file, one epoch per worker process
+        (each solving its own CAL pairs). Calibrated files are saved under
+        outputDirectory by epoch and the calling process writes a manifest,
+        manifest.txt, listing every file and its calibrated copy (or
+        UNCALIBRATED). Epochs with the largest files start first and, with a
+        memory budget in MB, only while their footprints fit in the budget.
+        Returns the manifest as a list of tuples.
+        '''
+
+        outputDirectory = str( outputDirectory )
+        os.makedirs( outputDirectory, exist_ok = True )
+
+        jobs = [ ( key, outputDirectory ) for key in sorted( self.psrFiles ) ]
+
+        manifest = []
+        budget = memory * 1024**2 if memory is not None else None
+        footprint = lambda job: max( [ sch.archiveFootprint( file ) for file in self.psrFiles[job[0]] ] + [ 0 ] )
+
+        for job, results in sch.runJobs( self.calibrateEpoch, jobs, processes, budget, footprint ):
+            manifest.extend( results )
+
+        with open( os.path.join( outputDirectory, "manifest.txt" ), 'w' ) as file:
+            for input, output in manifest:
+                file.write( "{} {}\n".format( input, output if output is not None else "UNCALIBRATED" ) )
+
+        return manifest
+
+
+def _parseCoordinates( ra, dec ):
+
+    '''
+    Returns the RA and Dec of sexagesimal strings (hh:mm:ss, dd:mm:ss) in degrees, or None.
+    '''
+
+    try:
+        h, m, s = ( list( map( float, str( ra ).split( ":" ) ) ) + [ 0, 0 ] )[:3]
+        d, dm, ds = ( list( map( float, str( dec ).split( ":" ) ) ) + [ 0, 0 ] )[:3]
+    except ValueError:
+        return None
+
+    sign = -1 if str( dec ).strip().startswith( "-" ) else 1
+
+    return 15 * ( h + ( m / 60 ) + ( s / 3600 ) ), sign * ( abs( d ) + ( dm / 60 ) + ( ds / 3600 ) )
+
+
+def _separation( position, positions ):
+
+    '''
+    Returns the angular separation (in degrees) between a position and an array of positions.
+    '''
+
+    ra, dec = np.radians( position )
+    ras, decs = np.radians( positions ).T
+
+    cosine = ( np.sin( dec ) * np.sin( decs ) ) + ( np.cos( dec ) * np.cos( decs ) * np.cos( ras - ra ) )
+
+    return np.degrees( np.arccos( np.clip( cosine, -1, 1 ) ) )
+
+
+if __name__ == "__main__":
+
+    from custom_exceptions import ArgumentError
+    import argparse
+
+    parser = argparse.ArgumentParser( formatter_class = argparse.RawDescriptionHelpFormatter,
+                prog = 'PSRCalibration.py',
+                description = '''\
+                    PulseBlast Calibration Argument Handler
+                -------------------------------------------
+                  Flux calibrates PSRFITS files by epoch
+                    ''' )
+
+    parser.add_argument( '-d', dest = 'directories', nargs = '*', default = None, help = 'Directories / files holding the PSR and CAL files.' )
+    parser.add_argument( '-o', dest = 'outputDirectory', nargs = 1, default = None, help = 'Directory to save the calibrated files to (one subdirectory per epoch).' )
+    parser.add_argument( '-c', dest = 'cache', nargs = 1, default = [None], help = 'Directory to cache F_cal solutions in. Optional.' )
+    parser.add_argument( '-g', dest = 'gain', nargs = 1, type = float, default = [10.0], help = 'Telescope gain (K / Jy). Optional.' )
+    parser.add_argument( '-p', dest = 'processes', type = int, default = 1, help = 'Number of epochs to calibrate in parallel. 0 uses one process per CPU. Optional.' )
+    parser.add_argument( '-m', dest = 'memory', type = float, default = None, help = 'Memory budget in MB. Epochs are only started while their largest files fit in it. Optional.' )
+    parser.add_argument( '-v', dest = 'verbose', action = 'store_true', default = False, help = 'Prints information to the console.' )
+
+    args = parser.parse_args()
+
+    if ( not args.directories ):
+        raise ArgumentError( "At least one directory argument is required." )
+    if ( not args.outputDirectory ):
+        raise ArgumentError( "Output directory argument required." )
+
+    planner = CalibrationPlanner( args.directories, cache = args.cache[0], G = args.gain[0], verbose = args.verbose )
+    planner.calibrateBatch( args.outputDirectory[0], args.processes, args.memory )
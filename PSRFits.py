@@ -0,0 +1,244 @@
+# PSRFITS partial reader class, Python 3
+
+# Local imports
+import utils.mathUtils as mathu
+
+# Other imports
+import numpy as np
+from astropy.io import fits
+
+# Dispersion constant used by PyPulse (to be consistent with PSRCHIVE), in MHz^2 s cm^3 / pc
+DISPERSION_CONSTANT = 1.0 / 2.41e-4
+
+# SUBINT columns the reader maps
+COLUMNS = [ 'DATA', 'DAT_SCL', 'DAT_OFFS', 'DAT_WTS', 'DAT_FREQ', 'PERIOD', 'TSUBINT', 'OFFS_SUB' ]
+
+
+# PSRFITS partial reader class
+class SubintReader:
+
+    '''
+    Class to read parts of the SUBINT table of a fold mode PSRFITS file without
+    loading the whole file. Only the headers are parsed on opening; the table is
+    memory-mapped, so a read only touches the rows, polarisations and channels
+    it asks for and only those are decoded (DATA x DAT_SCL + DAT_OFFS, weighted
+    by DAT_WTS if asked), all at once with NumPy. Total intensity is made from
+    the polarisations the POL_TYPE needs (AA + BB for coherence data, I for
+    Stokes). The time and memory a read takes are proportional to what it uses.
+    '''
+
+    def __init__( self, filename, verbose = False ):
+
+        '''
+        Initializes the reader on a PSRFITS file, reading its primary and SUBINT
+        headers and mapping the SUBINT table.
+        '''
+
+        self.filename = str( filename )
+        self.verbose = verbose
+
+        with fits.open( self.filename, memmap = True, lazy_load_hdus = True ) as hdul:
+            self.header = hdul[0].header
+            hdu = hdul['SUBINT']
+            self.subintHeader = hdu.header
+            location = hdul.fileinfo( hdul.index_of( 'SUBINT' ) )['datLoc']
+            columns = hdu.columns
+            dtype = columns.dtype
+
+        self.nsubint = int( self.subintHeader['NAXIS2'] )
+        self.npol = int( self.subintHeader['NPOL'] )
+        self.nchan = int( self.subintHeader['NCHAN'] )
+        self.nbin = int( self.subintHeader['NBIN'] )
+        self.polType = str( self.subintHeader.get( 'POL_TYPE', '' ) ).strip()
+
+        if dtype.itemsize != int( self.subintHeader['NAXIS1'] ):
+            raise ValueError( "SUBINT table of {} has columns the reader can't map (e.g. variable length arrays).".format( self.filename ) )
+
+        # A record type with only the columns used, at their offsets in each (big endian) row
+        names = [ name for name in COLUMNS if name in dtype.names ]
+        rowType = np.dtype( { 'names': names,
+                              'formats': [ dtype.fields[name][0].newbyteorder( '>' ) for name in names ],
+                              'offsets': [ dtype.fields[name][1] for name in names ],
+                              'itemsize': dtype.itemsize } )
+
+        self._table = np.memmap( self.filename, dtype = rowType, mode = 'r', offset = location, shape = ( self.nsubint, ) )
+
+        # DATA may be stored with a scale and zero point of its own (e.g. unsigned 8 bit data)
+        self._dataScale = columns['DATA'].bscale if columns['DATA'].bscale is not None else 1.0
+        self._dataZero = columns['DATA'].bzero if columns['DATA'].bzero is not None else 0.0
+
+        if self.verbose:
+            print( "Mapped {} ({} x {} x {} x {})...".format( self.filename, self.nsubint, self.npol, self.nchan, self.nbin ) )
+
+    def __repr__( self ):
+        return "SubintReader( filename = {}, verbose = {} )".format( self.filename, self.verbose )
+
+    def __str__( self ):
+        return self.filename
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, *exception ):
+        self.close()
+
+
+    @property
+    def shape( self ):
+        return self.nsubint, self.npol, self.nchan, self.nbin
+
+
+    def close( self ):
+
+        '''
+        Unmaps the file.
+        '''
+
+        self._table = None
+
+
+    def _rows( self, rows ):
+        return slice( None ) if rows is None else rows
+
+    def _channels( self, channels ):
+        if channels is None:
+            return slice( None )
+        elif isinstance( channels, tuple ):
+            return slice( *channels )
+        return channels
+
+    def _pols( self, pol ):
+
+        '''
+        Returns the polarisations to read (a slice where possible, so the mapped
+        table is not copied) and whether they are summed for total intensity.
+        '''
+
+        if pol == 'I':
+            if self.npol > 1 and self.polType in ( 'AABBCRCI', 'AABB' ):
+                return slice( 0, 2 ), True
+            return slice( 0, 1 ), False
+        elif isinstance( pol, ( int, np.integer ) ):
+            return slice( pol, pol + 1 ), False
+
+        return list( pol ), False
+
+
+    def _column( self, name, rows = None ):
+
+        '''
+        Returns the mapped column, or the given rows of it.
+        '''
+
+        if name not in self._table.dtype.names:
+            raise KeyError( "{} has no {} column in its SUBINT table.".format( self.filename, name ) )
+
+        return self._table[name][self._rows( rows )]
+
+
+    def weights( self, rows = None, channels = None ):
+
+        '''
+        Returns the DAT_WTS of the given rows and channels, with shape (nrows, nchan).
+        '''
+
+        return np.nan_to_num( np.array( self._column( 'DAT_WTS', rows ), dtype = np.float64 ).reshape( -1, self.nchan )[:, self._channels( channels )] )
+
+
+    def frequencies( self, channels = None, row = 0 ):
+
+        '''
+        Returns the centre frequencies (MHz) of the given channels in a row.
+        '''
+
+        return np.array( self._column( 'DAT_FREQ' )[row], dtype = np.float64 ).reshape( self.nchan )[self._channels( channels )]
+
+
+    def read( self, rows = None, pol = 'I', channels = None, weight = False, dtype = np.float32 ):
+
+        '''
+        Decodes the data of the given rows (None for all, a slice or indices),
+        polarisations (an index, a list of them, or 'I' for total intensity) and
+        channels (None for all, a ( start, stop ) range, a slice or indices).
+        Returns an array of shape (nrows, npol, nchan, nbin), where total
+        intensity counts as one polarisation, weighted by DAT_WTS if weight is set.
+        '''
+
+        pols, summed = self._pols( pol )
+        channels = self._channels( channels )
+
+        # Only the mapped pages of these rows, polarisations and channels are read
+        raw = self._column( 'DATA', rows ).reshape( -1, self.npol, self.nchan, self.nbin )[:, pols][:, :, channels]
+        scale = np.array( self._column( 'DAT_SCL', rows ), dtype = dtype ).reshape( -1, self.npol, self.nchan )[:, pols][:, :, channels]
+        offset = np.array( self._column( 'DAT_OFFS', rows ), dtype = dtype ).reshape( -1, self.npol, self.nchan )[:, pols][:, :, channels]
+
+        data = np.array( raw, dtype = dtype )
+        if self._dataScale != 1.0 or self._dataZero != 0.0:
+            data *= dtype( self._dataScale )
+            data += dtype( self._dataZero )
+
+        data *= scale[..., np.newaxis]
+        data += offset[..., np.newaxis]
+
+        if summed:
+            data = np.sum( data, axis = 1, keepdims = True )
+
+        if weight:
+            data *= self.weights( rows, channels ).astype( dtype )[:, np.newaxis, :, np.newaxis]
+
+        return data
+
+
+    def binDelays( self, channels = None ):
+
+        '''
+        Returns the dispersion delay of each channel in bins, as PyPulse's
+        dedisperse works it out: relative to OBSFREQ, with the header DM and the
+        mean folding period of the PERIOD column.
+        '''
+
+        DM = self.subintHeader.get( 'DM', self.header.get( 'DM', self.header.get( 'CHAN_DM' ) ) )
+        if DM is None or 'PERIOD' not in self._table.dtype.names:
+            raise ValueError( "{} needs a DM and a PERIOD column to be dedispersed.".format( self.filename ) )
+
+        period = float( np.mean( self._column( 'PERIOD' ) ) )
+        delays = DISPERSION_CONSTANT * float( DM ) * ( float( self.header['OBSFREQ'] )**( -2 ) - self.frequencies( channels )**( -2 ) )
+
+        return ( delays / ( period / self.nbin ) ) % self.nbin
+
+
+    def profiles( self, pol = 'I', channels = None, rows = None, dedisperse = False, chunk = 64 ):
+
+        '''
+        Returns the weighted sum over rows of each channel's profile, with shape
+        (nchan, nbin), divided by the sum of the weights as PyPulse's weighted
+        data are. Rows are decoded chunk at a time, so memory stays at chunk rows,
+        and rows whose channels all have zero weight are never read. If
+        dedisperse is set, each channel is rotated by its dispersion delay (see binDelays).
+        '''
+
+        indices = np.arange( self.nsubint )[self._rows( rows )]
+        weights = self.weights( indices, channels )
+
+        # Skip fully zapped rows
+        live = np.sum( weights, axis = 1 ) > 0
+        indices, weights = indices[live], weights[live]
+
+        pols, summed = self._pols( pol )
+        npol = 1 if summed else len( np.arange( self.npol )[pols] )
+        profiles = np.zeros( ( weights.shape[1], npol, self.nbin ) )
+
+        for start in np.arange( 0, len( indices ), chunk ):
+            block = self.read( indices[start:start + chunk], pol, channels, dtype = np.float64 )
+            block *= weights[start:start + chunk, np.newaxis, :, np.newaxis]
+            profiles += np.swapaxes( np.sum( block, axis = 0 ), 0, 1 )
+
+        total = np.sum( weights )
+        if total > 0:
+            profiles /= total
+
+        if dedisperse and profiles.shape[0] > 1:
+            spectra = np.fft.rfft( profiles, axis = -1 )
+            profiles = np.fft.irfft( mathu.fourierRotate( spectra, self.binDelays( channels )[:, np.newaxis], self.nbin ), n = self.nbin, axis = -1 )
+
+        return profiles[:, 0] if npol == 1 else profiles
@@ -0,0 +1,159 @@
+# Run journal class, Python 3
+
+# Imports
+import os
+import json
+import time
+
+
+# Run journal class
+class RunJournal:
+
+    '''
+    Class for the journal of a batch run. Every file's outcome is appended to
+    the journal file as a line of JSON as soon as it is known: 'done' once its
+    TOAs have been written, or 'failed' with the traceback of the error, in
+    which case the file is quarantined (skipped) rather than aborting the run.
+    A run given the same journal resumes where the last one stopped: files
+    already done with the same settings, or quarantined, are skipped unless
+    they have changed since. Lines are appended in a single write, so the
+    processes of a parallel run can share a journal.
+    '''
+
+    def __init__( self, filename, retry = False, verbose = False ):
+
+        '''
+        Initializes the journal, reading the states recorded by earlier runs.
+        If retry is set, quarantined files are tried again.
+        '''
+
+        self.filename = str( filename )
+        self.retry = retry
+        self.verbose = verbose
+
+        directory = os.path.dirname( os.path.abspath( self.filename ) )
+        os.makedirs( directory, exist_ok = True )
+
+        # Latest record of each file
+        self.records = {}
+        self._truncated = False
+
+        if os.path.isfile( self.filename ):
+            with open( self.filename, 'r' ) as journal:
+                for line in journal:
+                    self._truncated = not line.endswith( "\n" )
+                    try:
+                        record = json.loads( line )
+                    except ValueError:
+                        # A line cut short by a crash
+                        continue
+                    # Anything that isn't a journal record
+                    if not isinstance( record, dict ) or not all( key in record for key in ( 'file', 'state', 'stamp' ) ):
+                        continue
+                    self.records[record['file']] = record
+
+        if self.verbose:
+            print( "Journal {}: {} done, {} quarantined...".format( self.filename, len( self.completed() ), len( self.quarantined() ) ) )
+
+    def __repr__( self ):
+        return "RunJournal( filename = {}, retry = {}, verbose = {} )".format( self.filename, self.retry, self.verbose )
+
+    def __str__( self ):
+        return self.filename
+
+    def __len__( self ):
+        return len( self.records )
+
+
+    def _stamp( self, file ):
+
+        '''
+        Returns the size and modification time of a file, so changed files are redone.
+        '''
+
+        try:
+            stat = os.stat( file )
+        except OSError:
+            return None
+
+        return [ stat.st_size, stat.st_mtime_ns ]
+
+
+    def _write( self, record ):
+
+        '''
+        Appends a record to the journal and makes sure it reaches the disk.
+        '''
+
+        self.records[record['file']] = record
+
+        # Start on a new line if the last run was cut short mid-line
+        line = ( "\n" if self._truncated else "" ) + json.dumps( record ) + "\n"
+        self._truncated = False
+
+        with open( self.filename, 'a' ) as journal:
+            journal.write( line )
+            journal.flush()
+            os.fsync( journal.fileno() )
+
+
+    def skip( self, file, settings = None ):
+
+        '''
+        Returns True if a file doesn't need to be processed: it is done with the
+        same settings or quarantined (unless retrying), and hasn't changed since.
+        '''
+
+        record = self.records.get( os.path.abspath( file ) )
+
+        if record is None or record['stamp'] != self._stamp( file ):
+            return False
+        elif record['state'] == 'done':
+            return record.get( 'settings' ) == settings
+        elif record['state'] == 'failed':
+            return not self.retry
+
+        return False
+
+
+    def complete( self, file, settings = None, output = None, ntoa = None ):
+
+        '''
+        Records a file as done, with the output its TOAs were written to.
+        '''
+
+        self._write( { 'file': os.path.abspath( file ), 'state': 'done', 'stamp': self._stamp( file ), 'settings': settings,
+                       'output': output, 'ntoa': ntoa, 'time': time.time() } )
+
+
+    def fail( self, file, traceback, settings = None ):
+
+        '''
+        Quarantines a file, recording the traceback of its error.
+        '''
+
+        self._write( { 'file': os.path.abspath( file ), 'state': 'failed', 'stamp': self._stamp( file ), 'settings': settings,
+                       'traceback': traceback, 'time': time.time() } )
+
+        if self.verbose:
+            print( "Quarantined {}:\n{}".format( file, traceback ) )
+        else:
+            print( "\nQuarantined {} ({})".format( file, traceback.strip().splitlines()[-1] ) )
+
+
+    def completed( self ):
+
+        '''
+        Returns the files recorded as done.
+        '''
+
+        return [ file for file, record in self.records.items() if record['state'] == 'done' ]
+
+
+    def quarantined( self ):
+
+        '''
+        Returns a dictionary of the quarantined files and their tracebacks.
+        '''
+
+        return { file: record.get( 'traceback' ) for file, record in self.records.items() if record['state'] == 'failed' }
@@ -0,0 +1,315 @@
+# Calibrate-zap-scrunch-time pipeline class, Python 3
+
+# Local imports
+from DataCulling import DataCull
+from PSRToas import TOAStore
+from PSRJournal import RunJournal
+import utils.otherUtilities as u
+import utils.timingUtils as tu
+import utils.schedulerUtils as sch
+
+# PyPulse is imported by the first file processed, so building a pipeline (or importing this module) doesn't load it
+
+# Other imports
+import os
+import sys
+import hashlib
+import traceback
+import numpy as np
+from astropy.io import fits
+
+
+# Pipeline class
+class Pipeline:
+
+    '''
+    Class to take PSRFITS files from raw data to TOAs in a single pass per file:
+    flux calibration, RFI excision, scrunching and TOA generation all work on
+    the same loaded archive, which is only read once. Files are processed by
+    the parallel scheduler used by main.py and the TOAs of every file are
+    written by the calling process, in input order, with the native engine.
+    '''
+
+    def __init__( self, template, band, nsubint, nsubfreq, jump = None, RFI = None, planner = None, verbose = False ):
+
+        '''
+        Initializes the pipeline with a template, the frequency band (frontend)
+        to time, the number of sub-integrations and sub-bands to scrunch to and
+        optionally a jump string, the number of RFI excision iterations and a
+        CalibrationPlanner to flux calibrate each file with.
+        '''
+
+        self.template = str( template )
+        self.band = str( band )
+        self.verbose = verbose
+        self.rfi = RFI
+        self.planner = planner
+
+        if not jump:
+            self.jump = ""
+        else:
+            self.jump = str( jump )
+
+        if not isinstance( nsubint, int ):
+            raise TypeError( "nsubint argument must be an integer. Argument is currently {}".format( type( nsubint ).__name__ ) )
+        elif nsubint <= 0:
+            raise ValueError( "nsubint cannot be less than 1. Currently: {}".format( nsubint ) )
+
+        self.nsubint = nsubint
+        self.nsubfreq = nsubfreq
+
+        # The template FFT is calculated once and shipped to every worker
+        template = np.load( u.addExtension( self.template, 'npy' ) )
+        if isinstance( template, np.lib.npyio.NpzFile ):
+            with template:
+                self.templateFFT = template['portraitFFT']
+        else:
+            self.templateFFT = np.fft.rfft( template )
+
+        settings = "{}|{}|{}|{}|{}|{}".format( os.path.abspath( self.template ), self.nsubint, self.nsubfreq, self.rfi, self.jump, self.planner is not None )
+        self.settings = hashlib.sha1( settings.encode() ).hexdigest()[:16]
+
+    def __repr__( self ):
+        return "Pipeline( template = {}, band = {}, nsubint = {}, nsubfreq = {}, jump = {}, RFI = {}, planner = {}, verbose = {} )".format( self.template, self.band, self.nsubint, self.nsubfreq, self.jump, self.rfi, self.planner, self.verbose )
+
+    def __str__( self ):
+        return self.template, self.band, self.nsubint, self.nsubfreq, self.jump, self.rfi
+
+
+    def output( self, save, frontend ):
+
+        '''
+        Returns the TEMPO2 file the TOAs of a frontend are written to.
+        '''
+
+        return save
+
+
+    def process( self, file, header = None ):
+
+        '''
+        Runs one file through the whole pipeline and returns its TOAs as columns
+        (see timingUtils.toaColumns), or None if the file isn't a PSR observation
+        with the right frontend or its signal / noise is too low. The primary
+        header can be given if it has already been read.
+        '''
+
+        if header is None:
+            try:
+                header = fits.getheader( file, 0 )
+            except OSError:
+                if self.verbose:
+                    print( "{} is not a fits file...".format( file ) )
+                return None
+
+        if header.get( 'OBS_MODE' ) != 'PSR' or header.get( 'FRONTEND' ) != self.band:
+            return None
+
+        from pypulse.archive import Archive
+
+        # Load all polarisations so the archive can be calibrated before it is prepared
+        ar = Archive( file, prepare = False, verbose = False )
+
+        if self.planner is not None and not self.planner.calibrate( ar ):
+            if self.verbose:
+                print( "Could not flux calibrate {}...".format( file ) )
+
+        # Prepare the archive as PyPulse would have on loading. The baseline removed on loading used the off-pulse window of the
+        # dispersed, uncentred profile, so it is removed again with the window of the prepared one.
+        ar.pscrunch()
+        ar.dedisperse( wcfreq = True )
+        ar.calculateAverageProfile()
+        ar.center()
+        ar.removeBaseline()
+
+        # RFI excision on the same archive
+        directory, filename = os.path.split( os.path.abspath( file ) )
+        cullObject = DataCull( filename, self.template, directory + "/", verbose = self.verbose, archive = ar )
+
+        if cullObject.SNError:
+            return None
+
+        if self.rfi is not None and isinstance( self.rfi, int ):
+            cullObject.reject( 'chauvenet', self.rfi )
+
+        # Scrunch the data cube with the weights left by the rejection, straight into the TOA fit
+        return tu.timeRecordColumns( [ cullObject.scrunch( self.nsubint, self.nsubfreq ) ], self.templateFFT, flags = self.jump, settings = self.settings )
+
+
+    def processSafely( self, file ):
+
+        '''
+        Runs process on a file, catching any error. Returns the TOA columns (or
+        None) and the traceback of the error (or None), so one bad file doesn't
+        stop the run.
+        '''
+
+        try:
+            return self.process( file ), None
+        except Exception:
+            return None, traceback.format_exc()
+
+
+    def run( self, files, save, store = None, processes = 1, memory = None, journal = None ):
+
+        '''
+        Runs every file through the pipeline on the given number of worker
+        processes, appending the TOAs to the TEMPO2 file save (and to the TOA
+        store directory, if given) as each file finishes, in input order.
+        Largest files are started first and, with a memory budget in MB, files
+        are only started while the estimated footprints of the files being
+        processed fit in the budget.
+        With a run journal (a RunJournal or its filename), files it has recorded
+        are skipped, each file is checkpointed once its TOAs are written and
+        files that raise an error are quarantined instead of stopping the run.
+        The store and journal can be given already open, so repeated runs
+        (e.g. in watch mode) don't reread them.
+        Returns the number of TOAs written.
+        '''
+
+        if store is not None and not isinstance( store, TOAStore ):
+            store = TOAStore( store, verbose = self.verbose )
+
+        if journal is not None and not isinstance( journal, RunJournal ):
+            journal = RunJournal( journal, verbose = self.verbose )
+
+        files = list( files )
+        if journal is not None:
+            files = [ file for file in files if not journal.skip( file, self.settings ) ]
+
+        ntoa = 0
+
+        if not self.verbose:
+            sys.stdout.write( '\n {0:<7s}  {1:<7s}\n'.format( 'Files', '% done' ) )
+
+        function = self.process if journal is None else self.processSafely
+
+        for i, ( file, result ) in enumerate( sch.runJobs( function, files, processes, memory * 1024**2 if memory is not None else None, sch.archiveFootprint ) ):
+
+            columns, error = ( result, None ) if journal is None else result
+
+            if columns is not None and len( columns['imjd'] ) > 0:
+                tu.writeTOAs( tu.tempo2Lines( columns ), self.output( save, columns['frontend'][0] ), appendto = True )
+                if store is not None:
+                    store.append( columns )
+                ntoa += len( columns['imjd'] )
+
+            # Checkpoint the file once its TOAs are written
+            if journal is not None and error is not None:
+                journal.fail( file, error, self.settings )
+            elif journal is not None and columns is not None and len( columns['imjd'] ) > 0:
+                journal.complete( file, self.settings, self.output( save, columns['frontend'][0] ), len( columns['imjd'] ) )
+            elif journal is not None:
+                journal.complete( file, self.settings, None, 0 )
+
+            if not self.verbose:
+                u.display_status( i, len( files ) )
+
+        return ntoa
+
+
+# Multi-band pipeline class
+class MultiBandPipeline( Pipeline ):
+
+    '''
+    Class to time files from several frontends in a single pass. Each frontend
+    has its own template, scrunch factors and jump flags (see loadBands) and
+    every file is routed to the pipeline of its frontend from one read of its
+    header. The TOAs of each frontend go to their own TEMPO2 file, named after
+    the output file with the frontend added (e.g. PSR_TOAs_lbw.toa). Files are
+    run with the same scheduler, journal and TOA store options as Pipeline.
+    '''
+
+    def __init__( self, bands, RFI = None, planner = None, verbose = False ):
+
+        '''
+        Initializes a pipeline for every frontend of a band configuration, given
+        as a file or as a dictionary of frontends to dictionaries of template,
+        nsubint, nsubfreq and jump, with the number of RFI excision iterations
+        and a CalibrationPlanner shared by every frontend.
+        '''
+
+        self.bands = loadBands( bands ) if isinstance( bands, str ) else dict( bands )
+        self.verbose = verbose
+        self.rfi = RFI
+        self.planner = planner
+
+        if not self.bands:
+            raise ValueError( "No frontends found in the band configuration." )
+
+        self.pipelines = { frontend: Pipeline( band['template'], frontend, band['nsubint'], band['nsubfreq'], band.get( 'jump' ), RFI, planner, verbose ) for frontend, band in self.bands.items() }
+
+        settings = "|".join( "{}:{}".format( frontend, self.pipelines[frontend].settings ) for frontend in sorted( self.pipelines ) )
+        self.settings = hashlib.sha1( settings.encode() ).hexdigest()[:16]
+
+    def __repr__( self ):
+        return "MultiBandPipeline( bands = {}, RFI = {}, planner = {}, verbose = {} )".format( self.bands, self.rfi, self.planner, self.verbose )
+
+    def __str__( self ):
+        return ", ".join( self.pipelines )
+
+
+    def output( self, save, frontend ):
+
+        '''
+        Returns the TEMPO2 file the TOAs of a frontend are written to.
+        '''
+
+        root, extension = os.path.splitext( save )
+
+        return "{}_{}{}".format( root, frontend, extension )
+
+
+    def process( self, file, header = None ):
+
+        '''
+        Runs one file through the pipeline of its frontend and returns its TOAs
+        as columns, or None if its frontend isn't configured (or see Pipeline.process).
+        '''
+
+        if header is None:
+            try:
+                header = fits.getheader( file, 0 )
+            except OSError:
+                if self.verbose:
+                    print( "{} is not a fits file...".format( file ) )
+                return None
+
+        pipeline = self.pipelines.get( header.get( 'FRONTEND' ) )
+
+        if pipeline is None:
+            return None
+
+        return pipeline.process( file, header )
+
+
+def loadBands( filename ):
+
+    '''
+    Reads a band configuration file. Each line holds a frontend, its template,
+    the number of sub-integrations and sub-bands to scrunch to and optionally
+    the jump flags to add to its TOAs (the rest of the line):
+
+        # frontend  template        nsubint  nsubfreq  jump
+        lbw         lbw_temp.npy    1        1         -fe L-wide
+        430         430_temp.npy    1        1         -fe 430
+
+    Returns a dictionary of frontends to their settings.
+    '''
+
+    bands = {}
+
+    with open( filename, 'r' ) as file:
+        for number, line in enumerate( file, 1 ):
+
+            line = line.split( "#" )[0].strip()
+            if not line:
+                continue
+
+            fields = line.split( None, 4 )
+            if len( fields ) < 4:
+                raise ValueError( "Line {} of {} needs a frontend, template, nsubint and nsubfreq. (Found: {})".format( number, filename, line ) )
+
+            bands[fields[0]] = { 'template': fields[1], 'nsubint': int( fields[2] ), 'nsubfreq': int( fields[3] ), 'jump': fields[4] if len( fields ) > 4 else None }
+
+    return bands
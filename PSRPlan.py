@@ -0,0 +1,203 @@
+# Work planner class, Python 3
+
+# Local imports
+import utils.schedulerUtils as sch
+
+# Other imports
+import os
+import json
+from astropy.io import fits
+
+# Throughput measured by testing/throughput_benchmark.py
+THROUGHPUT_FILE = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), "throughput.json" )
+
+# Throughput assumed until it has been measured on this machine: bytes read and decoded per second, rejection fits per second,
+# profiles compared per second by portrait rejection, profiles timed per second by the native engine and by PyPulse
+# (Archive.time), profiles flux calibrated per second, seconds to solve the flux calibration of an epoch from its CAL files
+# and seconds of overhead per file
+DEFAULT_THROUGHPUT = { 'read': 100e6, 'fit': 200.0, 'portrait': 50000.0, 'toa': 5000.0, 'pypulse': 100.0, 'cal': 200000.0, 'solve': 10.0, 'file': 0.5 }
+
+# What each rate is, for the report
+RATE_NAMES = { 'read': "reading", 'fit': "rejection fits", 'portrait': "portrait rejection", 'toa': "native timing", 'pypulse': "PyPulse timing",
+               'cal': "flux calibration", 'solve': "calibration solves", 'file': "per file overhead" }
+
+
+# Work planner class
+class WorkPlan:
+
+    '''
+    Class for a dry run of a timing job. Each file's primary and SUBINT headers
+    are read, but never its data, to work out how many bytes will be read,
+    how many profiles the archive holds, how many rejection fits RFI excision
+    will make and how many TOAs will be made. The runtime is estimated from
+    the throughput measured by testing/throughput_benchmark.py, or rough
+    defaults if it hasn't been run on this machine, for the TOA engine used
+    and with the cost of flux calibration if the files are calibrated.
+    '''
+
+    def __init__( self, files, bands, RFI = None, throughput = THROUGHPUT_FILE, engine = 'pypulse', calibrate = False, verbose = False ):
+
+        '''
+        Initializes the plan for a list of files and a dictionary of the
+        frontends to time mapped to dictionaries of their nsubint and nsubfreq
+        (e.g. a band configuration, see PSRPipeline.loadBands) and optionally
+        their template, with the number of RFI excision iterations, the
+        throughput file to use, the TOA engine ('pypulse' or 'native') and
+        whether the files are flux calibrated.
+        '''
+
+        self.files = [ str( file ) for file in files ]
+        self.bands = dict( bands )
+        self.rfi = RFI if isinstance( RFI, int ) else None
+        self.engine = str( engine )
+        self.calibrate = calibrate
+        self.verbose = verbose
+
+        if self.engine not in [ 'pypulse', 'native' ]:
+            raise ValueError( "Engine must be either 'pypulse' or 'native'. (Given: {})".format( self.engine ) )
+
+        # Rates missing from the throughput file (some are never benchmarked) keep their defaults
+        self.throughput, self.measured, self.defaults = dict( DEFAULT_THROUGHPUT ), None, list( DEFAULT_THROUGHPUT )
+        if throughput is not None and os.path.isfile( throughput ):
+            with open( throughput, 'r' ) as file:
+                measured = json.load( file )
+            self.throughput.update( { key: float( measured[key] ) for key in DEFAULT_THROUGHPUT if key in measured } )
+            self.measured = measured.get( 'measured' )
+            self.defaults = [ key for key in DEFAULT_THROUGHPUT if key not in measured ]
+
+        self.entries = [ self.inspect( file ) for file in self.files ]
+
+        # Each epoch's flux calibration is solved once, by its first file
+        if self.calibrate:
+            epochs = set()
+            for entry in self.entries:
+                if entry['skip'] is None and entry['epoch'] not in epochs:
+                    epochs.add( entry['epoch'] )
+                    entry['seconds'] += self.throughput['solve']
+
+    def __repr__( self ):
+        return "WorkPlan( files = {}, bands = {}, RFI = {}, engine = {}, calibrate = {}, verbose = {} )".format( len( self.files ), self.bands, self.rfi, self.engine, self.calibrate, self.verbose )
+
+    def __str__( self ):
+        return "\n".join( self.report() )
+
+    def __len__( self ):
+        return len( self.entries )
+
+
+    def inspect( self, file ):
+
+        '''
+        Returns the plan of one file as a dictionary, from its headers alone.
+        Files that won't be timed (not PSR observations of a frontend being
+        timed, or not PSRFITS) are kept with a reason and no cost.
+        '''
+
+        entry = { 'file': file, 'frontend': None, 'epoch': None, 'bytes': 0, 'memory': 0, 'profiles': 0, 'fits': 0, 'toas': 0, 'seconds': 0.0, 'skip': None }
+
+        try:
+            entry['bytes'] = os.path.getsize( file )
+            with fits.open( file, memmap = True, lazy_load_hdus = True ) as hdul:
+                primary, subint = hdul[0].header, hdul['SUBINT'].header
+        except ( OSError, KeyError, IndexError, TypeError ):
+            entry['skip'] = "not PSRFITS"
+            return entry
+
+        entry['frontend'] = primary.get( 'FRONTEND' )
+        entry['epoch'] = ( primary.get( 'STT_IMJD' ), entry['frontend'] )
+
+        if primary.get( 'OBS_MODE' ) != 'PSR':
+            entry['skip'] = "OBS_MODE {}".format( primary.get( 'OBS_MODE' ) )
+            return entry
+        elif entry['frontend'] not in self.bands:
+            entry['skip'] = "frontend {}".format( entry['frontend'] )
+            return entry
+
+        try:
+            nsubint, npol, nchan, nbin = ( int( subint[key] ) for key in ( 'NAXIS2', 'NPOL', 'NCHAN', 'NBIN' ) )
+        except ( KeyError, ValueError, TypeError ):
+            entry['skip'] = "no SUBINT shape"
+            return entry
+
+        band = self.bands[entry['frontend']]
+
+        entry['memory'] = nsubint * npol * nchan * nbin * 8 * sch.ARCHIVE_COPIES
+        entry['profiles'] = nsubint * npol * nchan
+
+        # Each generation of RFI excision fits every total intensity profile once (at most, it can stop early).
+        # Portrait templates are compared with every profile at once instead, without any fits.
+        portrait = os.path.splitext( str( band.get( 'template' ) ) )[1] == '.npz'
+        if self.rfi is not None and not portrait:
+            entry['fits'] = self.rfi * nsubint * nchan
+
+        entry['toas'] = min( int( band['nsubint'] ), nsubint ) * min( int( band['nsubfreq'] ), nchan )
+
+        entry['seconds'] = ( self.throughput['file'] + entry['bytes'] / self.throughput['read'] +
+                             entry['fits'] / self.throughput['fit'] + entry['toas'] / self.throughput['toa' if self.engine == 'native' else 'pypulse'] )
+
+        if self.rfi is not None and portrait:
+            entry['seconds'] += self.rfi * nsubint * nchan / self.throughput['portrait']
+
+        # Calibration scales every profile of every polarisation
+        if self.calibrate:
+            entry['seconds'] += entry['profiles'] / self.throughput['cal']
+
+        return entry
+
+
+    def totals( self ):
+
+        '''
+        Returns the totals of the files that will be timed as a dictionary.
+        '''
+
+        timed = [ entry for entry in self.entries if entry['skip'] is None ]
+        totals = { key: sum( entry[key] for entry in timed ) for key in ( 'bytes', 'profiles', 'fits', 'toas', 'seconds' ) }
+        totals.update( { 'files': len( timed ), 'skipped': len( self.entries ) - len( timed ), 'memory': max( [ entry['memory'] for entry in timed ] + [ 0 ] ) } )
+
+        return totals
+
+
+    def wallTime( self, processes = 1 ):
+
+        '''
+        Returns the estimated wall time in seconds on a number of processes,
+        with the largest files started first as the scheduler does.
+        '''
+
+        workers = [ 0.0 ] * sch.processCount( processes )
+        for seconds in sorted( ( entry['seconds'] for entry in self.entries ), reverse = True ):
+            workers[workers.index( min( workers ) )] += seconds
+
+        return max( workers )
+
+
+    def report( self, processes = 1 ):
+
+        '''
+        Returns the plan as lines of text: one per file, then the totals.
+        '''
+
+        lines = [ "{:<40s} {:>8s} {:>10s} {:>10s} {:>10s} {:>8s} {:>10s}".format( 'File', 'Frontend', 'MB', 'Profiles', 'Fits', 'TOAs', 'Seconds' ) ]
+
+        for entry in self.entries:
+            name = os.path.basename( entry['file'] )
+            if entry['skip'] is not None:
+                lines.append( "{:<40s} skipped ({})".format( name, entry['skip'] ) )
+            else:
+                lines.append( "{:<40s} {:>8s} {:>10.1f} {:>10d} {:>10d} {:>8d} {:>10.1f}".format( name, str( entry['frontend'] ), entry['bytes'] / 1024**2,
+                                                                                                   entry['profiles'], entry['fits'], entry['toas'], entry['seconds'] ) )
+
+        totals = self.totals()
+        lines.append( "{:<40s} {:>8s} {:>10.1f} {:>10d} {:>10d} {:>8d} {:>10.1f}".format( "Total ({} files, {} skipped)".format( totals['files'], totals['skipped'] ), "",
+                                                                                           totals['bytes'] / 1024**2, totals['profiles'], totals['fits'], totals['toas'], totals['seconds'] ) )
+        lines.append( "Largest archive in memory: {:.1f} MB".format( totals['memory'] / 1024**2 ) )
+        lines.append( "TOA engine: {}{}".format( self.engine, ", flux calibrated ({} epoch(s) to solve)".format( len( { entry['epoch'] for entry in self.entries if entry['skip'] is None } ) ) if self.calibrate else "" ) )
+        seconds = int( round( self.wallTime( processes ) ) )
+        lines.append( "Estimated wall time on {} process(es): {:d}:{:02d}:{:02d}".format( sch.processCount( processes ), seconds // 3600, ( seconds // 60 ) % 60, seconds % 60 ) )
+        if self.measured is None:
+            lines.append( "Throughput not measured, using defaults (run testing/throughput_benchmark.py)" )
+        else:
+            lines.append( "Throughput measured {}{}".format( self.measured, ", defaults used for {}".format( ", ".join( RATE_NAMES[key] for key in self.defaults ) ) if self.defaults else "" ) )
+
+        return lines
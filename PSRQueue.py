@@ -0,0 +1,319 @@
+# Work queue class, Python 3
+
+# Local imports
+import utils.timingUtils as tu
+
+# Imports
+import os
+import json
+import time
+import socket
+
+
+# Work queue class
+class WorkQueue:
+
+    '''
+    Class for a file-level work queue kept in a directory on shared storage,
+    so any number of workers on any node can time one campaign without a job
+    broker. Each work item is a small JSON file that moves between the
+    subdirectories pending/, claimed/, done/ and failed/. Workers claim an item
+    by renaming it from pending/ to claimed/, which only one of them can do,
+    and record the time and worker of the claim next to it (item.claim), so
+    items left claimed by a worker that died can be requeued after a timeout.
+    The TOAs of each item are written to done/ atomically and collected, in
+    item order, into one TEMPO2 file once every item is finished. The timing
+    settings shared by every worker are kept in settings.json.
+    '''
+
+    STATES = [ 'pending', 'claimed', 'done', 'failed' ]
+
+    def __init__( self, directory, verbose = False ):
+
+        '''
+        Initializes the queue in a directory, creating it if needed.
+        '''
+
+        self.directory = str( directory )
+        self.verbose = verbose
+
+        for state in self.STATES:
+            os.makedirs( os.path.join( self.directory, state ), exist_ok = True )
+
+        # Name of this worker, to tell who claimed what
+        self.worker = "{}_{}".format( socket.gethostname(), os.getpid() )
+
+        # Records of the items this worker has claimed, in case they are requeued while being timed
+        self._claims = {}
+
+    def __repr__( self ):
+        return "WorkQueue( directory = {}, verbose = {} )".format( self.directory, self.verbose )
+
+    def __str__( self ):
+        return self.directory
+
+    def __len__( self ):
+        return sum( self.status().values() )
+
+
+    def _path( self, state, item, extension = ".json" ):
+        return os.path.join( self.directory, state, item + extension )
+
+    def _items( self, state ):
+        return sorted( file[:-5] for file in os.listdir( os.path.join( self.directory, state ) ) if file.endswith( ".json" ) )
+
+    def _write( self, filename, text ):
+
+        '''
+        Writes a file atomically, so other nodes never see it half written.
+        '''
+
+        temporary = "{}.{}.tmp".format( filename, self.worker )
+        with open( temporary, 'w' ) as file:
+            file.write( text )
+        os.replace( temporary, filename )
+
+
+    def configure( self, settings ):
+
+        '''
+        Saves the settings (a dictionary) every worker times the files with.
+        '''
+
+        self._write( os.path.join( self.directory, "settings.json" ), json.dumps( settings, indent = 1 ) )
+
+    def settings( self ):
+
+        '''
+        Returns the settings saved by configure.
+        '''
+
+        with open( os.path.join( self.directory, "settings.json" ), 'r' ) as file:
+            return json.load( file )
+
+
+    def enqueue( self, files ):
+
+        '''
+        Adds a work item for every file, numbered after the items already
+        queued so TOAs are collected in the order the files were given.
+        Returns the number of items added.
+        '''
+
+        start = len( self )
+
+        for i, file in enumerate( files ):
+            item = "{:08d}".format( start + i )
+            self._write( self._path( 'pending', item ), json.dumps( { 'item': item, 'file': os.path.abspath( file ) } ) )
+
+        return len( files )
+
+
+    def claim( self ):
+
+        '''
+        Claims the next pending item for this worker. Returns the item and its
+        file, or None if nothing is left to claim.
+        '''
+
+        for item in self._items( 'pending' ):
+            try:
+                os.rename( self._path( 'pending', item ), self._path( 'claimed', item ) )
+            except FileNotFoundError:
+                # Another worker got there first
+                continue
+
+            # The claim time is written atomically next to the item (see requeue)
+            self._write( self._path( 'claimed', item, ".claim" ), json.dumps( { 'worker': self.worker, 'time': time.time() } ) )
+
+            try:
+                with open( self._path( 'claimed', item ), 'r' ) as file:
+                    self._claims[item] = json.load( file )
+            except FileNotFoundError:
+                # Requeued in between, so it is up for grabs again
+                self._remove( self._path( 'claimed', item, ".claim" ) )
+                continue
+
+            return item, self._claims[item]['file']
+
+        return None
+
+
+    def _remove( self, filename ):
+
+        '''
+        Removes a file if it is still there.
+        '''
+
+        try:
+            os.remove( filename )
+        except FileNotFoundError:
+            pass
+
+
+    def _release( self, item ):
+
+        '''
+        Returns the record of an item this worker claimed and removes its claim.
+        An item requeued while it was being timed is still finished: its
+        results are the same whoever times it.
+        '''
+
+        record = dict( self._claims.pop( item ) )
+
+        for state in [ 'claimed', 'pending' ]:
+            self._remove( self._path( state, item ) )
+        self._remove( self._path( 'claimed', item, ".claim" ) )
+
+        return record
+
+
+    def complete( self, item, columns = None ):
+
+        '''
+        Marks a claimed item as done, saving its TOA columns (if any) in TEMPO2 format.
+        '''
+
+        record = self._claims[item]
+
+        lines = tu.tempo2Lines( columns ) if columns is not None else []
+        record.update( { 'worker': self.worker, 'ntoa': len( lines ), 'frontend': str( columns['frontend'][0] ) if lines else None } )
+
+        self._write( self._path( 'done', item, ".toa" ), "".join( lines ) )
+        self._write( self._path( 'done', item ), json.dumps( record ) )
+        self._release( item )
+
+
+    def fail( self, item, traceback ):
+
+        '''
+        Marks a claimed item as failed, keeping the traceback of its error.
+        '''
+
+        record = self._claims[item]
+
+        record.update( { 'worker': self.worker, 'traceback': traceback } )
+        self._write( self._path( 'failed', item ), json.dumps( record ) )
+        self._release( item )
+
+        if self.verbose:
+            print( "Item {} ({}) failed:\n{}".format( item, record['file'], traceback ) )
+
+
+    def requeue( self, timeout ):
+
+        '''
+        Puts items claimed more than timeout seconds ago (e.g. by a worker
+        that died) back in the queue. The claim time comes from the item's
+        claim record, or from when the item was renamed into claimed/ (its
+        change time) if the claim record isn't written yet, never from when
+        it was queued. Returns the number of items requeued.
+        '''
+
+        requeued = 0
+        for item in self._items( 'claimed' ):
+            try:
+                try:
+                    with open( self._path( 'claimed', item, ".claim" ), 'r' ) as file:
+                        claimed = float( json.load( file )['time'] )
+                except ( FileNotFoundError, ValueError, KeyError ):
+                    claimed = os.stat( self._path( 'claimed', item ) ).st_ctime
+
+                if time.time() - claimed > timeout:
+                    os.rename( self._path( 'claimed', item ), self._path( 'pending', item ) )
+                    self._remove( self._path( 'claimed', item, ".claim" ) )
+                    requeued += 1
+            except FileNotFoundError:
+                # Finished (or requeued by another worker) in the meantime
+                continue
+
+        if requeued and self.verbose:
+            print( "Requeued {} items claimed more than {} seconds ago...".format( requeued, timeout ) )
+
+        return requeued
+
+
+    def status( self ):
+
+        '''
+        Returns the number of items in each state.
+        '''
+
+        return { state: len( self._items( state ) ) for state in self.STATES }
+
+
+    def finished( self ):
+
+        '''
+        Returns True if every item is done or failed.
+        '''
+
+        status = self.status()
+
+        return status['pending'] == 0 and status['claimed'] == 0
+
+
+    def collect( self, filename, output = None ):
+
+        '''
+        Writes the TOAs of every done item, in item order, to a TEMPO2 file.
+        If an output( filename, frontend ) function is given (e.g. the output
+        method of a pipeline), each frontend's TOAs go to the file it returns.
+        Returns the number of TOAs written.
+        '''
+
+        outputs = {}
+        for item in self._items( 'done' ):
+
+            with open( self._path( 'done', item ), 'r' ) as file:
+                frontend = json.load( file ).get( 'frontend' )
+            if frontend is None:
+                continue
+
+            with open( self._path( 'done', item, ".toa" ), 'r' ) as file:
+                outputs.setdefault( output( filename, frontend ) if output is not None else filename, [] ).extend( file.readlines() )
+
+        # Written whole (with the FORMAT 1 header writeTOAs adds) and atomically, so collecting again gives the same file
+        for path, lines in outputs.items():
+            self._write( path, "FORMAT 1\n" + "".join( lines ) )
+
+        return sum( len( lines ) for lines in outputs.values() )
+
+
+    def work( self, pipeline, store = None, timeout = None ):
+
+        '''
+        Claims and times items with a Pipeline until the queue is empty,
+        appending TOAs to the TOA store (if given) as they are made. Files
+        that raise an error are marked as failed and the worker carries on.
+        With a timeout (in seconds), items claimed longer ago than that are
+        requeued and timed before the worker decides the queue is empty.
+        Returns the number of items this worker finished.
+        '''
+
+        finished = 0
+
+        while True:
+
+            claimed = self.claim()
+            if claimed is None and timeout is not None and self.requeue( timeout ):
+                continue
+            elif claimed is None:
+                return finished
+
+            item, file = claimed
+
+            if self.verbose:
+                print( "{} timing item {} ({})...".format( self.worker, item, file ) )
+
+            columns, error = pipeline.processSafely( file )
+
+            if error is not None:
+                self.fail( item, error )
+                continue
+
+            if store is not None and columns is not None and len( columns['imjd'] ) > 0:
+                store.append( columns )
+
+            self.complete( item, columns )
+            finished += 1
@@ -0,0 +1,348 @@
+# Timing server, Python 3
+
+# Only light imports at module level: clients never load PyPulse, astropy or scipy.
+# The server process and its workers import everything once, on start up.
+import os
+import sys
+import json
+import socket
+import socketserver
+import threading
+import ipaddress
+from concurrent.futures import ProcessPoolExecutor
+
+# Default server address. Addresses with a ':' are localhost TCP ports (host:port), anything else is a Unix socket path.
+DEFAULT_ADDRESS = "/tmp/pulseblast.sock"
+
+# Jobs the server accepts
+JOBS = [ 'timing', 'cull', 'template', 'ping' ]
+
+
+def _parseAddress( address ):
+
+    '''
+    Returns the socket family and address for an address string.
+    '''
+
+    address = str( address )
+
+    if ":" in address and not os.path.sep in address:
+        host, port = address.rsplit( ":", 1 )
+        return socket.AF_INET, ( host or "localhost", int( port ) )
+
+    return socket.AF_UNIX, address
+
+
+def _isLoopback( host ):
+
+    '''
+    Returns True if every address a host name resolves to is a loopback address.
+    '''
+
+    try:
+        addresses = { info[4][0] for info in socket.getaddrinfo( host, None, socket.AF_INET, socket.SOCK_STREAM ) }
+    except socket.gaierror:
+        return False
+
+    return bool( addresses ) and all( ipaddress.ip_address( address ).is_loopback for address in addresses )
+
+
+# Worker process state. Each worker keeps its pipelines (and so their template FFTs) between jobs.
+_pipelines = {}
+
+def _initWorker():
+
+    '''
+    Imports the heavy modules once per worker so no job pays for them.
+    PyPulse and scipy are imported lazily by the modules that use them, so
+    they are imported here explicitly (pypulse.archive brings in matplotlib),
+    along with the mathUtils PDF classes (made on first use) used by FFT rejection.
+    '''
+
+    import PSRPipeline
+    import DataCulling
+    import PSRTemplate
+    import pypulse.archive
+    import scipy.optimize
+    import scipy.stats
+    import scipy.fftpack
+    import utils.mathUtils as mathu
+    import utils.calculate_flux as cf
+
+    mathu.FFT_dist
+    cf.getCatalog()
+
+
+def _pipeline( settings ):
+
+    '''
+    Returns the worker's pipeline for a set of timing settings, making it the
+    first time the settings (or the template file) are seen.
+    '''
+
+    from PSRPipeline import Pipeline
+
+    key = ( settings['template'], os.stat( settings['template'] ).st_mtime, settings['band'], settings['nsubint'], settings['nsubfreq'], settings.get( 'jump' ), settings.get( 'rfi' ) )
+
+    if key not in _pipelines:
+        _pipelines[key] = Pipeline( settings['template'], settings['band'], settings['nsubint'], settings['nsubfreq'], settings.get( 'jump' ), settings.get( 'rfi' ) )
+
+    return _pipelines[key]
+
+
+def _timeFile( settings, file ):
+
+    '''
+    Times one file on a warm worker. Returns the file and its TOA columns (or None).
+    '''
+
+    return file, _pipeline( settings ).process( file )
+
+
+def _cullFile( settings, file ):
+
+    '''
+    Runs RFI excision on one file on a warm worker. Returns a summary of the zapped profiles.
+    '''
+
+    from DataCulling import DataCull
+
+    directory, filename = os.path.split( os.path.abspath( file ) )
+    cullObject = DataCull( filename, settings['template'], directory + "/" )
+
+    if cullObject.SNError:
+        return { 'file': file, 'snError': True }
+
+    cullObject.reject( settings.get( 'criterion', 'chauvenet' ), settings.get( 'iterations', 1 ) )
+    weights = cullObject.ar.getWeights( squeeze = False )
+
+    return { 'file': file, 'snError': False, 'zapped': int( ( weights == 0 ).sum() ), 'profiles': int( weights.size ) }
+
+
+def _createTemplate( settings ):
+
+    '''
+    Creates a template on a warm worker. Returns the template profile as a list.
+    '''
+
+    from PSRTemplate import Template
+
+    templateObject = Template( settings['band'], *settings['directories'] )
+    profile = templateObject.createTemplate( settings.get( 'filename' ), settings.get( 'saveDirectory' ), False, settings.get( 'align', False ),
+                                             settings.get( 'iterations', 1 ), settings.get( 'portrait', False ), settings.get( 'nchan' ), settings.get( 'reader', False ) )
+
+    return { 'template': [ float( value ) for value in profile ] }
+
+
+def _files( input ):
+
+    '''
+    Returns the files of an input (a file, a directory, a glob or a list of them), see otherUtilities.resolveInputs.
+    '''
+
+    from utils.otherUtilities import resolveInputs
+
+    return resolveInputs( [ input ] if isinstance( input, str ) else input )
+
+
+# Server class
+class TimingServer:
+
+    '''
+    Class for a long-lived server that keeps PyPulse, astropy, scipy, the
+    templates and the flux catalog resident in a pool of warm worker processes.
+    Clients send one job per connection as a line of JSON and the results are
+    streamed back as JSON lines as soon as each file is done, ending with a
+    'done' (or 'error') message. Jobs are 'timing', 'cull', 'template' and 'ping'.
+    The server has no authentication and writes wherever its clients ask, so
+    it only listens on loopback TCP addresses unless allowRemote is set.
+    '''
+
+    def __init__( self, address = DEFAULT_ADDRESS, processes = None, verbose = False, allowRemote = False ):
+
+        '''
+        Initializes the server on a Unix socket path or a localhost host:port
+        address with the given number of worker processes (one per CPU if None).
+        Raises ValueError for a TCP address that isn't loopback, unless allowRemote is set.
+        '''
+
+        self.address = str( address )
+        self.verbose = verbose
+        self.allowRemote = allowRemote
+
+        family, address = _parseAddress( self.address )
+        if family == socket.AF_INET and not self.allowRemote and not _isLoopback( address[0] ):
+            raise ValueError( "{} is not a loopback address. The server has no authentication, so remote addresses need allowRemote (--allow-remote).".format( self.address ) )
+
+        # Imported here so clients don't pay for them
+        import utils.schedulerUtils as sch
+        import utils.timingUtils as tu
+
+        self._tu = tu
+        self.processes = sch.processCount( processes )
+        self.pool = ProcessPoolExecutor( max_workers = self.processes, initializer = _initWorker )
+        self._locks = {}
+        self._locksLock = threading.Lock()
+
+    def __repr__( self ):
+        return "TimingServer( address = {}, processes = {}, verbose = {}, allowRemote = {} )".format( self.address, self.processes, self.verbose, self.allowRemote )
+
+    def __str__( self ):
+        return self.address
+
+
+    def _outputLock( self, path ):
+
+        '''
+        Returns the lock for an output file, so concurrent jobs append to it one at a time.
+        '''
+
+        with self._locksLock:
+            return self._locks.setdefault( os.path.abspath( path ), threading.Lock() )
+
+
+    def handle( self, request, send ):
+
+        '''
+        Runs one job, calling send with each message to stream back.
+        '''
+
+        job, arguments = request.get( 'job' ), request.get( 'arguments', {} )
+
+        if job not in JOBS:
+            raise ValueError( "Unknown job {}. (Allowed: {})".format( job, ", ".join( JOBS ) ) )
+
+        if job == 'ping':
+            send( { 'status': 'ready', 'processes': self.processes } )
+
+        elif job == 'timing':
+            output, store = arguments.get( 'output' ), arguments.get( 'store' )
+            if store is not None:
+                from PSRToas import TOAStore
+                store = TOAStore( store )
+
+            futures = [ self.pool.submit( _timeFile, arguments, file ) for file in _files( arguments['input'] ) ]
+
+            # Results are taken in input order, so TOAs are written in the same order as every other batch path
+            for future in futures:
+                file, columns = future.result()
+                lines = self._tu.tempo2Lines( columns ) if columns is not None else []
+
+                if lines and output is not None:
+                    with self._outputLock( output ):
+                        self._tu.writeTOAs( lines, output, appendto = True )
+                        if store is not None:
+                            store.append( columns )
+
+                send( { 'file': file, 'toas': lines } )
+
+        elif job == 'cull':
+            futures = [ self.pool.submit( _cullFile, arguments, file ) for file in _files( arguments['input'] ) ]
+            for future in futures:
+                send( future.result() )
+
+        elif job == 'template':
+            send( self.pool.submit( _createTemplate, arguments ).result() )
+
+
+    def serve( self ):
+
+        '''
+        Warms up the workers and serves jobs until interrupted.
+        '''
+
+        server = self
+
+        class Handler( socketserver.StreamRequestHandler ):
+
+            def handle( self ):
+
+                def send( message ):
+                    self.wfile.write( ( json.dumps( message ) + "\n" ).encode() )
+                    self.wfile.flush()
+
+                try:
+                    server.handle( json.loads( self.rfile.readline().decode() ), send )
+                    send( { 'status': 'done' } )
+                except Exception as e:
+                    send( { 'status': 'error', 'message': "{}: {}".format( type( e ).__name__, e ) } )
+
+        family, address = _parseAddress( self.address )
+
+        if family == socket.AF_UNIX:
+            if os.path.exists( address ):
+                os.remove( address )
+            socketServer = socketserver.ThreadingUnixStreamServer( address, Handler )
+        else:
+            socketServer = socketserver.ThreadingTCPServer( address, Handler )
+
+        # Make every worker import everything before the first job arrives
+        for future in [ self.pool.submit( _initWorker ) for i in range( self.processes ) ]:
+            future.result()
+
+        if self.verbose:
+            print( "Serving on {} with {} warm workers...".format( self.address, self.processes ) )
+
+        try:
+            socketServer.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socketServer.server_close()
+            self.pool.shutdown()
+            if family == socket.AF_UNIX and os.path.exists( address ):
+                os.remove( address )
+
+
+def request( job, address = DEFAULT_ADDRESS, **arguments ):
+
+    '''
+    Sends a job to a running server and yields each message as it is streamed
+    back. Raises RuntimeError if the job fails on the server.
+    '''
+
+    family, address = _parseAddress( address )
+
+    with socket.socket( family, socket.SOCK_STREAM ) as connection:
+        connection.connect( address )
+        connection.sendall( ( json.dumps( { 'job': job, 'arguments': arguments } ) + "\n" ).encode() )
+
+        with connection.makefile( 'r' ) as stream:
+            for line in stream:
+                message = json.loads( line )
+                if message.get( 'status' ) == 'error':
+                    raise RuntimeError( message['message'] )
+                elif message.get( 'status' ) == 'done':
+                    return
+                yield message
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    parser = argparse.ArgumentParser( formatter_class = argparse.RawDescriptionHelpFormatter,
+                prog = 'PSRServer.py',
+                description = '''\
+                      PulseBlast Timing Server
+                -------------------------------------
+                  Keeps PulseBlast warm for fast jobs
+                    ''' )
+
+    parser.add_argument( '-s', '--socket', dest = 'address', default = DEFAULT_ADDRESS, help = 'Unix socket path or localhost host:port to serve on / connect to.' )
+    parser.add_argument( '-p', '--processes', dest = 'processes', type = int, default = None, help = 'Number of warm worker processes (server only). Default is one per CPU.' )
+    parser.add_argument( '-j', '--job', dest = 'job', choices = JOBS, default = None, help = 'Job to send to a running server. Without it, a server is started.' )
+    parser.add_argument( '-a', '--arguments', dest = 'arguments', default = '{}', help = 'Job arguments as a JSON object, e.g. \'{"input": "dir/", "template": "t.npy", "band": "lbw", "nsubint": 1, "nsubfreq": 1}\'.' )
+    parser.add_argument( '--allow-remote', dest = 'allowRemote', action = 'store_true', default = False, help = 'Allows serving on a TCP address that isn\'t loopback. The server has no authentication.' )
+    parser.add_argument( '-v', '--verbose', dest = 'verbose', action = 'store_true', default = False, help = 'Prints information to the console.' )
+
+    args = parser.parse_args()
+
+    if args.job is None:
+        TimingServer( args.address, args.processes, args.verbose, args.allowRemote ).serve()
+    else:
+        for message in request( args.job, args.address, **json.loads( args.arguments ) ):
+            if 'toas' in message:
+                sys.stdout.write( "".join( message['toas'] ) )
+            else:
+                print( json.dumps( message ) )
@@ -3,9 +3,9 @@
 
 # Local imports
 import utils.otherUtilities as u
+import utils.mathUtils as mathu
 
-# PyPulse imports
-from pypulse.archive import Archive
+# PyPulse is imported where archives are loaded, so templates made with the PSRFITS reader don't need it
 
 # Other imports
 import os
@@ -51,11 +51,33 @@ class Template:
         Loads the archive from the PyPulse Archive class and initializes the main parameters.
         '''
 
+        from pypulse.archive import Archive
+
         loadedArchive = Archive( self.directory + self.file, verbose = False )
 
         return loadedArchive
 
 
+    def _readPortrait( self ):
+
+        '''
+        Returns the file's total intensity profile of every channel (nchan x nbin),
+        summed over the subints with their weights, dedispersed and centred as
+        PyPulse prepares an archive, but read straight from the SUBINT table
+        with the PSRFITS reader instead of loading the archive.
+        '''
+
+        from PSRFits import SubintReader
+
+        with SubintReader( self.directory + self.file ) as reader:
+            portrait = reader.profiles( 'I', dedisperse = True )
+
+        # Centre the peak of the scrunched profile
+        shift = ( portrait.shape[1] // 2 ) - np.argmax( np.sum( portrait, axis = 0 ) )
+
+        return np.roll( portrait, shift, axis = -1 )
+
+
     def _templateCreationScript( self ):
 
         '''
@@ -64,31 +86,111 @@ class Template:
         createTemplate method.
         '''
 
-        # Load the archive
-        archive = self._loadArchive()
+        # Every subint added together for each channel, either read directly or from the loaded archive
+        if self.reader:
+            channels = self._readPortrait()
+        else:
+            channels = np.sum( self._loadArchive().getData( squeeze = False )[:, 0], axis = 0 )
+
+        nchan, nbin = channels.shape
 
         # Initialize the template if this is the first call
         if self._templateCreationScript.counter == 0:
-            self.templateProfile = np.zeros( archive.getNbin(), dtype = float )
+            self.templateProfile = np.zeros( nbin, dtype = float )
+
+            # The portrait takes the channel count of the first file unless one was given
+            if self.portrait:
+                if self.nchan is None:
+                    self.nchan = nchan
+                self.templatePortrait = np.zeros( ( self.nchan, nbin ), dtype = float )
+
             self._templateCreationScript.__func__.counter += 1
 
-        # Iterate through each subint and channel to add each profile together
-        for time in np.arange( archive.getNsubint() ):
-            for frequency in np.arange( archive.getNchan() ):
-                self.templateProfile += archive.getData()[time][frequency]
+        # Add every channel together to get the file's scrunched profile
+        profile = np.sum( channels, axis = 0 )
+
+        # Keep the scrunched profile so the template can be aligned without reloading the archive
+        self.profiles.append( profile )
+
+        self.templateProfile += profile
+
+        # Add every subint together and scrunch the channels down to the portrait's resolution
+        if self.portrait:
+            portrait = self._scrunchPortrait( channels )
+            self.portraits.append( portrait )
+            self.templatePortrait += portrait
 
         return self.templateProfile
 
 
-    def createTemplate( self, filename = None, saveDirectory = None, verbose = False ):
+    def _scrunchPortrait( self, portrait ):
+
+        '''
+        Sums adjacent channels of a 2D (nchan x nbin) profile together so it has
+        the number of channels set for the portrait template.
+        '''
+
+        nchan = portrait.shape[0]
+
+        if nchan % self.nchan != 0:
+            raise ValueError( "Number of channels in {} ({}) must be a multiple of the number of portrait channels ({})".format( self.file, nchan, self.nchan ) )
+
+        return np.sum( np.reshape( portrait, ( self.nchan, nchan // self.nchan, portrait.shape[1] ) ), axis = 1 )
+
+
+    def _alignProfiles( self, iterations = 1 ):
+
+        '''
+        Aligns the scrunched profile of every file against the current template
+        estimate and rebuilds the template from the aligned profiles.
+        Shifts are found and applied in the Fourier domain for all files at once
+        and the process repeats for the given number of passes.
+        Returns the aligned template.
+        '''
+
+        profiles = np.array( self.profiles )
+        nbin = profiles.shape[1]
+
+        # Each profile only needs to be transformed once. Every pass works on the original spectra
+        # so interpolation errors don't build up between passes.
+        spectra = np.fft.rfft( profiles, axis = 1 )
+        templateFFT = np.sum( spectra, axis = 0 )
+
+        for i in np.arange( iterations ):
+            shifts = mathu.fourierShifts( spectra, templateFFT, nbin )
+            templateFFT = np.sum( mathu.fourierRotate( spectra, -shifts, nbin ), axis = 0 )
+
+        self.shifts = shifts
+
+        # Every channel of a file's portrait gets the same shift as its scrunched profile
+        if self.portrait:
+            portraitSpectra = np.fft.rfft( np.array( self.portraits ), axis = 2 )
+            portraitFFT = np.sum( mathu.fourierRotate( portraitSpectra, -shifts[:, np.newaxis], nbin ), axis = 0 )
+            self.templatePortrait = np.fft.irfft( portraitFFT, n = nbin, axis = 1 )
+
+        return np.fft.irfft( templateFFT, n = nbin )
+
+
+    def createTemplate( self, filename = None, saveDirectory = None, verbose = False, align = False, iterations = 1, portrait = False, nchan = None, reader = False ):
 
         '''
         Loads the archive of each file in self.directory using PyPulse.
         Depending on the frequency band parsed at initialization, a template will be created for that frequency band, measuring it against the frontend in the fits file.
         Templates are saved in the saveDirectory as 1D numpy arrays with default extension .npy however any extension can be specified by the user.
         If arguments are not provided for the template name (without the .npy suffix) or directory name, a default file name and CWD will be used.
+        If align is set, each file's scrunched profile is phase aligned against the template for the given number of iterations before saving.
+        If portrait is set, a 2D (nchan x nbin) template is built alongside the 1D profile and saved with the per-channel FFTs in a .npz file.
+        nchan sets the number of portrait channels. If not provided, the channel count of the first file is used.
+        If reader is set, each file's summed profiles are read straight from its SUBINT table (see PSRFits.SubintReader) rather
+        than by loading the archive with PyPulse, which needs the files to have a PERIOD column to be dedispersed.
         '''
 
+        # Check if iterations is a positive integer
+        if not isinstance( iterations, int ):
+            raise TypeError( "iterations argument must be an integer. Argument is currently {}".format( type( iterations ).__name__ ) )
+        elif iterations <= 0:
+            raise ValueError( "iterations cannot be less than 1. Currently: {}".format( iterations ) )
+
         if verbose:
             print( "Beginning template creation..." )
 
@@ -106,8 +208,19 @@ class Template:
                 ext = '.npy'
                 filename_in_str = root + ext
 
+            # Portraits are always stored as .npz files
+            if portrait:
+                filename_in_str = root + '.npz'
+
         # Set the templates to empty arrays
         self.templateProfile = []
+        self.profiles = []
+        self.portraits = []
+
+        # Set the portrait and reader options for the creation script
+        self.portrait = portrait
+        self.nchan = nchan
+        self.reader = reader
 
         # Set the call counters for the creation scripts to 0
         self._templateCreationScript.__func__.counter = 0
@@ -202,13 +315,25 @@ class Template:
             # Check if this is the last directory in the list
             if i == ( len( self.args ) - 1 ):
 
+                # Align the stored profiles and rebuild the template before saving
+                if align and self.profiles:
+                    if verbose:
+                        print( "Aligning {} profiles over {} iterations...".format( len( self.profiles ), iterations ) )
+                    self.templateProfile = self._alignProfiles( iterations )
+
+                # Default filename depends on whether a portrait is also being saved
+                if portrait:
+                    default_filename = "PSR_template.npz"
+                else:
+                    default_filename = "PSR_template.npy"
+
                 # Check if a save name was provided and save as appropriate
                 if filename == None and saveDirectory == None:
-                    np.save( os.getcwd() + "PSR_template.npy", self.templateProfile )
+                    self._saveTemplate( os.getcwd() + default_filename )
                 elif filename == None:
-                    np.save( saveDirectory + "PSR_template.npy", self.templateProfile )
+                    self._saveTemplate( saveDirectory + default_filename )
                 else:
-                    np.save( saveDirectory + filename_in_str, self.templateProfile )
+                    self._saveTemplate( saveDirectory + filename_in_str )
 
         # Decide what to return based on doType
         if verbose:
@@ -219,6 +344,21 @@ class Template:
         return self.templateProfile
 
 
+    def _saveTemplate( self, path ):
+
+        '''
+        Saves the template to the path given. 1D templates are saved as .npy files.
+        Portrait templates are saved as .npz files containing the 1D profile
+        ('profile'), the 2D portrait ('portrait') and the real FFT of each portrait
+        channel ('portraitFFT') so they don't need to be recalculated on every load.
+        '''
+
+        if self.portrait:
+            np.savez( path, profile = self.templateProfile, portrait = self.templatePortrait, portraitFFT = np.fft.rfft( self.templatePortrait, axis = 1 ) )
+        else:
+            np.save( path, self.templateProfile )
+
+
     def deleteTemplate( self, dir, tempname ):
 
         '''
@@ -276,6 +416,11 @@ if __name__ == "__main__":
             parser.add_argument( '-b', dest = 'band', metavar = 'Frequency Band', nargs = 1, default = None, help = 'Frequency band of observation.' )
             parser.add_argument( '-o', dest = 'outputfile', metavar = 'Output File', nargs = 1, default = None, widget = 'FileSaver', help = 'Name of the output file and path.' )
             parser.add_argument( '-d', dest = 'directories', metavar = 'Directories List', nargs = '*', default = None, widget = 'MultiDirChooser', help = 'Directories to search for PSRFITS files in.' )
+            parser.add_argument( '-a', dest = 'align', metavar = 'Align Profiles', action = 'store_true', default = False, help = 'Phase align each file against the template before adding it.' )
+            parser.add_argument( '-i', dest = 'iterations', metavar = 'Alignment Iterations', nargs = 1, type = int, default = [1], help = 'Number of alignment passes.' )
+            parser.add_argument( '-p', dest = 'portrait', metavar = 'Portrait', action = 'store_true', default = False, help = 'Also create a frequency resolved (nchan x nbin) portrait template.' )
+            parser.add_argument( '-c', dest = 'nchan', metavar = 'Portrait Channels', nargs = 1, type = int, default = [None], help = 'Number of channels in the portrait template.' )
+            parser.add_argument( '-r', dest = 'reader', metavar = 'PSRFITS Reader', action = 'store_true', default = False, help = 'Read the summed profiles straight from the SUBINT tables instead of loading each archive.' )
             parser.add_argument( '-v', dest = 'verbose', metavar = 'Verbose Mode', action = 'store_true', default = False, help = 'Prints information to the console.' )
 
             args = parser.parse_args()
@@ -297,7 +442,7 @@ if __name__ == "__main__":
 
             # Initialize the template class object as normal and run the template creation script
             templateObject = Template( args.band[0], *idirs )
-            templateObject.createTemplate( ofile, odir, args.verbose )
+            templateObject.createTemplate( ofile, odir, args.verbose, args.align, args.iterations[0], args.portrait, args.nchan[0], args.reader )
 
     # If the UI package is unavailable
     else:
@@ -313,6 +458,11 @@ if __name__ == "__main__":
             parser.add_argument( '-b', dest = 'band', metavar = 'Frequency Band', nargs = 1, default = None, help = 'Frequency band of observation.' )
             parser.add_argument( '-o', dest = 'outputfile', metavar = 'Output File', nargs = 1, default = None, help = 'Name of the output file and path.' )
             parser.add_argument( '-d', dest = 'directories', metavar = 'Directories List', nargs = '*', default = None, help = 'Directories to search for PSRFITS files in.' )
+            parser.add_argument( '-a', dest = 'align', action = 'store_true', default = False, help = 'Phase align each file against the template before adding it.' )
+            parser.add_argument( '-i', dest = 'iterations', nargs = 1, type = int, default = [1], help = 'Number of alignment passes.' )
+            parser.add_argument( '-p', dest = 'portrait', action = 'store_true', default = False, help = 'Also create a frequency resolved (nchan x nbin) portrait template.' )
+            parser.add_argument( '-c', dest = 'nchan', nargs = 1, type = int, default = [None], help = 'Number of channels in the portrait template.' )
+            parser.add_argument( '-r', dest = 'reader', action = 'store_true', default = False, help = 'Read the summed profiles straight from the SUBINT tables instead of loading each archive.' )
             parser.add_argument( '-v', dest = 'verbose', action = 'store_true', default = False, help = 'Prints information to the console.' )
 
             args = parser.parse_args()
@@ -334,7 +484,7 @@ if __name__ == "__main__":
 
             # Initialize the template class object as normal and run the template creation script
             templateObject = Template( args.band[0], *idirs )
-            templateObject.createTemplate( ofile, odir, args.verbose )
+            templateObject.createTemplate( ofile, odir, args.verbose, args.align, args.iterations[0], args.portrait, args.nchan[0], args.reader )
 
 
     # Run the main function
@@ -3,14 +3,21 @@
 
 # Local imports
 from DataCulling import DataCull
+from PSRCache import ProfileCache
+from PSRToas import TOAStore
+from PSRJournal import RunJournal
 from custom_exceptions import *
 import utils.otherUtilities as u
+import utils.timingUtils as tu
+import utils.schedulerUtils as sch
 
 # Other imports
 import os
 import sys
+import hashlib
+import traceback
+import numpy as np
 from astropy.io import fits
-import magic
 
 
 # Timing class
@@ -21,17 +28,33 @@ class Timing:
     TEMPO2 format, and creating fake TOAs for prediction models based on user defined criteria.
     '''
 
-    def __init__( self, template, input, band, nsubint, nsubfreq, jump = None, saveDirectory = None, toaFile = None, verbose = False, RFI = None ):
+    def __init__( self, template, input, band, nsubint, nsubfreq, jump = None, saveDirectory = None, toaFile = None, verbose = False, RFI = None, cache = None, fromCache = False, engine = 'pypulse', store = None, prefetch = 0, memory = None, journal = None, retry = False ):
 
         '''
         Initializes an instance of the class with a required template and a directory or file (collectively known as 'input') to time
         as well as the frequency band as a string, number of time sub-integrations to scrunch to, user defined strings (jump) at the end of
         the TOAs, a directory to save the timing file to and the filename of that file. The jump and save locations are optional. If no save
         directory is parsed, CWD will be used. Finally, one can set the verbose and RFI excision flags.
+        If a cache directory is given, the scrunched profiles of each file are stored there. If fromCache is also set, the input is
+        re-timed from the cache instead of the archives (files with no valid cache entry are skipped).
+        The engine can either be 'pypulse', which times each archive with PyPulse Archive.time, or 'native', which collects the
+        scrunched profiles of every file and times them all at once against the template FFT (per channel if the template is a portrait).
+        If a TOA store directory is given, the native engine also writes its TOAs there as binary columns, tagged with a hash of the
+        timing settings.
+        When timing a directory or list of files, prefetch sets how many of the next archives are read on background threads while the current one is
+        culled and timed, limited to a memory budget in MB if one is given.
+        If a run journal file is given, a directory (or list of files) run can be resumed where it stopped and files that fail are quarantined (see RunJournal).
+        If retry is set, files quarantined by an earlier run are tried again.
+        The input can also be a list of files (see otherUtilities.resolveInputs), which are all timed in this one run, in order.
         '''
 
         # Initialize all parsed parameters as strings. Check for validity of nsubint (in case argparse doesn't)
-        self.directory = str( input )
+        if isinstance( input, ( list, tuple ) ):
+            self.files = [ str( file ) for file in input ]
+            self.directory = ""
+        else:
+            self.files = None
+            self.directory = str( input )
 
         self.verbose = verbose
 
@@ -69,8 +92,53 @@ class Timing:
         self.nsubint = nsubint
         self.nsubfreq = nsubfreq
 
+        # Initialize the profile cache if one has been provided
+        if cache is not None:
+            self.cache = ProfileCache( cache, verbose = self.verbose )
+        elif fromCache:
+            raise ValueError( "A cache directory is required to time from the cache." )
+        else:
+            self.cache = None
+
+        self.fromCache = fromCache
+
+        # Check which TOA engine to use. The native engine only needs the template FFT, calculated once here.
+        if engine not in [ 'pypulse', 'native' ]:
+            raise ValueError( "Allowed TOA engines are either 'pypulse' or 'native'. (Engine provided: {})".format( engine ) )
+
+        self.engine = engine
+        self.records = []
+
+        if self.engine == 'native':
+            self.templateFFT = self._loadTemplateFFT()
+
+        # Initialize the TOA store if one has been provided. Only the native engine has the TOAs as columns.
+        if store is not None and self.engine != 'native':
+            raise ValueError( "The TOA store can only be written by the native TOA engine." )
+        elif store is not None:
+            self.store = TOAStore( store, verbose = self.verbose )
+        else:
+            self.store = None
+
+        self.settings = self._settingsHash()
+
+        # Prefetch depth and memory budget (MB) for reading archives ahead
+        self.prefetch = int( prefetch )
+        self.memory = memory
+
+        # Run journal for checkpointing and quarantining files
+        self.journal = RunJournal( journal, retry, verbose = self.verbose ) if journal is not None else None
+
         # Determine which version of getTOAs is needed (likely to change)
-        if os.path.isdir( self.directory ):
+        if fromCache and self.files is not None:
+            self.getTOAs_cache( self.files )
+        elif self.files is not None:
+            self.getTOAs_files( self.files, save = self.savePath, exciseRFI = RFI )
+        elif fromCache and os.path.isdir( self.directory ):
+            self.getTOAs_cache( [ self.directory + file for file in os.listdir( self.directory ) ] )
+        elif fromCache and os.path.isfile( self.directory ):
+            self.getTOAs_cache( [ self.directory ] )
+        elif os.path.isdir( self.directory ):
             self.getTOAs_dir( save = self.savePath, exciseRFI = RFI )
         elif os.path.isfile( self.directory ):
             self.getTOAs_file( exciseRFI = RFI )
@@ -80,12 +148,131 @@ class Timing:
 
 
     def __repr__( self ):
-        return "Timing( template = {}, file / directory = {}, frequencyBand = {}, nsubint = {}, nsubfreq = {}, jump = {}, saveDirectory = {}, toaFile = {}, verbose = {}, RFI = {} )".format( self.template, self.directory, self.band, self.nsubint, self.nsubfreq, self.jump, self.saveDirectory. self.toaFile, self.verbose, self.rfi )
+        return "Timing( template = {}, file / directory = {}, frequencyBand = {}, nsubint = {}, nsubfreq = {}, jump = {}, saveDirectory = {}, toaFile = {}, verbose = {}, RFI = {}, cache = {}, fromCache = {}, engine = {}, store = {} )".format( self.template, self.directory, self.band, self.nsubint, self.nsubfreq, self.jump, self.saveDirectory, self.toaFile, self.verbose, self.rfi, self.cache, self.fromCache, self.engine, self.store )
 
     def __str__( self ):
         return self.template, self.directory, self.band, self.nsubint, self.nsubfreq, self.jump, self.saveDirectory, self.toaFile, self.verbose, self.rfi
 
 
+    def _settingsHash( self ):
+
+        '''
+        Returns a short hash of the settings that change the TOAs (template, scrunch factors, RFI excision,
+        jump and engine) so TOAs made with different settings can be told apart in the TOA store.
+        '''
+
+        settings = "{}|{}|{}|{}|{}|{}".format( os.path.abspath( self.template ), self.nsubint, self.nsubfreq, self.rfi, self.jump, self.engine )
+
+        return hashlib.sha1( settings.encode() ).hexdigest()[:16]
+
+
+    def _loadTemplate( self ):
+
+        '''
+        Loads the template in the same way DataCull does. Returns the 1D profile and,
+        for portrait templates, the per-channel FFTs (otherwise None).
+        '''
+
+        template = np.load( u.addExtension( self.template, 'npy' ) )
+
+        if isinstance( template, np.lib.npyio.NpzFile ):
+            with template:
+                return template['profile'], template['portraitFFT']
+
+        return template, None
+
+
+    def _loadTemplateFFT( self ):
+
+        '''
+        Returns the template FFT used by the native TOA engine. Portrait templates
+        give their stored per-channel FFTs, 1D templates are transformed here.
+        '''
+
+        profile, portraitFFT = self._loadTemplate()
+
+        if portraitFFT is not None:
+            return portraitFFT
+
+        return np.fft.rfft( profile )
+
+
+    def _scrunchAndTime( self, cullObject, save, exciseRFI = None ):
+
+        '''
+        Scrunches a culled archive to nsubint sub-integrations and nsubfreq channels and gets its TOAs.
+        The native engine scrunches the data cube with the rejection weights (see DataCull.scrunch), skipping
+        fully zapped blocks, and keeps the record to time in bulk later. PyPulse scrunches the archive itself
+        and writes its TOAs straight away.
+        The scrunched profiles are stored in the profile cache (if any) so the file can be re-timed later.
+        '''
+
+        if self.engine == 'native':
+            record = cullObject.scrunch( self.nsubint, self.nsubfreq )
+            if self.cache is not None:
+                self.cache.storeRecord( record, self.nsubint, self.nsubfreq, exciseRFI )
+            self.records.append( record )
+            return
+
+        # Scrunch factors. For TOAs, nchan should be 1 and nsubint is defined in class initialization
+        cullObject.ar.tscrunch( nsubint = self.nsubint )
+        cullObject.ar.fscrunch( nchan = self.nsubfreq )
+
+        if self.cache is not None:
+            self.cache.store( cullObject.ar, self.nsubint, self.nsubfreq, exciseRFI )
+
+        cullObject.ar.time( cullObject.template, filename = save, MJD = True, flags = self.jump, appendto = True )
+
+
+    def _timeRecords( self, save ):
+
+        '''
+        Times every record collected by the native engine in one batch and writes the TOAs,
+        to the TOA store as well if there is one.
+        '''
+
+        if self.records:
+            if self.verbose:
+                print( "Timing {} files...".format( len( self.records ) ) )
+
+            columns = tu.timeRecordColumns( self.records, self.templateFFT, flags = self.jump, settings = self.settings )
+            tu.writeTOAs( tu.tempo2Lines( columns ), save, appendto = True )
+
+            if self.store is not None:
+                self.store.append( columns )
+
+        self.records = []
+
+
+    def _loadArchive( self, file ):
+
+        '''
+        Loads a file in the same way DataCull does. Used to read archives ahead on background threads.
+        '''
+
+        from pypulse.archive import Archive
+
+        return Archive( file, verbose = False )
+
+
+    def _prefetchFiles( self, files ):
+
+        '''
+        Returns the files that will be culled and timed (PSR files with the right frontend), in order.
+        '''
+
+        prefetchFiles = []
+        for file in files:
+            try:
+                header = fits.getheader( file, 0 )
+            except OSError:
+                continue
+            if header.get( 'OBS_MODE' ) == 'PSR' and header.get( 'FRONTEND' ) == self.band:
+                prefetchFiles.append( file )
+
+        return prefetchFiles
+
+
     def getTOAs_dir( self, save = None, exciseRFI = None ):
 
         '''
@@ -93,97 +280,141 @@ class Timing:
         Each file can be chosen to undergo RFI excision before TOA calculation.
         '''
 
+        self.getTOAs_files( [ self.directory + file for file in os.listdir( self.directory ) ], save = save, exciseRFI = exciseRFI )
+
+
+    def getTOAs_files( self, files, save = None, exciseRFI = None ):
+
+        '''
+        Calculate and return Times-of-Arrival (TOAs) for a list of files, in order.
+        Each file can be chosen to undergo RFI excision before TOA calculation.
+        If prefetching is on, the next archives to time are read on background
+        threads while the current one is culled and timed.
+        With a run journal, files it has recorded are skipped, each file is
+        checkpointed once its TOAs are written and files that raise an error
+        are quarantined instead of stopping the run.
+        '''
+
         if not self.verbose:
             sys.stdout.write( '\n {0:<7s}  {1:<7s}\n'.format( 'Files', '% done' ) )
 
-        # Cycle through each file in the stored directory
-        for i, file in enumerate( os.listdir( self.directory ) ):
+        # Skip the files an earlier run got through
+        if self.journal is not None:
+            files = [ file for file in files if not self.journal.skip( file, self.settings ) ]
 
-            # Set the file to be a global variable in the class for use elsewhere
-            self.file = file
+        # Start reading the archives to time ahead of the loop
+        prefetchFiles = self._prefetchFiles( files ) if self.prefetch > 0 else []
+        budget = self.memory * 1024**2 if self.memory is not None else None
+        archives = sch.prefetch( self._loadArchive, prefetchFiles, self.prefetch, budget, sch.archiveFootprint )
+        prefetchFiles = set( prefetchFiles )
 
-            # Get the ASCII signature of the file header
-            with magic.Magic() as m:
-                format = m.id_filename( self.directory + self.file )
+        # Cycle through each file
+        for i, file in enumerate( files ):
 
-            # Check whether the file is a fits file using the header signature
-            if format.find( "FITS image data, 8-bit, character or unsigned binary integer" ) == 0:
+            # Set the file (and its directory) to be a global variable in the class for use elsewhere
+            self.directory, self.file = os.path.join( os.path.dirname( file ), "" ), os.path.basename( file )
 
-                # Open the fits file header
-                try:
-                    hdul = fits.open( self.directory + self.file )
-                except OSError:
-                    print( "File {} did not match ASCII signature required for a fits file".format( self.file ) )
-                    u.display_status( i, len( os.listdir( self.directory ) ) )
-                    continue
+            try:
+                self._timeDirectoryFile( save, exciseRFI, archives, prefetchFiles )
+            except Exception:
+                if self.journal is None:
+                    raise
+                self.records = []
+                self.journal.fail( self.directory + self.file, traceback.format_exc(), self.settings )
+            else:
+                # Checkpoint the file once its TOAs are written
+                if self.journal is not None:
+                    ntoa = len( self.records )
+                    self._timeRecords( save )
+                    self.journal.complete( self.directory + self.file, self.settings, save, ntoa if self.engine == 'native' else None )
 
-                # Check if the OBS_MODE is PSR and if not, skip it
-                if hdul[0].header[ 'OBS_MODE' ] == 'PSR':
+            u.display_status( i, len( files ) )
 
-                    # Get the frequency band used in the observation.
-                    try:
-                        frontend = hdul[0].header[ 'FRONTEND' ]
-                    except OSError:
-                        print( "Could not find any frontend information in file {}".format( self.file ) )
-                        u.display_status( i, len( os.listdir( self.directory ) ) )
-                        continue
+        # Stop reading ahead and time everything the native engine has collected
+        archives.close()
+        self._timeRecords( save )
 
-                    # Close the header once it's been used or the program becomes very slow.
-                    hdul.close()
 
-                    # Create an object of the DataCull type
-                    cullObject = DataCull( self.file, self.template, self.directory, verbose = self.verbose )
+    def _timeDirectoryFile( self, save, exciseRFI, archives, prefetchFiles ):
 
-                    if cullObject.SNError:
-                        continue
+        '''
+        Culls, scrunches and times the current file (self.directory + self.file),
+        taking its archive from the prefetcher if it has been read ahead.
+        '''
 
-                    # Check if the band provided matches that in the header
-                    if frontend == self.band:
+        # Get the ASCII signature of the file header
+        import magic
+        with magic.Magic() as m:
+            format = m.id_filename( self.directory + self.file )
 
-                        # If enabled, perform a standard RFI cull
-                        if exciseRFI is not None and isinstance( exciseRFI, int ):
-                            cullObject.reject( 'chauvenet', self.rfi, self.verbose )
+        # If the binary signature doesn't match that of a fits file, skip completely
+        if format.find( "FITS image data, 8-bit, character or unsigned binary integer" ) != 0:
+            if self.verbose:
+                print( "{} is not a fits file...".format( self.file ) )
+            return
 
-                        # Scrunch factors. For TOAs, nchan should be 1 and nsubint is defined in class initialization
-                        cullObject.ar.tscrunch( nsubint = self.nsubint )
-                        cullObject.ar.fscrunch( nchan = self.nsubfreq )
+        # Open the fits file header
+        try:
+            hdul = fits.open( self.directory + self.file )
+        except OSError:
+            print( "File {} did not match ASCII signature required for a fits file".format( self.file ) )
+            return
 
-                        # Function to return the TOAs
-                        cullObject.ar.time( cullObject.template, filename = save, MJD = True, flags = self.jump, appendto = True )
+        # Check if the OBS_MODE is PSR and if not, skip it
+        if hdul[0].header[ 'OBS_MODE' ] == 'PSR':
 
+            # Get the frequency band used in the observation.
+            try:
+                frontend = hdul[0].header[ 'FRONTEND' ]
+            except OSError:
+                print( "Could not find any frontend information in file {}".format( self.file ) )
+                return
 
-                    else:
-                        if self.verbose:
-                            print( "Frontend provided for {} does not match frontend in fits file ( Input: {}, Expected: {} )".format( self.file, self.band, frontend ) )
-                        else:
-                            u.display_status( i, len( os.listdir( self.directory ) ) )
-                            continue
-
-                # Potential custom handling when OBS_MODE is CAL or SEARCH
-                elif hdul[0].header[ 'OBS_MODE' ] == 'CAL':
-                    if self.verbose:
-                        print( "Skipping calibration file..." )
-                    hdul.close()
+            # Close the header once it's been used or the program becomes very slow.
+            hdul.close()
 
-                elif hdul[0].header[ 'OBS_MODE' ] == 'SEARCH':
-                    if self.verbose:
-                        print( "Skipping search file..." )
-                    hdul.close()
+            # Check if the band provided matches that in the header
+            if frontend != self.band:
+                if self.verbose:
+                    print( "Frontend provided for {} does not match frontend in fits file ( Input: {}, Expected: {} )".format( self.file, self.band, frontend ) )
+                return
 
-                # If none of the options are present, raise OSError
-                else:
-                    hdul.close()
-                    raise OSError( "OBS_MODE found in file does not match known file types. ( Expected: PSR, CAL, SEARCH. Found: {} )".format( hdul[0].header[ 'OBS_MODE' ] ) )
+            # Take the archive from the prefetcher if it has been read ahead (files it skipped are dropped)
+            archive = None
+            if self.directory + self.file in prefetchFiles:
+                for loaded, loadedArchive in archives:
+                    if loaded == self.directory + self.file:
+                        archive = loadedArchive
+                        break
 
-            # If the binary signature doesn't match that of a fits file, skip completely
-            else:
-                if self.verbose:
-                    print( "{} is not a fits file...".format( self.file ) )
-                else:
-                    u.display_status( i, len( os.listdir( self.directory ) ) )
-                    continue
+            # Create an object of the DataCull type
+            cullObject = DataCull( self.file, self.template, self.directory, verbose = self.verbose, archive = archive )
+
+            if cullObject.SNError:
+                return
+
+            # If enabled, perform a standard RFI cull
+            if exciseRFI is not None and isinstance( exciseRFI, int ):
+                cullObject.reject( 'chauvenet', self.rfi, self.verbose )
+
+            # Scrunch and get the TOAs
+            self._scrunchAndTime( cullObject, save, exciseRFI )
+
+        # Potential custom handling when OBS_MODE is CAL or SEARCH
+        elif hdul[0].header[ 'OBS_MODE' ] == 'CAL':
+            if self.verbose:
+                print( "Skipping calibration file..." )
+            hdul.close()
+
+        elif hdul[0].header[ 'OBS_MODE' ] == 'SEARCH':
+            if self.verbose:
+                print( "Skipping search file..." )
+            hdul.close()
 
-            u.display_status( i, len( os.listdir( self.directory ) ) )
+        # If none of the options are present, raise OSError
+        else:
+            hdul.close()
+            raise OSError( "OBS_MODE found in file does not match known file types. ( Expected: PSR, CAL, SEARCH. Found: {} )".format( hdul[0].header[ 'OBS_MODE' ] ) )
 
 
     def getTOAs_file( self, save = None, exciseRFI = None ):
@@ -200,6 +431,7 @@ class Timing:
         self.directory = self.directory + "/"
 
         # Get the ASCII signature of the file header
+        import magic
         with magic.Magic() as m:
             format = m.id_filename( self.directory + self.file )
 
@@ -239,12 +471,8 @@ class Timing:
                     if exciseRFI is not None and isinstance( exciseRFI, int ):
                         cullObject.reject( 'chauvenet', self.rfi, self.verbose )
 
-                    # Scrunch factors. For TOAs, nchan should be 1 and nsubint is defined in class initialization
-                    cullObject.ar.tscrunch( nsubint = self.nsubint )
-                    cullObject.ar.fscrunch( nchan = self.nsubfreq )
-
-                    # Function to return TOAs
-                    cullObject.ar.time( cullObject.template, filename = self.savePath, MJD = True, flags = self.jump, appendto = True )
+                    # Scrunch and get the TOAs
+                    self._scrunchAndTime( cullObject, self.savePath, exciseRFI )
 
 
                 else:
@@ -275,3 +503,42 @@ class Timing:
                 print( "{} is not a fits file...".format( self.file ) )
             else:
                 pass
+
+        # Time the file if the native engine has collected it
+        self._timeRecords( self.savePath )
+
+
+    def getTOAs_cache( self, files ):
+
+        '''
+        Calculate Times-of-Arrival (TOAs) for the given files from their cached scrunched profiles.
+        Only the small cached arrays are read so no archive is loaded, culled or scrunched again.
+        Files without a valid cache entry for the current settings are skipped.
+        '''
+
+        # Load the template in the same way DataCull does
+        template = self._loadTemplate()[0]
+
+        if not self.verbose:
+            sys.stdout.write( '\n {0:<7s}  {1:<7s}\n'.format( 'Files', '% done' ) )
+
+        for i, file in enumerate( files ):
+
+            record = self.cache.load( file, self.nsubint, self.nsubfreq, self.rfi )
+
+            if record is None:
+                if self.verbose:
+                    print( "No valid cache entry for {}...".format( file ) )
+            elif record['frontend'] != self.band:
+                if self.verbose:
+                    print( "Frontend provided for {} does not match frontend in cache ( Input: {}, Expected: {} )".format( file, self.band, record['frontend'] ) )
+            elif self.engine == 'native':
+                self.records.append( record )
+            else:
+                self.cache.time( record, template, self.savePath, flags = self.jump, appendto = True )
+
+            if not self.verbose:
+                u.display_status( i, len( files ) )
+
+        # Time everything the native engine has collected
+        self._timeRecords( self.savePath )
@@ -0,0 +1,214 @@
+# Columnar TOA store class, Python 3
+
+# Local imports
+import utils.timingUtils as tu
+
+# Other imports
+import os
+import time
+import shlex
+import numpy as np
+
+
+# Columnar TOA store class
+class TOAStore:
+
+    '''
+    Class for a binary, columnar store of TOAs. Each TOA keeps its MJD as an
+    integer day and a float64 day fraction, its error in microseconds, the
+    observing frequency, site, frontend, flags, source file and the hash of the
+    settings it was made with (see timingUtils.TOA_COLUMNS for all columns).
+    The store is a directory of .npz segments, one per call to append, so
+    several runs can add to it without rewriting it. On loading, the segments
+    are concatenated and indexed so TOAs can be selected by band, MJD range,
+    jump/flags, source file or settings without parsing any text, and any
+    selection can be exported as TEMPO2 text.
+    '''
+
+    def __init__( self, directory, verbose = False ):
+
+        '''
+        Initializes the store in the directory given, creating it if necessary,
+        and loads any segments already in it.
+        '''
+
+        self.directory = str( directory )
+        self.verbose = verbose
+
+        os.makedirs( self.directory, exist_ok = True )
+
+        self.reload()
+
+    def __repr__( self ):
+        return "TOAStore( directory = {}, verbose = {} )".format( self.directory, self.verbose )
+
+    def __str__( self ):
+        return self.directory
+
+    def __len__( self ):
+        return len( self.toas['imjd'] )
+
+
+    def reload( self ):
+
+        '''
+        Reads every segment in the store directory and rebuilds the indexes.
+        '''
+
+        segments = []
+        for file in sorted( os.listdir( self.directory ) ):
+            if file.startswith( "segment_" ) and file.endswith( ".npz" ):
+                with np.load( os.path.join( self.directory, file ) ) as segment:
+                    segments.append( { key: segment[key] for key, dtype in tu.TOA_COLUMNS } )
+
+        self.toas = tu.concatenateColumns( segments )
+        self._index()
+
+        if self.verbose:
+            print( "Loaded {} TOAs from {} segments...".format( len( self ), len( segments ) ) )
+
+
+    def _index( self ):
+
+        '''
+        Builds the indexes used by select: the row order sorted by MJD (for
+        range queries with searchsorted) and a dictionary of row numbers for each
+        value of the categorical columns.
+        '''
+
+        self._order = np.lexsort( ( self.toas['fmjd'], self.toas['imjd'] ) )
+        self._sortedMJD = self.toas['imjd'][self._order] + self.toas['fmjd'][self._order]
+
+        self._indexes = {}
+        for key in [ 'frontend', 'flags', 'filename', 'settings', 'site' ]:
+            values, inverse = np.unique( self.toas[key], return_inverse = True )
+            rows = np.argsort( inverse, kind = 'stable' )
+            bounds = np.cumsum( np.bincount( inverse, minlength = len( values ) ) )
+            self._indexes[key] = { value: rows[start:end] for value, start, end in zip( values, np.concatenate( ( [0], bounds[:-1] ) ), bounds ) }
+
+
+    def append( self, columns ):
+
+        '''
+        Adds TOA columns (see timingUtils.toaColumns) to the store as a new
+        segment. The segment is written to a temporary file and renamed so a
+        crash never leaves a partial segment behind.
+        '''
+
+        if len( columns['imjd'] ) == 0:
+            return
+
+        columns = { key: np.asarray( columns[key], dtype = dtype ) for key, dtype in tu.TOA_COLUMNS }
+
+        name = "segment_{}_{}".format( time.time_ns(), os.getpid() )
+        temporary = os.path.join( self.directory, "." + name + ".npz" )
+        np.savez( temporary, **columns )
+        os.replace( temporary, os.path.join( self.directory, name + ".npz" ) )
+
+        self.toas = tu.concatenateColumns( [ self.toas, columns ] )
+        self._index()
+
+        if self.verbose:
+            print( "Stored {} TOAs...".format( len( columns['imjd'] ) ) )
+
+
+    def select( self, band = None, mjdRange = None, jump = None, filename = None, settings = None, site = None ):
+
+        '''
+        Returns the row numbers (in MJD order) of the TOAs matching every
+        criterion given. band is the frontend, mjdRange is a (start, end) tuple
+        of MJDs (either can be None), jump is the exact flag string and
+        filename, settings and site are matched exactly.
+        '''
+
+        # The MJD range picks a slice of the sorted order
+        start, end = 0, len( self._order )
+        if mjdRange is not None:
+            low, high = mjdRange
+            if low is not None:
+                start = np.searchsorted( self._sortedMJD, low, side = 'left' )
+            if high is not None:
+                end = np.searchsorted( self._sortedMJD, high, side = 'right' )
+        rows = self._order[start:end]
+
+        # The categorical criteria intersect their index entries with the rows
+        for key, value in [ ( 'frontend', band ), ( 'flags', jump ), ( 'filename', filename ), ( 'settings', settings ), ( 'site', site ) ]:
+            if value is not None:
+                matches = self._indexes[key].get( str( value ), np.array( [], dtype = np.intp ) )
+                rows = rows[np.isin( rows, matches )]
+
+        return rows
+
+
+    def columns( self, rows = None ):
+
+        '''
+        Returns the TOA columns for the given row numbers (all rows if None).
+        '''
+
+        if rows is None:
+            return dict( self.toas )
+
+        return { key: column[rows] for key, column in self.toas.items() }
+
+
+    def export( self, filename, rows = None, appendto = False ):
+
+        '''
+        Writes the given rows (all rows, in MJD order, if None) to a TEMPO2 text
+        file in the same format as PyPulse Archive.time. Returns the lines.
+        '''
+
+        if rows is None:
+            rows = self._order
+
+        lines = tu.tempo2Lines( self.columns( rows ) )
+        tu.writeTOAs( lines, filename, appendto )
+
+        return lines
+
+
+    def importTempo2( self, filename, settings = "" ):
+
+        '''
+        Parses a TEMPO2 TOA file written by PyPulse Archive.time or by this
+        store and appends its TOAs. Flags that aren't part of the Archive.time
+        format are kept as the flag string. Returns the number of TOAs imported.
+        '''
+
+        named = { '-fe': 'frontend', '-be': 'backend', '-bw': 'bw', '-tobs': 'tobs', '-tmplt': 'template', '-nbin': 'nbin', '-nch': 'nchan',
+                  '-chan': 'chan', '-subint': 'subint', '-snr': 'snr', '-flux': 'flux', '-fluxerr': 'fluxerr' }
+
+        rows = []
+        with open( filename, 'r' ) as f:
+            for line in f:
+                fields = shlex.split( line )
+
+                # Skip headers, commands and comments
+                if len( fields ) < 5 or fields[0] in [ 'FORMAT', 'MODE', 'C', '#' ] or fields[0].startswith( '#' ):
+                    continue
+
+                day, _, fraction = fields[2].partition( '.' )
+                row = { 'filename': fields[0], 'frequency': float( fields[1] ), 'imjd': int( day ), 'fmjd': float( "0." + ( fraction or "0" ) ),
+                        'error': float( fields[3] ), 'site': fields[4], 'settings': settings }
+
+                extra = []
+                i = 5
+                while i < len( fields ):
+                    if fields[i] in named and i + 1 < len( fields ):
+                        row[named[fields[i]]] = fields[i + 1]
+                        i += 2
+                    else:
+                        extra.append( fields[i] )
+                        i += 1
+                row['flags'] = " ".join( extra )
+
+                rows.append( row )
+
+        defaults = { 'frontend': "", 'backend': "", 'bw': 0, 'tobs': 0, 'template': "None", 'nbin': 0, 'nchan': 0, 'chan': 0, 'subint': 0,
+                     'snr': 0, 'flux': 0, 'fluxerr': 0 }
+
+        columns = { key: np.array( [ row.get( key, defaults.get( key ) ) for row in rows ], dtype = dtype ) for key, dtype in tu.TOA_COLUMNS }
+        self.append( columns )
+
+        return len( rows )
@@ -0,0 +1,155 @@
+# Directory watcher class, Python 3
+
+# Imports
+import os
+import time
+
+
+# Directory watcher class
+class DirectoryWatcher:
+
+    '''
+    Class to watch directories for newly arriving files. inotify is used if the
+    inotify_simple package is installed; otherwise the directories are polled.
+    Files are only handed out once they are complete, i.e. once their size and
+    modification time have not changed for a settling time, so archives still
+    being written by the backend are never read. Each file is handed out once.
+    '''
+
+    def __init__( self, directories, settle = 2.0, interval = 1.0, existing = False, verbose = False ):
+
+        '''
+        Initializes the watcher on a list of directories with the number of
+        seconds a file must stay unchanged before it counts as complete and the
+        polling interval (also the longest time between checks with inotify).
+        Files already in the directories are skipped unless existing is set.
+        '''
+
+        self.directories = [ os.path.abspath( str( directory ) ) for directory in directories ]
+        self.settle = float( settle )
+        self.interval = float( interval )
+        self.verbose = verbose
+
+        for directory in self.directories:
+            if not os.path.isdir( directory ):
+                raise NotADirectoryError( "{} is not a directory...".format( directory ) )
+
+        # Pending files map to their last ( size, mtime ) and when that was first seen
+        self._pending = {}
+        self._done = set() if existing else self._scan()
+
+        # Default attempt to use inotify but switch to polling if not
+        try:
+            from inotify_simple import INotify, flags
+            self._inotify = INotify()
+            mask = flags.CREATE | flags.MODIFY | flags.CLOSE_WRITE | flags.MOVED_TO
+            self._watches = { self._inotify.add_watch( directory, mask ): directory for directory in self.directories }
+        except ( ImportError, OSError ):
+            self._inotify = None
+
+        if existing:
+            self._pending.update( { file: ( None, 0.0 ) for file in self._scan() } )
+
+        if self.verbose:
+            print( "Watching {} with {}...".format( ", ".join( self.directories ), "inotify" if self._inotify is not None else "polling" ) )
+
+    def __repr__( self ):
+        return "DirectoryWatcher( directories = {}, settle = {}, interval = {}, verbose = {} )".format( self.directories, self.settle, self.interval, self.verbose )
+
+    def __str__( self ):
+        return ", ".join( self.directories )
+
+
+    def _scan( self ):
+
+        '''
+        Returns the set of files in the watched directories.
+        '''
+
+        files = set()
+        for directory in self.directories:
+            with os.scandir( directory ) as entries:
+                files.update( entry.path for entry in entries if entry.is_file() )
+
+        return files
+
+
+    def _changed( self, timeout ):
+
+        '''
+        Waits up to timeout seconds and returns the files that may have changed.
+        '''
+
+        if self._inotify is None:
+            time.sleep( timeout )
+            return self._scan() - self._done
+
+        files = set()
+        for event in self._inotify.read( timeout = int( timeout * 1000 ) ):
+            if event.name and event.wd in self._watches:
+                files.add( os.path.join( self._watches[event.wd], event.name ) )
+
+        return files - self._done
+
+
+    def poll( self, timeout = None ):
+
+        '''
+        Waits up to timeout seconds (the polling interval by default) for changes
+        and returns the new files that have become complete, oldest first.
+        '''
+
+        if timeout is None:
+            timeout = self.interval
+
+        # Don't wait past the moment a pending file could settle
+        if self._pending:
+            timeout = min( timeout, self.settle )
+
+        for file in self._changed( timeout ):
+            self._pending.setdefault( file, ( None, 0.0 ) )
+
+        now = time.monotonic()
+        ready = []
+
+        for file, ( state, since ) in list( self._pending.items() ):
+
+            try:
+                stat = os.stat( file )
+            except FileNotFoundError:
+                del self._pending[file]
+                continue
+
+            current = ( stat.st_size, stat.st_mtime_ns )
+
+            if current != state:
+                self._pending[file] = ( current, now )
+            elif now - since >= self.settle:
+                del self._pending[file]
+                self._done.add( file )
+                ready.append( ( stat.st_mtime_ns, file ) )
+
+        return [ file for mtime, file in sorted( ready ) ]
+
+
+    def watch( self ):
+
+        '''
+        Yields lists of newly completed files as they arrive, forever.
+        '''
+
+        while True:
+            files = self.poll()
+            if files:
+                yield files
+
+
+    def close( self ):
+
+        '''
+        Stops watching.
+        '''
+
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
@@ -1,4 +1,4 @@
-__all__ = [ "main", "argumenthandler", "ArgumentHandler", "DataCulling", "DataCull", "PSRTemplate", "Template", "PSRTiming", "Timing", "mathUtils", "otherUtilities", "pulsarUtilities", "custom_exceptions", "ArgumentError", "DimensionError" ]
+__all__ = [ "main", "argumenthandler", "ArgumentHandler", "DataCulling", "DataCull", "PSRTemplate", "Template", "PSRTiming", "Timing", "PSRCache", "ProfileCache", "PSRToas", "TOAStore", "PSRCalibration", "CalibrationPlanner", "PSRPipeline", "Pipeline", "MultiBandPipeline", "PSRServer", "TimingServer", "PSRWatch", "DirectoryWatcher", "PSRJournal", "RunJournal", "PSRQueue", "WorkQueue", "PSRPlan", "WorkPlan", "PSRFits", "SubintReader", "mathUtils", "otherUtilities", "pulsarUtilities", "timingUtils", "calibrationUtils", "schedulerUtils", "custom_exceptions", "ArgumentError", "DimensionError" ]
 
 __version__ = 0.2
 
@@ -6,4 +6,14 @@ from argumenthandler import ArgumentHandler
 from DataCulling import DataCull
 from PSRTemplate import Template
 from PSRTiming import Timing
+from PSRCache import ProfileCache
+from PSRToas import TOAStore
+from PSRCalibration import CalibrationPlanner
+from PSRPipeline import Pipeline, MultiBandPipeline
+from PSRServer import TimingServer
+from PSRWatch import DirectoryWatcher
+from PSRJournal import RunJournal
+from PSRQueue import WorkQueue
+from PSRPlan import WorkPlan
+from PSRFits import SubintReader
 from custom_exceptions import *
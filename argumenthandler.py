@@ -3,7 +3,17 @@
 
 # Local imports
 from PSRTiming import Timing
+from PSRPipeline import Pipeline, MultiBandPipeline, loadBands
+from PSRCalibration import CalibrationPlanner
+from PSRWatch import DirectoryWatcher
+from PSRQueue import WorkQueue
+from PSRToas import TOAStore
+from PSRJournal import RunJournal
+from PSRPlan import WorkPlan, THROUGHPUT_FILE
 from custom_exceptions import *
+import utils.schedulerUtils as sch
+import utils.timingUtils as tu
+import utils.otherUtilities as u
 
 # Other imports
 import argparse
@@ -23,20 +33,40 @@ class ArgumentHandler:
         # Calls the  parser method in this class
         args = self.parser( progname )
 
-        # Checks argument requirements for non-optional flags (as a double check)
-        if ( not args.timingFlag ):
-            raise ArgumentError( "Timing argument (-t / --time) required." )
-        if ( not args.tempFlag ):
-            raise ArgumentError( "Template argument (--temp) not initialized." )
-        if ( not args.subintFlag ):
-            raise ArgumentError( "Sub-integration argument (-s / --subint) required." )
-        if ( not args.subfreqFlag ):
-            raise ArgumentError( "Sub-band argument (-n / --subfreq) required." )
+        # Workers take all of their settings from the queue
+        if args.workerFlag is not None:
+            self.worker( args )
+            return
+        elif args.requeueFlag is not None or args.collectFlag is not None:
+            self.manageQueue( args )
+            return
+
+        # Checks argument requirements for non-optional flags (as a double check). A band configuration replaces all four.
+        if args.bandsFlag is None:
+            if ( not args.timingFlag ):
+                raise ArgumentError( "Timing argument (-t / --time) required." )
+            if ( not args.tempFlag ):
+                raise ArgumentError( "Template argument (--temp) not initialized." )
+            if ( not args.subintFlag ):
+                raise ArgumentError( "Sub-integration argument (-s / --subint) required." )
+            if ( not args.subfreqFlag ):
+                raise ArgumentError( "Sub-band argument (-n / --subfreq) required." )
 
         # Basically, if the jumpFlag isn't set, initialize it as a NoneType 1x1 array
         if args.jumpFlag is None:
             args.jumpFlag = [ None ]
 
+        # The pipeline modes read each archive once and time it with the native engine, so the Timing class options don't apply to them
+        pipelineModes = [ flag for flag, value in ( ( "-b / --bands", args.bandsFlag ), ( "--cal", args.calFlag ), ( "-w / --watch", args.watchFlag ), ( "--queue", args.queueFlag ) ) if value is not None ]
+        if pipelineModes:
+            ignored = [ flag for flag, given in ( ( "-e pypulse", args.engineFlag == 'pypulse' ), ( "-c / --cache", args.cacheFlag is not None ),
+                                                  ( "--from-cache", args.fromCacheFlag ), ( "--prefetch", args.prefetchFlag != 0 ) ) if given ]
+            if ignored:
+                raise ArgumentError( "{} can't be used with {}, which always times with the native engine and reads each archive once.".format( ", ".join( ignored ), pipelineModes[0] ) )
+
+        if args.engineFlag is None:
+            args.engineFlag = 'pypulse'
+
         # Changes type of the rejection flag to an integer if it exists
         if args.rejectionFlag is not None:
             args.rejectionFlag = args.rejectionFlag[0]
@@ -44,31 +74,29 @@ class ArgumentHandler:
         # textFile is optional. If no -x flag is provided, uses CWD
         if ( not args.textFile ):
 
-             directory_in_str = str( os.getcwd() )
-
-             for file in os.listdir( directory_in_str ):
-                self.timing( file, args.timingFlag[0], args.tempFlag[0], args.subintFlag[0], args.subfreqFlag[0], args.jumpFlag[0], args.outputDirFlag, args.outputFlag, args.verbose, args.rejectionFlag )
-
+            inputs = sorted( os.listdir( str( os.getcwd() ) ) )
 
         else:
 
-            # If -x has been provided:
+            # If -x has been provided, read the directories / files in each text file line by line
+            inputs = []
             for argument in args.textFile:
-
-                    # Opens and separates the file into its lines
-                    currentFile = open( argument, "r" )
-                    loadedFile = currentFile.readlines()
-
-                    # Read the lines in the file one by one
-                    for line in loadedFile:
-
-                        # Removes the 'new line' character introduced via readlines()
-                        line = line.replace( "\n", "" )
-
-                        # Calculates the TOAs
-                        self.timing( line, args.timingFlag[0], args.tempFlag[0], args.subintFlag[0], args.subfreqFlag[0], args.jumpFlag[0], args.outputDirFlag, args.outputFlag, args.verbose, args.rejectionFlag )
-
-                    currentFile.close()
+                with open( argument, "r" ) as currentFile:
+                    inputs.extend( [ line.strip() for line in currentFile.readlines() if line.strip() ] )
+
+        # Calculates the TOAs
+        if args.planFlag is not None:
+            self.plan( inputs, args )
+        elif args.queueFlag is not None:
+            self.queue( inputs, args )
+        elif args.watchFlag is not None:
+            self.watch( inputs, args )
+        elif args.calFlag is not None or args.bandsFlag is not None:
+            self.pipeline( inputs, args )
+        elif args.processesFlag == 1:
+            self.timing( self._files( inputs, args ), args.timingFlag[0], args.tempFlag[0], args.subintFlag[0], args.subfreqFlag[0], args.jumpFlag[0], args.outputDirFlag, args.outputFlag, args.verbose, args.rejectionFlag, args.cacheFlag, args.fromCacheFlag, args.engineFlag, args.storeFlag, args.prefetchFlag, args.memoryFlag, args.journalFlag, args.retryFlag )
+        else:
+            self.parallelTiming( inputs, args )
 
 
     def __repr__( self ):
@@ -97,14 +125,34 @@ class ArgumentHandler:
 
         # Arguments list
         parser.add_argument( '-x', '--file', dest = 'textFile', nargs = '*', default = None, help = 'Text file flag. Optional. Accepts as many txt files as necessary. Files can contain a mixture of directories and filenames.' )
-        parser.add_argument( '-t', '--time', dest = 'timingFlag', nargs = 1, default = False, required = True, help = 'Timing flag. Required. Argument after flag takes the frequency band (to be improved).' )
-        parser.add_argument( '--temp', dest = 'tempFlag', nargs = 1, required = True, help = 'Template flag. Required. Argument after flag takes the full path for the template profile.' )
-        parser.add_argument( '-s', '--subint', dest = 'subintFlag', nargs = 1, type = int, required = True, help = 'Sub-integration scrunch flag. Required. Argument after flag takes an integer greater than 0.' )
-        parser.add_argument( '-n', '--subfreq', dest = 'subfreqFlag', nargs = 1, type = int, required = True, help = 'Sub-band scrunch flag. Required. Argument after flag takes an integer greater than 0.' )
+        parser.add_argument( '-i', '--include', dest = 'includeFlag', nargs = '*', default = None, help = 'Include flag. Optional. Argument takes glob patterns (e.g. *.fits); only files whose name or path matches one of them are timed.' )
+        parser.add_argument( '--exclude', dest = 'excludeFlag', nargs = '*', default = None, help = 'Exclude flag. Optional. Argument takes glob patterns; files whose name or path matches any of them are skipped.' )
+        parser.add_argument( '-t', '--time', dest = 'timingFlag', nargs = 1, default = False, help = 'Timing flag. Required (unless -b is used). Argument after flag takes the frequency band (to be improved).' )
+        parser.add_argument( '--temp', dest = 'tempFlag', nargs = 1, default = None, help = 'Template flag. Required (unless -b is used). Argument after flag takes the full path for the template profile.' )
+        parser.add_argument( '-s', '--subint', dest = 'subintFlag', nargs = 1, type = int, default = None, help = 'Sub-integration scrunch flag. Required (unless -b is used). Argument after flag takes an integer greater than 0.' )
+        parser.add_argument( '-n', '--subfreq', dest = 'subfreqFlag', nargs = 1, type = int, default = None, help = 'Sub-band scrunch flag. Required (unless -b is used). Argument after flag takes an integer greater than 0.' )
+        parser.add_argument( '-b', '--bands', dest = 'bandsFlag', default = None, help = 'Band configuration flag. Optional. Argument takes a file mapping each frontend to its template, scrunch factors and jump flags. Files of every frontend are timed in one pass through the pipeline, with one TOA file per frontend. Replaces -t, --temp, -s, -n and -j.' )
         parser.add_argument( '-j', '--jump', dest = 'jumpFlag', nargs = '*', default = None, help = 'Jump flag. Optional. Argument takes a string that should correspond to a jump (or other) flag needed on the end of the TOAs.' )
         parser.add_argument( '-od', '--odir', dest = 'outputDirFlag', nargs = '?', default = None, help = 'TOA output directory. Optional. Argument takes a directory to save the TOA file to.' )
         parser.add_argument( '-o', '--output', dest = 'outputFlag', nargs = '?', default = None, help = 'TOA output filename. Optional. Argument takes the filename to save the TOAs to. Without, a default name is used.' )
         parser.add_argument( '-r', '--reject', dest = 'rejectionFlag', nargs = 1, type = int, required = False, default = None, help = 'RFI excision flag. Use flag when you would like to pre-TOA excise sources of RFI.' )
+        parser.add_argument( '-c', '--cache', dest = 'cacheFlag', nargs = '?', default = None, help = 'Profile cache directory. Optional. Argument takes a directory to store the scrunched profiles of each file in for fast re-timing.' )
+        parser.add_argument( '--from-cache', dest = 'fromCacheFlag', action = 'store_true', default = False, help = 'Re-time from the profile cache. Use with -c to re-time previously cached files against a new template or jump without reloading the archives.' )
+        parser.add_argument( '-e', '--engine', dest = 'engineFlag', default = None, choices = [ 'pypulse', 'native' ], help = 'TOA engine. Optional. Either pypulse (default, times each archive with PyPulse) or native (times the scrunched profiles of every file in one batch against the template FFT).' )
+        parser.add_argument( '--store', dest = 'storeFlag', default = None, help = 'TOA store directory. Optional. Argument takes a directory to also write the TOAs to as binary columns (native engine only).' )
+        parser.add_argument( '-p', '--processes', dest = 'processesFlag', type = int, default = 1, help = 'Number of worker processes. Optional. Inputs (or files, with --cal) are processed in parallel and their TOAs merged in input order. 0 uses one process per CPU.' )
+        parser.add_argument( '--cal', dest = 'calFlag', nargs = '*', default = None, help = 'Pipeline flag. Optional. Flux calibrates, zaps, scrunches and times each file in a single pass. Argument takes the directories / files to find CAL files in (the inputs themselves if none are given).' )
+        parser.add_argument( '--prefetch', dest = 'prefetchFlag', type = int, default = 0, help = 'Prefetch flag. Optional. Argument takes how many of the next archives in a directory to read on background threads while the current one is culled and timed (default 0, off).' )
+        parser.add_argument( '--memory', dest = 'memoryFlag', type = float, default = None, help = 'Memory budget in MB. Optional. Worker processes (-p) only start files while their estimated footprints fit in the budget, and archives read ahead by --prefetch share what is left to each process.' )
+        parser.add_argument( '--journal', dest = 'journalFlag', default = None, help = 'Run journal file. Optional. Argument takes a file to record the outcome of every file in, so an interrupted run given the same journal resumes where it stopped. Files that fail are quarantined there with their traceback instead of stopping the run.' )
+        parser.add_argument( '--retry', dest = 'retryFlag', action = 'store_true', default = False, help = 'Retry flag. Optional. With --journal, files quarantined by an earlier run are tried again.' )
+        parser.add_argument( '-w', '--watch', dest = 'watchFlag', nargs = '?', type = float, const = 2.0, default = None, help = 'Watch flag. Optional. Watches the input directories and times each new file through the pipeline as soon as it is complete. Argument takes the seconds a file must stay unchanged to count as complete (default 2).' )
+        parser.add_argument( '--queue', dest = 'queueFlag', default = None, help = 'Queue flag. Optional. Argument takes a directory on shared storage to write a work item for every input file to, with the timing settings, instead of timing them. Files are then timed by any number of --worker processes.' )
+        parser.add_argument( '--worker', dest = 'workerFlag', default = None, help = 'Worker flag. Optional. Argument takes a queue directory made with --queue. Claims and times its files through the pipeline until none are left. All other settings come from the queue.' )
+        parser.add_argument( '--timeout', dest = 'timeoutFlag', type = float, default = None, help = 'Queue timeout flag. Optional. Argument takes the seconds after which a claimed item counts as abandoned (its worker died). With --worker, abandoned items are requeued and timed before the worker stops. With --requeue, only items claimed longer ago than this are requeued (default 0, every claimed item).' )
+        parser.add_argument( '--requeue', dest = 'requeueFlag', default = None, help = 'Requeue flag. Optional. Argument takes a queue directory. Puts its claimed items back in the queue (see --timeout) for workers to time again.' )
+        parser.add_argument( '--collect', dest = 'collectFlag', default = None, help = 'Collect flag. Optional. Argument takes a queue directory. Collects the TOAs of its done items into the output file, even if some items are unfinished.' )
+        parser.add_argument( '--plan', dest = 'planFlag', nargs = '?', const = THROUGHPUT_FILE, default = None, help = 'Plan flag. Optional. Reports the data volume, profiles, rejection fits and TOAs of every file and an estimated runtime from the headers alone, without timing anything. Argument takes the throughput file to estimate with (default: the one saved by testing/throughput_benchmark.py).' )
         parser.add_argument( '-v', '--verbose', dest = 'verbose', action = 'store_true', default = False, help = 'Verbose mode flag. Set this to print more information to the console (for developers).' )
 
 
@@ -113,10 +161,243 @@ class ArgumentHandler:
         return args
 
 
-    def timing( self, input, band, temp, nsubint, nsubfreq, jump, saveDir, saveFile, verbose, exciseRFI ):
+    def timing( self, input, band, temp, nsubint, nsubfreq, jump, saveDir, saveFile, verbose, exciseRFI, cache = None, fromCache = False, engine = 'pypulse', store = None, prefetch = 0, memory = None, journal = None, retry = False ):
 
         """
         Calls an instance of the Timing class.
         """
 
-        timingObject = Timing( temp, input, band, nsubint, nsubfreq, jump, saveDir, saveFile, verbose, exciseRFI )
+        timingObject = Timing( temp, input, band, nsubint, nsubfreq, jump, saveDir, saveFile, verbose, exciseRFI, cache, fromCache, engine, store, prefetch, memory, journal, retry )
+
+
+    def _timingJob( self, job ):
+
+        """
+        Times one contiguous slice of the work list in a worker process with a single Timing, writing its TOAs to its own part file.
+        """
+
+        i, files, args = job
+
+        # Each process reads ahead within its share of the memory budget
+        memory = args.memoryFlag / sch.processCount( args.processesFlag ) if args.memoryFlag is not None else None
+
+        self.timing( files, args.timingFlag[0], args.tempFlag[0], args.subintFlag[0], args.subfreqFlag[0], args.jumpFlag[0], args.outputDirFlag, self._partName( args, i ), args.verbose, args.rejectionFlag, args.cacheFlag, args.fromCacheFlag, args.engineFlag, args.storeFlag, args.prefetchFlag, memory, args.journalFlag, args.retryFlag )
+
+
+    def _partName( self, args, i ):
+
+        """
+        Returns the TOA filename used by the worker timing slice i.
+        """
+
+        return "{}.part{}".format( args.outputFlag if args.outputFlag is not None else "PSR_TOAs.toa", i )
+
+
+    def parallelTiming( self, inputs, args ):
+
+        """
+        Times the work list in parallel. It is split into one contiguous slice per process, balanced by the estimated footprint of each file,
+        and each slice is timed by one Timing, so the template, TOA store and journal are loaded once per process and prefetching reads ahead
+        within the slice. The part files are merged into the output file in slice order, which is the order of the work list.
+        The slice with the largest files starts first and, with a memory budget, slices only start while the footprints of their largest files fit in it.
+        """
+
+        saveDirectory = args.outputDirFlag if args.outputDirFlag is not None else os.getcwd()
+        saveFile = args.outputFlag if args.outputFlag is not None else "PSR_TOAs.toa"
+
+        files = self._files( inputs, args )
+        footprints = { file: sch.archiveFootprint( file ) for file in files }
+
+        slices = sch.contiguousSlices( files, sch.processCount( args.processesFlag ), footprints.get )
+        jobs = [ ( i, files, args ) for i, files in enumerate( slices ) ]
+
+        budget = args.memoryFlag * 1024**2 if args.memoryFlag is not None else None
+
+        # Archives are loaded one at a time, so a slice needs the memory of its largest file
+        for job, result in sch.runJobs( self._timingJob, jobs, args.processesFlag, budget, lambda job: max( footprints[file] for file in job[1] ) ):
+            pass
+
+        tu.mergeTOAFiles( [ str( saveDirectory + self._partName( args, i ) ) for i in range( len( slices ) ) ], str( saveDirectory + saveFile ) )
+
+
+    def _files( self, inputs, args ):
+
+        """
+        Returns the one ordered list of files to time from the inputs (see otherUtilities.resolveInputs):
+        directories are expanded recursively, globs are matched, --include / --exclude are applied and every file appears once.
+        """
+
+        return u.resolveInputs( inputs, args.includeFlag, args.excludeFlag, args.verbose )
+
+
+    def _pipeline( self, inputs, args ):
+
+        """
+        Returns the pipeline for the arguments: one per frontend with a band configuration, and flux calibrating with --cal.
+        """
+
+        planner = CalibrationPlanner( args.calFlag if args.calFlag else inputs, verbose = args.verbose ) if args.calFlag is not None else None
+
+        if args.bandsFlag is not None:
+            return MultiBandPipeline( args.bandsFlag, args.rejectionFlag, planner, args.verbose )
+
+        return Pipeline( args.tempFlag[0], args.timingFlag[0], args.subintFlag[0], args.subfreqFlag[0], args.jumpFlag[0], args.rejectionFlag, planner, args.verbose )
+
+
+    def pipeline( self, inputs, args ):
+
+        """
+        Runs every file in the inputs through the calibrate-zap-scrunch-time pipeline (one per frontend with a band configuration).
+        """
+
+        files = self._files( inputs, args )
+
+        pipelineObject = self._pipeline( inputs, args )
+
+        saveDirectory = args.outputDirFlag if args.outputDirFlag is not None else os.getcwd()
+        saveFile = args.outputFlag if args.outputFlag is not None else "PSR_TOAs.toa"
+
+        journal = RunJournal( args.journalFlag, args.retryFlag, verbose = args.verbose ) if args.journalFlag is not None else None
+
+        pipelineObject.run( files, str( saveDirectory + saveFile ), args.storeFlag, args.processesFlag, args.memoryFlag, journal )
+
+
+    def watch( self, inputs, args ):
+
+        """
+        Watches the input directories and runs each newly arrived file through the pipeline, appending its TOAs to the output file.
+        """
+
+        directories = [ os.path.abspath( input ) for input in inputs if os.path.isdir( input ) ]
+        if not directories:
+            raise ArgumentError( "Watch mode (-w / --watch) needs at least one directory to watch." )
+
+        pipelineObject = self._pipeline( inputs, args )
+        planner = pipelineObject.planner
+
+        # CAL directories given with --cal are watched too, so new CAL files are indexed as they arrive
+        calDirectories = [ os.path.abspath( input ) for input in ( args.calFlag or [] ) if os.path.isdir( input ) ]
+
+        saveDirectory = args.outputDirFlag if args.outputDirFlag is not None else os.getcwd()
+        saveFile = args.outputFlag if args.outputFlag is not None else "PSR_TOAs.toa"
+
+        # The store and journal are read once, not on every new file
+        store = TOAStore( args.storeFlag, verbose = args.verbose ) if args.storeFlag is not None else None
+        journal = RunJournal( args.journalFlag, args.retryFlag, verbose = args.verbose ) if args.journalFlag is not None else None
+
+        watcher = DirectoryWatcher( directories + [ directory for directory in calDirectories if directory not in directories ], settle = args.watchFlag, verbose = args.verbose )
+
+        try:
+            for files in watcher.watch():
+
+                # Index new CAL files before timing, so new observations are calibrated against their own epoch
+                if planner is not None:
+                    planner.add( files )
+
+                files = [ file for file in self._files( files, args ) if os.path.dirname( os.path.abspath( file ) ) in directories ]
+                if not files:
+                    continue
+                ntoa = pipelineObject.run( files, str( saveDirectory + saveFile ), store, args.processesFlag, args.memoryFlag, journal )
+                print( "\n{} new file(s), {} TOA(s) appended to {}".format( len( files ), ntoa, saveDirectory + saveFile ) )
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()
+
+
+    def plan( self, inputs, args ):
+
+        """
+        Prints the work plan of the inputs (see WorkPlan) without timing anything.
+        """
+
+        if args.bandsFlag is not None:
+            bands = loadBands( args.bandsFlag )
+        else:
+            bands = { args.timingFlag[0]: { 'template': args.tempFlag[0], 'nsubint': args.subintFlag[0], 'nsubfreq': args.subfreqFlag[0] } }
+
+        # The pipeline modes always time with the native engine
+        pipelineMode = args.calFlag is not None or args.bandsFlag is not None or args.watchFlag is not None or args.queueFlag is not None
+        engine = 'native' if pipelineMode else args.engineFlag
+
+        planObject = WorkPlan( self._files( inputs, args ), bands, args.rejectionFlag, args.planFlag, engine, args.calFlag is not None, args.verbose )
+
+        print( "\n".join( planObject.report( args.processesFlag ) ) )
+
+
+    def queue( self, inputs, args ):
+
+        """
+        Writes a work item for every input file and the timing settings to the queue directory, for workers to time.
+        """
+
+        saveDirectory = args.outputDirFlag if args.outputDirFlag is not None else os.getcwd()
+        saveFile = args.outputFlag if args.outputFlag is not None else "PSR_TOAs.toa"
+
+        # Paths are made absolute so workers on any node (and in any directory) find the same files
+        absolute = lambda path: os.path.abspath( path ) if path is not None else None
+
+        settings = { 'timingFlag': args.timingFlag, 'subintFlag': args.subintFlag, 'subfreqFlag': args.subfreqFlag, 'jumpFlag': args.jumpFlag, 'rejectionFlag': args.rejectionFlag,
+                     'tempFlag': [ absolute( args.tempFlag[0] ) ] if args.tempFlag else None,
+                     'bandsFlag': absolute( args.bandsFlag ), 'storeFlag': absolute( args.storeFlag ),
+                     'calFlag': [ absolute( input ) for input in ( args.calFlag or inputs ) ] if args.calFlag is not None else None,
+                     'output': absolute( str( saveDirectory + saveFile ) ) }
+
+        queue = WorkQueue( args.queueFlag, verbose = args.verbose )
+        queue.configure( settings )
+        nfiles = queue.enqueue( self._files( inputs, args ) )
+
+        print( "Queued {} files in {}. Start workers with: python main.py --worker {}".format( nfiles, args.queueFlag, args.queueFlag ) )
+
+
+    def worker( self, args ):
+
+        """
+        Claims and times files from a queue directory until it is empty. The worker that finds every file finished collects the TOAs into the output file.
+        """
+
+        queue = WorkQueue( args.workerFlag, verbose = args.verbose )
+
+        settings = argparse.Namespace( **queue.settings() )
+        settings.verbose = args.verbose
+
+        pipelineObject = self._pipeline( [], settings )
+        store = TOAStore( settings.storeFlag, verbose = args.verbose ) if settings.storeFlag is not None else None
+
+        nfiles = queue.work( pipelineObject, store, args.timeoutFlag )
+
+        if args.verbose:
+            print( "Worker {} timed {} files...".format( queue.worker, nfiles ) )
+
+        if queue.finished():
+            self._collect( queue, settings.output, pipelineObject )
+
+
+    def _collect( self, queue, output, pipelineObject ):
+
+        """
+        Collects the TOAs of a queue's done items into the output file (one per frontend with a band configuration).
+        """
+
+        ntoa = queue.collect( output, pipelineObject.output )
+        print( "Queue {}: {} TOAs collected ({}).".format( "finished" if queue.finished() else "unfinished", ntoa, ", ".join( "{} {}".format( n, state ) for state, n in queue.status().items() if n ) ) )
+
+
+    def manageQueue( self, args ):
+
+        """
+        Requeues the claimed items of a queue directory (--requeue) and / or collects its TOAs (--collect).
+        """
+
+        if args.requeueFlag is not None:
+            queue = WorkQueue( args.requeueFlag, verbose = args.verbose )
+            print( "Requeued {} items.".format( queue.requeue( args.timeoutFlag if args.timeoutFlag is not None else 0 ) ) )
+
+        if args.collectFlag is not None:
+            queue = WorkQueue( args.collectFlag, verbose = args.verbose )
+
+            # Only the output names of the pipeline are needed, so nothing is calibrated
+            settings = argparse.Namespace( **queue.settings() )
+            settings.verbose, settings.calFlag = args.verbose, None
+
+            self._collect( queue, settings.output, self._pipeline( [], settings ) )
@@ -0,0 +1,73 @@
+# Import time benchmark
+# Times 'import PSRTiming' (and the rest of the headless entry points) in fresh interpreters and fails if
+# any of them goes over its budget, or if a plotting / optional heavy dependency is loaded on import.
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+# Budgets in seconds (median of fresh interpreter runs). PSRTiming should only cost numpy and astropy.io.fits.
+BUDGETS = { 'PSRTiming': 1.0, 'argumenthandler': 1.2, 'PSRServer': 0.2 }
+
+# Modules that must not be loaded by importing any of the above
+LAZY = [ 'matplotlib', 'matplotlib.pyplot', 'scipy.stats', 'scipy.optimize', 'scipy.fftpack', 'pypulse', 'magic' ]
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+
+PROBE = '''
+import sys, time, json
+sys.path.insert( 0, {root!r} )
+start = time.perf_counter()
+import {module}
+print( json.dumps( {{ 'time': time.perf_counter() - start, 'loaded': [ m for m in {lazy!r} if m in sys.modules ] }} ) )
+'''
+
+
+def probe( module ):
+
+    '''
+    Imports module in a fresh interpreter. Returns the import time and the lazy modules it loaded.
+    '''
+
+    output = subprocess.run( [ sys.executable, '-W', 'ignore', '-c', PROBE.format( root = ROOT, module = module, lazy = LAZY ) ],
+                             check = True, capture_output = True, text = True ).stdout
+    result = json.loads( output.strip().splitlines()[-1] )
+
+    return result['time'], result['loaded']
+
+
+def benchmark( modules, repeats = 5 ):
+
+    '''
+    Returns the median import time and the lazy modules loaded for each module.
+    '''
+
+    results = {}
+    for module in modules:
+        runs = [ probe( module ) for i in range( repeats ) ]
+        times = sorted( run[0] for run in runs )
+        results[module] = ( times[len( times ) // 2], runs[0][1] )
+
+    return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser( description = 'Times PulseBlast imports against their budgets.' )
+    parser.add_argument( '-r', '--repeats', type = int, default = 5, help = 'Fresh interpreters per module (the median is used).' )
+    parser.add_argument( 'modules', nargs = '*', default = list( BUDGETS ), help = 'Modules to time. Default: {}'.format( ", ".join( BUDGETS ) ) )
+    args = parser.parse_args()
+
+    failed = False
+    for module, ( time, loaded ) in benchmark( args.modules, args.repeats ).items():
+
+        budget = BUDGETS.get( module, BUDGETS['PSRTiming'] )
+        status = "OK"
+        if time > budget or loaded:
+            status, failed = "FAIL", True
+
+        print( "{:<16s} {:6.3f} s (budget {:.1f} s) {}{}".format( module, time, budget, status, "" if not loaded else " - loaded " + ", ".join( loaded ) ) )
+
+    sys.exit( 1 if failed else 0 )
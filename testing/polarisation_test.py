@@ -0,0 +1,138 @@
+# Polarisation basis conversion check
+# Compares the in-place kernels in calibrationUtils (IQUV_to_AABB, AABB_to_IQUV, apply_flux_scale) against the
+# original out-of-place conversions for the cartesian, rotated and circular bases, and checks the AA BB round trip.
+
+import os
+import sys
+import argparse
+import numpy as np
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, ROOT )
+
+import utils.calibrationUtils as calu
+
+BASES = [ "cartesian", "rotated", "circular" ]
+
+
+def referenceIQUV_to_AABB( data, basis = "cartesian" ):
+
+    '''
+    The original IQUV_to_AABB from calibrationUtils.
+    '''
+
+    components = { "cartesian": 1, "rotated": 2, "circular": 3 }
+
+    I = data[..., 0, :, :]
+    comp = data[..., components[basis], :, :]
+
+    aa = np.add( I, comp ) / 2
+    bb = np.subtract( I, comp ) / 2
+
+    return aa, bb
+
+
+def referenceAABB_to_IQUV( prof, basis = "cartesian" ):
+
+    '''
+    The original AABB_to_IQUV from cal_test, using complex square roots of AA and BB.
+    '''
+
+    if len( prof.shape ) == 4:
+        aa, bb = prof[:,0], prof[:,1]
+    elif len( prof.shape ) == 3:
+        aa, bb = prof[0], prof[1]
+
+    a, b = np.lib.scimath.sqrt( aa ), np.lib.scimath.sqrt( bb )
+    I = np.add( aa, bb )
+
+    if basis == "cartesian":
+        Q = np.subtract( aa, bb )
+        U = 2 * ( a * ( b.conjugate() ) ).real
+        V = -2 * ( a * ( b.conjugate() ) ).imag
+    elif basis == "rotated":
+        Q = -2 * ( ( a.conjugate() ) * b ).real
+        U = np.subtract( aa, bb )
+        V = 2 * ( ( a.conjugate() ) * b ).imag
+    elif basis == "circular":
+        Q = 2 * ( ( a.conjugate() ) * b ).real
+        U = -2 * ( ( a.conjugate() ) * b ).imag
+        V = np.subtract( aa, bb )
+
+    return I, Q, U, V
+
+
+def cube( shape, seed = 0 ):
+
+    '''
+    Returns a random Stokes cube with negative values (so AA and BB take both signs).
+    '''
+
+    return np.random.default_rng( seed ).normal( size = shape )
+
+
+def check( name, result, expected, tolerance ):
+
+    '''
+    Prints and returns whether result matches expected.
+    '''
+
+    ok = np.allclose( result, expected, rtol = tolerance, atol = tolerance )
+    print( "{:<48s} {}".format( name, "OK" if ok else "FAIL (max difference {:.3g})".format( np.max( np.abs( np.asarray( result ) - np.asarray( expected ) ) ) ) ) )
+
+    return ok
+
+
+def run( shape ):
+
+    '''
+    Runs every check on cubes of shape (..., 4, nchan, nbin) in float64 and float32. Returns whether they all passed.
+    '''
+
+    passed = True
+
+    for dtype, tolerance in ( ( np.float64, 1e-10 ), ( np.float32, 1e-4 ) ):
+
+        data = cube( shape ).astype( dtype )
+        label = np.dtype( dtype ).name
+
+        for basis in BASES:
+
+            # IQUV -> AABB against the original, out of place and in place
+            expected = referenceIQUV_to_AABB( data.astype( np.float64 ), basis )
+            passed &= check( "IQUV_to_AABB {} {}".format( basis, label ), np.stack( calu.IQUV_to_AABB( data, basis ), axis = -3 ), np.stack( expected, axis = -3 ), tolerance )
+            inPlace = data.copy()
+            calu.IQUV_to_AABB( inPlace, basis, out = inPlace )
+            passed &= check( "IQUV_to_AABB {} {} in place".format( basis, label ), inPlace[..., 0:2, :, :], np.stack( expected, axis = -3 ), tolerance )
+
+            # AABB -> IQUV against the original (which takes AA and BB as the first two polarisations), out of place and in place
+            aabb = data[..., 0:2, :, :]
+            expected = np.stack( referenceAABB_to_IQUV( aabb.astype( np.float64 ), basis ), axis = -3 )
+            passed &= check( "AABB_to_IQUV {} {}".format( basis, label ), calu.AABB_to_IQUV( aabb, basis ), expected, tolerance )
+            inPlace = data.copy()
+            calu.AABB_to_IQUV( inPlace, basis, out = inPlace )
+            passed &= check( "AABB_to_IQUV {} {} in place".format( basis, label ), inPlace, expected, tolerance )
+
+            # AABB -> IQUV -> AABB gives back AA and BB
+            roundTrip = calu.AABB_to_IQUV( aabb, basis )
+            calu.IQUV_to_AABB( roundTrip, basis, out = roundTrip )
+            passed &= check( "AABB round trip {} {}".format( basis, label ), roundTrip[..., 0:2, :, :], aabb, tolerance )
+
+        # Flux scaling against the original conversions with the factors applied in between
+        factor = np.abs( cube( ( 2, shape[-2] ), seed = 1 ) ).astype( dtype )
+        aa, bb = referenceIQUV_to_AABB( data.astype( np.float64 ) )
+        scaled = np.stack( ( aa * factor[0][:, np.newaxis], bb * factor[1][:, np.newaxis] ), axis = -3 )
+        expected = np.stack( referenceAABB_to_IQUV( scaled ), axis = -3 )
+        passed &= check( "apply_flux_scale {}".format( label ), calu.apply_flux_scale( data.copy(), factor ), expected, tolerance )
+
+    return passed
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser( description = 'Checks the polarisation basis conversion kernels against the original conversions.' )
+    parser.add_argument( '-s', '--shape', type = int, nargs = 3, default = [ 8, 64, 256 ], metavar = ( 'NSUBINT', 'NCHAN', 'NBIN' ), help = 'Shape of the random cubes (4 polarisations are added).' )
+    args = parser.parse_args()
+
+    nsubint, nchan, nbin = args.shape
+    sys.exit( 0 if run( ( nsubint, 4, nchan, nbin ) ) else 1 )
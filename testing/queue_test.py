@@ -0,0 +1,78 @@
+# Work queue check
+# Runs a simulated campaign through a WorkQueue (with a stand-in for the pipeline, so no archives are needed) and checks
+# that the collected TEMPO2 file has the FORMAT 1 header, holds the TOAs in input order and is the same if collected again.
+
+import os
+import sys
+import tempfile
+import numpy as np
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, ROOT )
+
+from PSRQueue import WorkQueue
+import utils.timingUtils as tu
+
+
+def columns( file, ntoa = 2 ):
+
+    '''
+    Returns ntoa made up TOAs of a file as columns (see timingUtils.TOA_COLUMNS).
+    '''
+
+    values = { 'imjd': 58000 + np.arange( ntoa ), 'fmjd': np.full( ntoa, 0.25 ), 'error': np.ones( ntoa ), 'frequency': np.full( ntoa, 1400.0 ),
+               'site': [ 'ao' ] * ntoa, 'filename': [ file ] * ntoa, 'frontend': [ 'lbw' ] * ntoa, 'backend': [ 'PUPPI' ] * ntoa,
+               'bw': np.full( ntoa, 800.0 ), 'tobs': np.full( ntoa, 60.0 ), 'template': [ 'template.npy' ] * ntoa, 'nbin': np.full( ntoa, 1024 ),
+               'nchan': np.ones( ntoa ), 'chan': np.zeros( ntoa ), 'subint': np.arange( ntoa ), 'snr': np.full( ntoa, 50.0 ),
+               'flux': np.ones( ntoa ), 'fluxerr': np.ones( ntoa ), 'flags': [ '' ] * ntoa, 'settings': [ '' ] * ntoa }
+
+    return { name: np.asarray( values[name], dtype = dtype ) for name, dtype in tu.TOA_COLUMNS }
+
+
+class StandInPipeline:
+
+    '''
+    Gives every file made up TOAs, as Pipeline.processSafely would.
+    '''
+
+    def processSafely( self, file ):
+        return columns( file ), None
+
+
+def check( name, ok ):
+
+    '''
+    Prints and returns whether a check passed.
+    '''
+
+    print( "{:<48s} {}".format( name, "OK" if ok else "FAIL" ) )
+
+    return ok
+
+
+if __name__ == "__main__":
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        queue = WorkQueue( os.path.join( directory, "queue" ) )
+        files = [ os.path.join( directory, "obs{}.fits".format( i ) ) for i in range( 5 ) ]
+        queue.enqueue( files )
+        queue.work( StandInPipeline() )
+
+        output = os.path.join( directory, "PSR_TOAs.toa" )
+        ntoa = queue.collect( output )
+
+        with open( output, 'r' ) as file:
+            collected = file.read()
+
+        lines = collected.splitlines()
+        passed = check( "Queue finished", queue.finished() )
+        passed &= check( "Collected file starts with FORMAT 1", collected.startswith( "FORMAT 1\n" ) )
+        passed &= check( "Every TOA collected", ntoa == len( lines ) - 1 == 2 * len( files ) )
+        passed &= check( "TOAs in input order", [ line.split()[0] for line in lines[1::2] ] == files )
+
+        queue.collect( output )
+        with open( output, 'r' ) as file:
+            passed &= check( "Collecting again gives the same file", file.read() == collected )
+
+    sys.exit( 0 if passed else 1 )
@@ -0,0 +1,217 @@
+# Throughput benchmark
+# Measures how fast this machine reads and decodes PSRFITS data, makes rejection fits, times profiles (natively and with
+# PyPulse, if it is installed) and flux calibrates profiles, on synthetic data, and saves the rates to throughput.json in
+# the PulseBlast directory for the work planner (main.py --plan) to use.
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import numpy as np
+from astropy.io import fits
+
+ROOT = os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) )
+sys.path.insert( 0, ROOT )
+
+from PSRPlan import THROUGHPUT_FILE
+import utils.mathUtils as mathu
+import utils.timingUtils as tu
+import utils.calibrationUtils as calu
+
+
+def profiles( n, nbin, seed = 0 ):
+
+    '''
+    Returns n noisy Gaussian pulse profiles of nbin bins.
+    '''
+
+    rng = np.random.default_rng( seed )
+    phase = np.arange( nbin ) / nbin
+    pulse = np.exp( -0.5 * ( ( phase - 0.5 ) / 0.02 )**2 )
+
+    return 100 * pulse + rng.normal( size = ( n, nbin ) )
+
+
+def syntheticArchive( filename, nsubint, npol, nchan, nbin ):
+
+    '''
+    Writes a PSRFITS-like file with a SUBINT table of scaled 16 bit data.
+    '''
+
+    rng = np.random.default_rng( 1 )
+    primary = fits.PrimaryHDU()
+    primary.header['OBS_MODE'] = 'PSR'
+    primary.header['FRONTEND'] = 'bench'
+
+    columns = [ fits.Column( name = 'DAT_WTS', format = '{}E'.format( nchan ), array = np.ones( ( nsubint, nchan ), dtype = np.float32 ) ),
+                fits.Column( name = 'DAT_OFFS', format = '{}E'.format( nchan * npol ), array = np.zeros( ( nsubint, nchan * npol ), dtype = np.float32 ) ),
+                fits.Column( name = 'DAT_SCL', format = '{}E'.format( nchan * npol ), array = np.ones( ( nsubint, nchan * npol ), dtype = np.float32 ) ),
+                fits.Column( name = 'DATA', format = '{}I'.format( nbin * nchan * npol ), dim = '({},{},{})'.format( nbin, nchan, npol ),
+                             array = rng.integers( -32768, 32767, size = ( nsubint, npol, nchan, nbin ), dtype = np.int16 ) ) ]
+    subint = fits.BinTableHDU.from_columns( columns, name = 'SUBINT' )
+    subint.header['NPOL'], subint.header['NCHAN'], subint.header['NBIN'] = npol, nchan, nbin
+
+    fits.HDUList( [ primary, subint ] ).writeto( filename, overwrite = True )
+
+
+def readRate( nsubint = 64, npol = 4, nchan = 128, nbin = 512, repeats = 3 ):
+
+    '''
+    Returns the bytes per second read from disk and decoded into a float64 data cube.
+    '''
+
+    with tempfile.TemporaryDirectory() as directory:
+
+        filename = os.path.join( directory, "bench.fits" )
+        syntheticArchive( filename, nsubint, npol, nchan, nbin )
+        size = os.path.getsize( filename )
+
+        times = []
+        for i in range( repeats ):
+            start = time.perf_counter()
+            with fits.open( filename, memmap = False ) as hdul:
+                table = hdul['SUBINT'].data
+                data = np.asarray( table['DATA'], dtype = np.float64 )
+                data = data * table['DAT_SCL'].reshape( nsubint, npol, nchan, 1 ) + table['DAT_OFFS'].reshape( nsubint, npol, nchan, 1 )
+                data *= table['DAT_WTS'].reshape( nsubint, 1, nchan, 1 )
+            times.append( time.perf_counter() - start )
+
+    return size / min( times )
+
+
+def fitRate( n = 200, nbin = 1024 ):
+
+    '''
+    Returns the rejection fits per second: the curve fit made on the FFT of every profile by DataCull.fourierTransformRejection.
+    '''
+
+    import scipy.optimize as opt
+    from scipy.fftpack import fft, fftshift
+
+    curve = mathu.FFT_dist._pdf
+    data = profiles( n, nbin )
+
+    start = time.perf_counter()
+    for profile in data:
+        profFFT = fftshift( abs( mathu.normalizeToMax( abs( fft( profile ).T ) ) ) )
+        try:
+            opt.curve_fit( curve, np.arange( nbin ), profFFT, p0 = [ 100, 100, 1024 ] )
+        except RuntimeError:
+            pass
+
+    return n / ( time.perf_counter() - start )
+
+
+def portraitRate( nsubint = 16, nchan = 256, nbin = 1024, repeats = 3 ):
+
+    '''
+    Returns the profiles compared per second by portrait rejection (DataCull.portraitRejection):
+    the amplitude spectrum of every profile against that of its portrait channel.
+    '''
+
+    data = profiles( nsubint * nchan, nbin ).reshape( nsubint, nchan, nbin )
+    tempAmps = np.abs( np.fft.rfft( profiles( nchan, nbin, seed = 2 ), axis = 1 )[:, 1:] )
+    tempAmps = tempAmps / np.max( tempAmps, axis = 1, keepdims = True )
+
+    times = []
+    for i in range( repeats ):
+        start = time.perf_counter()
+        profAmps = np.abs( np.fft.rfft( data, axis = 2 )[:, :, 1:] )
+        profAmps = profAmps / ( np.max( profAmps, axis = 2, keepdims = True ) + np.spacing( 0 ) )
+        rmsArray = np.sqrt( np.mean( ( profAmps - tempAmps )**2, axis = 2 ) )
+        rmsArray[np.all( data == 0, axis = 2 )] = np.nan
+        mathu.chauvenet( np.ma.array( rmsArray, mask = np.isnan( rmsArray ) ), np.nanmean( rmsArray ), np.nanstd( rmsArray ), 3 )
+        times.append( time.perf_counter() - start )
+
+    return nsubint * nchan / min( times )
+
+
+def toaRate( n = 20000, nbin = 1024, repeats = 3 ):
+
+    '''
+    Returns the profiles timed per second by the native engine (timingUtils.fftfit).
+    '''
+
+    data = profiles( n, nbin )
+    templateFFT = tu.templateSpectrum( np.fft.rfft( profiles( 1, nbin, seed = 2 )[0] ), nbin )
+
+    times = []
+    for i in range( repeats ):
+        start = time.perf_counter()
+        tu.fftfit( data, templateFFT )
+        times.append( time.perf_counter() - start )
+
+    return n / min( times )
+
+
+def pypulseRate( n = 50, nbin = 1024 ):
+
+    '''
+    Returns the profiles timed per second by PyPulse: the fit Archive.time makes
+    of every profile. Returns None if PyPulse isn't installed.
+    '''
+
+    try:
+        import pypulse.singlepulse as SP
+    except ImportError:
+        return None
+
+    data = profiles( n, nbin )
+    template = profiles( 1, nbin, seed = 2 )[0]
+
+    start = time.perf_counter()
+    for profile in data:
+        SP.SinglePulse( profile, windowsize = nbin // 8 ).fitPulse( template )
+
+    return n / ( time.perf_counter() - start )
+
+
+def calRate( nsubint = 16, nchan = 256, nbin = 1024, repeats = 3 ):
+
+    '''
+    Returns the profiles (of each polarisation) flux calibrated per second by calibrationUtils.apply_flux_scale.
+    '''
+
+    data = np.random.default_rng( 3 ).normal( size = ( nsubint, 4, nchan, nbin ) )
+    factors = np.ones( ( 2, nchan ) )
+
+    times = []
+    for i in range( repeats ):
+        cube = data.copy()
+        start = time.perf_counter()
+        calu.apply_flux_scale( cube, factors )
+        times.append( time.perf_counter() - start )
+
+    return nsubint * 4 * nchan / min( times )
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser( description = 'Measures PulseBlast throughput for the work planner.' )
+    parser.add_argument( '-o', '--output', default = THROUGHPUT_FILE, help = 'File to save the rates to. Default: {}'.format( THROUGHPUT_FILE ) )
+    args = parser.parse_args()
+
+    throughput = { 'read': readRate(), 'fit': fitRate(), 'portrait': portraitRate(), 'toa': toaRate(), 'cal': calRate() }
+
+    # The PyPulse rate is left to the planner's default if PyPulse isn't installed
+    rate = pypulseRate()
+    if rate is not None:
+        throughput['pypulse'] = rate
+
+    print( "Read:           {:10.1f} MB/s".format( throughput['read'] / 1024**2 ) )
+    print( "Fits:           {:10.1f} fits/s".format( throughput['fit'] ) )
+    print( "Portrait:       {:10.1f} profiles/s".format( throughput['portrait'] ) )
+    print( "TOAs (native):  {:10.1f} profiles/s".format( throughput['toa'] ) )
+    print( "TOAs (PyPulse): {}".format( "{:10.1f} profiles/s".format( rate ) if rate is not None else "PyPulse not installed, default used" ) )
+    print( "Calibration:    {:10.1f} profiles/s".format( throughput['cal'] ) )
+    print( "The per file overhead and calibration solve times aren't measured; the planner's defaults are used for them." )
+
+    throughput.update( { 'measured': time.strftime( "%Y-%m-%d %H:%M:%S" ), 'host': socket.gethostname() } )
+
+    with open( args.output, 'w' ) as file:
+        json.dump( throughput, file, indent = 1 )
+
+    print( "Saved to {}".format( args.output ) )
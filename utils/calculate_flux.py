@@ -1,43 +1,217 @@
 # Calculates flux from a known continuum based on one of two formats
 
-import mmap
-import math
+import os
 import argparse
+import numpy as np
 
+# Default catalog, found relative to this file rather than the working directory
+FLUXCAL_CFG = os.path.join( os.path.dirname( os.path.abspath( __file__ ) ), 'fluxcal.cfg' )
 
-def find_flux_f1( frequency, source ):
+
+class FluxCatalog:
 
     """
-    Returns the Format 1 (see .cfg file) flux as a float from a given source.
+    Flux calibrator catalog. Parses a fluxcal.cfg file once into a table of
+    sources (Format 1 and Format 2, see the .cfg file) indexed by every name and
+    alias, so lookups are dictionary hits on the exact name.
+    The parsed table is saved as a compact .npz file next to the .cfg file and
+    reused until the .cfg file changes.
     """
 
-    if not isinstance( source, str ):
-        raise TypeError( "Source parsed in must be a string" )
+    def __init__( self, cfg = FLUXCAL_CFG ):
+
+        self.cfg = os.path.abspath( cfg )
+        self.cachePath = self.cfg + ".npz"
+
+        source = os.stat( self.cfg )
+        self._stamp = np.array( [ source.st_mtime_ns, source.st_size ], dtype = np.int64 )
+
+        if not self._loadCache():
+            self._parse()
+            self._saveCache()
+
+        self.index = { str( alias ): int( i ) for alias, i in zip( self.aliases, self.aliasIndex ) }
+
+    def __repr__( self ):
+        return "FluxCatalog( cfg = {} )".format( self.cfg )
+
+    def __len__( self ):
+        return len( self.names )
+
+    def __contains__( self, source ):
+        return str( source ) in self.index
+
+
+    def _parse( self ):
+
+        """
+        Parses the .cfg file. A line starting with '%' (Format 1) or '&' (Format 2)
+        starts a new source and 'aka' lines add aliases to the last source.
+        """
+
+        names, formats, ra, dec, params = [], [], [], [], []
+        aliases, aliasIndex = [], []
+
+        with open( self.cfg, 'r' ) as file:
+            for line in file:
+                fields = line.split()
+
+                if not fields or fields[0].startswith( "#" ):
+                    continue
+
+                if fields[0][0] in "%&":
+                    names.append( fields[0][1:] )
+                    formats.append( 1 if fields[0][0] == "%" else 2 )
+                    ra.append( fields[1] )
+                    dec.append( fields[2] )
+                    params.append( [ float( p ) for p in fields[3:] ] )
+                    aliases.append( names[-1] )
+                    aliasIndex.append( len( names ) - 1 )
+
+                elif fields[0] == "aka" and len( fields ) > 1 and names:
+                    aliases.append( fields[1] )
+                    aliasIndex.append( len( names ) - 1 )
+
+        # Parameters are padded with NaN up to the longest set of coefficients
+        self.params = np.full( ( len( params ), max( [ len( p ) for p in params ] + [ 0 ] ) ), np.nan )
+        for i, p in enumerate( params ):
+            self.params[i, :len( p )] = p
+
+        self.names = np.array( names, dtype = np.str_ )
+        self.formats = np.array( formats, dtype = np.int8 )
+        self.ra = np.array( ra, dtype = np.str_ )
+        self.dec = np.array( dec, dtype = np.str_ )
+        self.aliases = np.array( aliases, dtype = np.str_ )
+        self.aliasIndex = np.array( aliasIndex, dtype = np.int32 )
+
+
+    def _loadCache( self ):
+
+        """
+        Loads the parsed table if it was made from the current .cfg file.
+        Returns True on success.
+        """
+
+        try:
+            with np.load( self.cachePath ) as cache:
+                if not np.array_equal( cache['stamp'], self._stamp ):
+                    return False
+                for key in [ 'names', 'formats', 'ra', 'dec', 'params', 'aliases', 'aliasIndex' ]:
+                    setattr( self, key, cache[key] )
+        except ( OSError, KeyError, ValueError ):
+            return False
+
+        return True
+
+
+    def _saveCache( self ):
+
+        """
+        Saves the parsed table. The catalog still works if the directory is read-only.
+        """
+
+        temporary = self.cachePath + ".{}.tmp.npz".format( os.getpid() )
+
+        try:
+            np.savez( temporary, stamp = self._stamp, names = self.names, formats = self.formats, ra = self.ra, dec = self.dec,
+                      params = self.params, aliases = self.aliases, aliasIndex = self.aliasIndex )
+            os.replace( temporary, self.cachePath )
+        except OSError:
+            pass
+
+
+    def lookup( self, source ):
+
+        """
+        Returns the row of a source given its name or any alias (exact match).
+        """
+
+        try:
+            return self.index[str( source )]
+        except KeyError:
+            raise ValueError( "No source matching name given was found: {}".format( source ) )
+
 
-    new_f = float( frequency )
+    def entry( self, source ):
 
-    src = source.encode()
-    amp_line = b""
+        """
+        Returns the name, RA, Dec, format and parameters of a source as a dictionary.
+        """
+
+        i = self.lookup( source )
+        params = self.params[i]
+
+        return { 'name': str( self.names[i] ), 'ra': str( self.ra[i] ), 'dec': str( self.dec[i] ), 'format': int( self.formats[i] ),
+                 'params': params[~np.isnan( params )] }
+
+
+    def fluxes( self, frequency, sources, format = None ):
+
+        """
+        Returns the flux in Jy of every source at every frequency (in GHz) as an
+        array of shape (nsources,) + frequency.shape. Frequencies can be a scalar
+        or an array of any shape (e.g. the channel frequencies of every band).
+        Format 1 and Format 2 sources are evaluated together in one pass.
+        If a format is given, every source must have parameters in that format.
+        """
+
+        rows = np.array( [ self.lookup( source ) for source in np.atleast_1d( sources ) ], dtype = np.intp )
+
+        if format is not None and np.any( self.formats[rows] != format ):
+            raise ValueError( "Sources {} do not have Format {} flux parameters".format( [ str( source ) for source in np.atleast_1d( sources )[self.formats[rows] != format] ], format ) )
+
+        f = np.asarray( frequency, dtype = np.float64 )
+        params = self.params[rows].reshape( ( len( rows ), ) + ( 1, ) * f.ndim + ( -1, ) )
 
+        with np.errstate( invalid = 'ignore', divide = 'ignore', over = 'ignore' ):
 
-    # Opens cfg file and creates read-only mmap. Then, searches for '%' (start of new source), before then searching for aliases.
-    # Once the alias is found, the last recorded '%' line is parsed into memory and the file closes.
+            # Format 2: log10(S) = a_0 + a_1*log10(f) + a_2*(log10(f))^2 + ..., with the NaN padding as zero coefficients
+            powers = np.log10( f )[..., np.newaxis] ** np.arange( params.shape[-1] )
+            formatTwo = 10 ** np.sum( np.nan_to_num( params ) * powers, axis = -1 )
 
-    with open( 'fluxcal.cfg', 'rb', 0 ) as file, mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ ) as s:
-        for lin_num, line in enumerate( iter(s.readline, b"") ):
-            if line.find( b'%' ) != -1:
-                amp_line = line
+            # Format 1: S = S_0 * (f / f_0)^alpha with f_0 stored in MHz
+            formatOne = params[..., 1] * ( ( f / ( params[..., 0] / 1000 ) ) ** params[..., 2] )
 
-            if src in line and not line.startswith( b"#" ):
-                file.close()
-                break
+        isFormatOne = ( self.formats[rows] == 1 ).reshape( ( len( rows ), ) + ( 1, ) * f.ndim )
 
-    amp_line = amp_line.decode()
-    if amp_line == "":
-        raise ValueError( "No source matching name given was found" )
-    name, ra, dec, freq, flux, spec = amp_line.split()
+        return np.where( isFormatOne, formatOne, formatTwo )
 
-    freq, flux, spec = float( freq ), float( flux ), float( spec )
+
+_catalogs = {}
+
+def getCatalog( cfg = FLUXCAL_CFG ):
+
+    """
+    Returns the FluxCatalog for a .cfg file, parsing it only the first time
+    (or again if the file has changed).
+    """
+
+    cfg = os.path.abspath( cfg )
+    source = os.stat( cfg )
+
+    catalog = _catalogs.get( cfg )
+    if catalog is None or catalog._stamp[0] != source.st_mtime_ns or catalog._stamp[1] != source.st_size:
+        catalog = _catalogs[cfg] = FluxCatalog( cfg )
+
+    return catalog
+
+
+def find_flux_f1( frequency, source ):
+
+    """
+    Returns the Format 1 (see .cfg file) flux as a float from a given source.
+    """
+
+    if not isinstance( source, str ):
+        raise TypeError( "Source parsed in must be a string" )
+
+    new_f = np.asarray( frequency, dtype = np.float64 )
+
+    entry = getCatalog().entry( source )
+    if entry['format'] != 1:
+        raise ValueError( "Source {} does not have Format 1 flux parameters".format( source ) )
+
+    freq, flux, spec = entry['params'][:3]
     freq /= 1000
 
     # Use spectral index to calculate flux at a different frequency
@@ -55,44 +229,24 @@ def find_source_params_f2( source ):
     if not isinstance( source, str ):
         raise TypeError( "Source parsed in must be a string" )
 
-    src = source.encode()
-    amp_line = b""
-
+    entry = getCatalog().entry( source )
+    if entry['format'] != 2:
+        raise ValueError( "Source {} does not have Format 2 flux parameters".format( source ) )
 
-    # Opens cfg file and creates read-only mmap. Then, searches for '&' (start of new source), before then searching for aliases.
-    # Once the alias is found, the last recorded '&' line is parsed into memory and the file closes.
-
-    with open( 'fluxcal.cfg', 'rb', 0 ) as file, mmap.mmap( file.fileno(), 0, access = mmap.ACCESS_READ ) as s:
-        for lin_num, line in enumerate( iter(s.readline, b"") ):
-            if line.find( b'&' ) != -1:
-                amp_line = line
-
-            if src in line and not line.startswith( b"#" ):
-                file.close()
-                break
-
-    amp_line = amp_line.decode()
-    if amp_line == "":
-        raise ValueError( "No source matching name given was found" )
-    params = amp_line.split()
-    return params[3:]
+    return [ repr( float( p ) ) for p in entry['params'] ]
 
 
 def calculate_flux_f2( frequency, params ):
 
     """
-    Returns the Format 2 (see .cfg file) flux at a given frequency for a set of coefficients.
+    Returns the Format 2 (see .cfg file) flux at a given frequency (or array of frequencies) for a set of coefficients.
     """
 
-    # Turn all inputs to floats if not already
-    f = float( frequency )
-    p = list( map( float, params ) )
+    # Turn all inputs to float arrays if not already
+    f = np.asarray( frequency, dtype = np.float64 )
+    p = np.asarray( params, dtype = np.float64 )
 
-    LogS = p[0]
-
-    for i, elem in enumerate( p[1:] ):
-        corr = elem*((math.log10(f))**(i+1))
-        LogS += corr
+    LogS = np.sum( p * ( np.log10( f )[..., np.newaxis] ** np.arange( len( p ) ) ), axis = -1 )
 
     flux = 10**LogS
     return flux
@@ -102,17 +256,28 @@ def getFlux( frequency, source, format1 = False ):
 
     """
     Master method. Returns the flux of a given frequency, source and format.
+    Frequencies can be a scalar (returns a float) or an array (returns an array of the same shape).
     """
 
-    if format1:
-        flux = find_flux_f1( frequency, str( source ) )
-    else:
-        params = find_source_params_f2( str( source ) )
-        flux = calculate_flux_f2( frequency, params )
+    flux = getFluxes( frequency, [ str( source ) ], 1 if format1 else 2 )[0]
+
+    if flux.ndim == 0:
+        return flux.item()
 
     return flux
 
 
+def getFluxes( frequency, sources, format = None, cfg = FLUXCAL_CFG ):
+
+    """
+    Batch method. Returns the flux of several sources at every frequency given,
+    as an array of shape (nsources,) + frequency.shape. Sources can be a mix of
+    Format 1 and Format 2 unless a format is given.
+    """
+
+    return getCatalog( cfg ).fluxes( frequency, sources, format )
+
+
 if __name__ == "__main__":
 
     def parser( progname ):
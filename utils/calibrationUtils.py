@@ -0,0 +1,232 @@
+# Flux calibration utilities, Python 3
+
+# Imports
+import math
+import numpy as np
+
+
+def chan_to_freq( ctr_freq, bandwidth, nchan ):
+
+    '''
+    Returns the channel frequencies of a band given its centre frequency, bandwidth and number of channels.
+    '''
+
+    start_freq = ctr_freq - ( bandwidth / 2 )
+    end_freq = ctr_freq + ( bandwidth / 2 )
+    freq = np.linspace( start_freq, end_freq, num = nchan )
+    return freq
+
+
+def find_cal_switching_points( nbin, start_duty = 0.0, duty = 0.5 ):
+
+    '''
+    Returns the bins where the noise diode switches for a cal profile of nbin bins:
+    the start of the low state, the start of the high state and the end of the high state.
+    '''
+
+    start = math.floor( nbin * start_duty )
+
+    bin_start = math.floor( nbin * ( start_duty + duty ) )
+    bin_end = bin_start + ( math.floor( nbin * duty ) )
+
+    return start, bin_start, bin_end
+
+
+# Stokes parameter holding AA - BB in each basis
+BASIS_COMPONENTS = { "cartesian": 1, "rotated": 2, "circular": 3 }
+
+
+def _basisComponent( basis ):
+
+    '''
+    Returns the index of the Stokes parameter holding AA - BB in a basis.
+    '''
+
+    if basis not in BASIS_COMPONENTS:
+        raise ValueError( "'basis' must be either 'cartesian', 'rotated' or 'circular'." )
+
+    return BASIS_COMPONENTS[basis]
+
+
+def IQUV_to_AABB( data, basis = "cartesian", out = None ):
+
+    '''
+    Returns the AA and BB components of Stokes data in the basis stated.
+    The polarisation axis is the third from last, i.e. data has shape
+    (..., npol, nchan, nbin) as in a PyPulse data cube.
+    AA and BB are written to the first two polarisations of out, which can be
+    preallocated with shape (..., 2, nchan, nbin) or be data itself to convert
+    in place (overwriting I and Q). No other arrays are allocated.
+    Returns views of AA and BB.
+    '''
+
+    component = _basisComponent( basis )
+
+    if out is None:
+        out = np.empty( data.shape[:-3] + ( 2, ) + data.shape[-2:], dtype = data.dtype if np.issubdtype( data.dtype, np.floating ) else np.float64 )
+
+    I, comp = data[..., 0, :, :], data[..., component, :, :]
+    aa, bb = out[..., 0, :, :], out[..., 1, :, :]
+
+    # AA = (I + comp) / 2 and BB = AA - comp, which is safe if comp is the BB plane
+    np.add( I, comp, out = aa )
+    aa *= 0.5
+    np.subtract( aa, comp, out = bb )
+
+    return aa, bb
+
+
+def AABB_to_IQUV( data, basis = "cartesian", out = None ):
+
+    '''
+    Returns Stokes data in the basis stated given AA and BB as the first two
+    polarisations of data, of shape (..., 2, nchan, nbin) or (..., 4, nchan, nbin).
+    The result is written to out, which can be preallocated with shape
+    (..., 4, nchan, nbin) or be data itself (with 4 polarisations) to convert in
+    place. Gives the same result as taking the cross terms from complex square
+    roots of AA and BB, without making any complex arrays: 2 * sqrt(|AA BB|)
+    is the real cross term if AA and BB have the same sign, or the imaginary
+    one (with the sign of AA) if not. Only one extra plane and a boolean mask
+    are allocated.
+    Returns out.
+    '''
+
+    component = _basisComponent( basis )
+
+    if out is None:
+        out = np.empty( data.shape[:-3] + ( 4, ) + data.shape[-2:], dtype = data.dtype if np.issubdtype( data.dtype, np.floating ) else np.float64 )
+
+    # Bring AA and BB into the first two planes of the output
+    if out is not data:
+        out[..., 0:2, :, :] = data[..., 0:2, :, :]
+
+    aa, bb = out[..., 0, :, :], out[..., 1, :, :]
+    P2, P3 = out[..., 2, :, :], out[..., 3, :, :]
+
+    # Real cross term into P2 and imaginary cross term into P3
+    np.multiply( aa, bb, out = P2 )
+    negative = P2 < 0
+    np.abs( P2, out = P3 )
+    np.sqrt( P3, out = P3 )
+    P3 *= 2
+    np.multiply( P3, np.logical_not( negative ), out = P2 )
+    np.copysign( P3, aa, out = P3 )
+    P3 *= negative
+
+    # AA - BB into a new plane and I = AA + BB
+    difference = np.subtract( aa, bb )
+    aa += bb
+
+    # Arrange Q, U and V for the basis
+    if component == 1:
+        bb[...] = difference
+    elif component == 2:
+        np.negative( P2, out = bb )
+        P2[...] = difference
+    else:
+        bb[...] = P2
+        np.negative( P3, out = P2 )
+        P3[...] = difference
+
+    return out
+
+
+def cal_levels( profiles, start_duty = 0.0, duty = 0.5, r_err = 8 ):
+
+    '''
+    Returns the mean of the high (diode on) and low (diode off) states of cal
+    profiles, binned along the last axis, for every profile at once. Means are
+    rounded to r_err decimal places. Profiles containing NaN give NaN.
+    '''
+
+    start, bin_start, bin_end = find_cal_switching_points( np.shape( profiles )[-1], start_duty, duty )
+
+    low_mean = np.round( np.mean( profiles[..., start:bin_start], axis = -1 ), r_err )
+    high_mean = np.round( np.mean( profiles[..., bin_start:bin_end], axis = -1 ), r_err )
+
+    return high_mean, low_mean
+
+
+def solve_Fcal( data_on, data_off, s_duty_on = 0.0, duty_on = 0.5, s_duty_off = 0.0, duty_off = 0.5, G = 10.0, T0 = 1.0 ):
+
+    '''
+    Returns the noise diode flux, F_cal (in Jy / cal), of every channel of the
+    AA and BB polarisations as a (2, nchan) array, given time scrunched Stokes
+    data of shape (npol, nchan, nbin) pointing on and off a continuum source of
+    flux T0 (in Jy) and a telescope gain G.
+    NaN is handled for all cells at once: an undefined on-source fractional
+    increase is set to 1 and channels whose F_cal is undefined are set to 0.
+    '''
+
+    high_on, low_on = cal_levels( np.stack( IQUV_to_AABB( data_on, basis = "cartesian" ) ), s_duty_on, duty_on )
+    high_off, low_off = cal_levels( np.stack( IQUV_to_AABB( data_off, basis = "cartesian" ) ), s_duty_off, duty_off )
+
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+
+        f_on = ( high_on / low_on ) - 1
+        f_off = ( high_off / low_off ) - 1
+
+        f_on = np.where( np.isnan( f_on ), 1, f_on )
+
+        C0 = T0 / ( ( 1 / f_on ) - ( 1 / f_off ) )
+        T_sys = C0 / f_off
+        F_cal = ( T_sys * f_off ) / G     # F_cal has units Jy / cal
+
+    return np.where( np.isnan( F_cal ), 0, F_cal )
+
+
+def solve_Jy_per_count( data, F_cal, s_duty = 0.0, duty = 0.5 ):
+
+    '''
+    Returns the Jy per count factor of every channel of the AA and BB
+    polarisations as a (2, nchan) array, given the time scrunched Stokes data
+    of a pulsar cal observation, of shape (npol, nchan, nbin), and the diode
+    flux of each channel, F_cal, as a (2, nchan) array.
+    '''
+
+    high, low = cal_levels( np.stack( IQUV_to_AABB( data, basis = "cartesian" ) ), s_duty, duty )
+
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+        jy_per_count_factor = np.asarray( F_cal ) / ( high - low )     # A has units Jy / count
+
+    return jy_per_count_factor
+
+
+def Fcal_interpolators( frequencies, F_cal, kind = 'cubic' ):
+
+    '''
+    Returns functions of frequency interpolating (and extrapolating) F_cal for
+    the AA and BB polarisations.
+    '''
+
+    # Imported here so the rest of the module doesn't need scipy
+    from scipy.interpolate import interp1d
+
+    return tuple( interp1d( frequencies, F_cal[i], kind = kind, fill_value = 'extrapolate' ) for i in np.arange( 2 ) )
+
+
+def apply_flux_scale( data, cal_factor ):
+
+    '''
+    Flux calibrates Stokes data of shape (..., npol, nchan, nbin) in place by
+    scaling its AA and BB components (cartesian basis) by the (2, nchan) Jy per
+    count factors in cal_factor, then converting back to IQUV with AABB_to_IQUV.
+    data must be float32 or float64; the factors are cast to its type. Both
+    conversions run in place, so only one extra plane and a boolean mask are
+    allocated on top of the cube.
+    Returns data.
+    '''
+
+    if not np.issubdtype( data.dtype, np.floating ):
+        raise TypeError( "Data must be a float32 or float64 array. (Type provided: {})".format( data.dtype ) )
+    elif data.shape[-3] < 4:
+        raise ValueError( "Data must have all 4 Stokes parameters to be calibrated. (Polarisations provided: {})".format( data.shape[-3] ) )
+
+    # Factors broadcast along the bin axis
+    ca, cb = np.asarray( cal_factor, dtype = data.dtype )[..., np.newaxis]
+
+    aa, bb = IQUV_to_AABB( data, basis = "cartesian", out = data )
+    aa *= ca
+    bb *= cb
+
+    return AABB_to_IQUV( data, basis = "cartesian", out = data )
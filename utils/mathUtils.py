@@ -5,18 +5,34 @@
 import math
 import numpy as np
 from custom_exceptions import DimensionError
-from scipy.stats import rv_continuous
 
 # PDF classes
-class test_dist( rv_continuous ):
+def _pdfClasses():
 
-    def _pdf( x, a, b, c ):
-        return np.sqrt(a) * ( np.exp(-(b*x)**2 / c ) / np.sqrt(2.0 * np.pi) )
+    '''
+    Returns the PDF classes. They are made the first time one is used
+    (see __getattr__), so importing this module doesn't load scipy.stats.
+    '''
+
+    from scipy.stats import rv_continuous
+
+    class test_dist( rv_continuous ):
+
+        def _pdf( x, a, b, c ):
+            return np.sqrt(a) * ( np.exp(-(b*x)**2 / c ) / np.sqrt(2.0 * np.pi) )
+
+    class FFT_dist( rv_continuous ):
+
+        def _pdf( x, b, a, k ):
+            return (b/(np.sqrt(1 + a*((k-x)**2))))
 
-class FFT_dist( rv_continuous ):
+    return { 'test_dist': test_dist, 'FFT_dist': FFT_dist }
 
-    def _pdf( x, b, a, k ):
-        return (b/(np.sqrt(1 + a*((k-x)**2))))
+def __getattr__( name ):
+    if name in ( 'test_dist', 'FFT_dist' ):
+        globals().update( _pdfClasses() )
+        return globals()[name]
+    raise AttributeError( "module {!r} has no attribute {!r}".format( __name__, name ) )
 
 # Functions
 def rootMeanSquare( array ):
@@ -85,6 +101,50 @@ def normalizeToMax( array ):
     return ( array / ( np.max( array, 0 ) + np.spacing( 0 ) ) )
 
 
+def fourierShifts( spectra, templateFFT, nbin ):
+
+    '''
+    Returns the (fractional) bin shift of each profile relative to a template,
+    given the real FFTs of the profiles (last axis) and the template.
+    The shift is the peak of the FFT cross-correlation, refined by fitting a
+    parabola through the peak and its two neighbours. A positive shift means
+    the profile lags the template. Works on any number of leading dimensions.
+    '''
+
+    # Cross-correlate every profile with the template in one batched inverse FFT
+    cross = np.fft.irfft( spectra * np.conj( templateFFT ), n = nbin, axis = -1 )
+
+    peak = np.argmax( cross, axis = -1 )
+
+    centre = np.take_along_axis( cross, peak[..., np.newaxis], axis = -1 )[..., 0]
+    left = np.take_along_axis( cross, ( ( peak - 1 ) % nbin )[..., np.newaxis], axis = -1 )[..., 0]
+    right = np.take_along_axis( cross, ( ( peak + 1 ) % nbin )[..., np.newaxis], axis = -1 )[..., 0]
+
+    # Parabolic interpolation of the peak position. Flat peaks get no correction.
+    curvature = left - ( 2 * centre ) + right
+    offset = np.divide( 0.5 * ( left - right ), curvature, out = np.zeros_like( curvature ), where = curvature != 0 )
+
+    # Wrap into [-nbin/2, nbin/2)
+    shifts = ( peak + offset + ( nbin / 2 ) ) % nbin - ( nbin / 2 )
+
+    return shifts
+
+
+def fourierRotate( spectra, shifts, nbin ):
+
+    '''
+    Rotates profiles in the Fourier domain by the given number of bins
+    (fractional shifts allowed). Takes and returns real FFTs along the last
+    axis, with one shift per leading index. Positive shifts move the profile
+    later in phase.
+    '''
+
+    harmonics = np.arange( spectra.shape[-1] )
+    phase = np.exp( -2j * np.pi * np.asarray( shifts )[..., np.newaxis] * harmonics / nbin )
+
+    return spectra * phase
+
+
 def chauvenet( array, mean = 0, stddev = 1, threshold = 3.0 ):
 
     '''
@@ -3,11 +3,13 @@
 # Imports
 import sys
 import os
+import re
+import glob
+import fnmatch
 import platform
 import numpy as np
 import inspect
 from collections import namedtuple
-import matplotlib.pyplot as plt
 
 from utils.mathUtils import rmsMatrix2D
 
@@ -133,19 +135,19 @@ def get_unique_fitting_parameter_length( func ):
 
     argspec = getargspec_no_self( func )
 
-    if len( argspec[0] ) is 0:
+    if len( argspec[0] ) == 0:
         raise ValueError( "Length of ArgSpec must not be 0" )
 
     has_self = False
     count = 0
 
     for i, arg in enumerate( argspec[0] ):
-        if arg is 'self':
+        if arg == 'self':
             has_self = True
             continue
-        if has_self and i is 1:
+        if has_self and i == 1:
             continue
-        if not has_self and i is 0:
+        if not has_self and i == 0:
             continue
 
         count += 1
@@ -181,6 +183,131 @@ def addExtension( file, ext, save = False, overwrite = False ):
     return fileout
 
 
+def _matches( path, patterns ):
+
+    '''
+    Returns True if the path or its filename matches any of the glob patterns.
+    '''
+
+    return any( fnmatch.fnmatch( path, pattern ) or fnmatch.fnmatch( os.path.basename( path ), pattern ) for pattern in patterns )
+
+
+def _recursiveGlob( pattern ):
+
+    '''
+    Splits a glob pattern containing ** into the directory to walk (the part
+    before the first wildcard) and a compiled expression matching the paths
+    under it, or under any directory it matches.
+    '''
+
+    parts = pattern.split( os.sep )
+    n = next( i for i, part in enumerate( parts ) if glob.has_magic( part ) )
+    base = os.sep.join( parts[:n] ) if n > 0 else ""
+    if pattern.startswith( os.sep ) and not base:
+        base = os.sep
+
+    expression, i = "", 0
+    while i < len( pattern ):
+        if pattern.startswith( "**" + os.sep, i ):
+            expression, i = expression + r"(?:.*" + re.escape( os.sep ) + r")?", i + 3
+        elif pattern.startswith( "**", i ):
+            expression, i = expression + r".*", i + 2
+        elif pattern[i] == "*":
+            expression, i = expression + r"[^" + re.escape( os.sep ) + r"]*", i + 1
+        elif pattern[i] == "?":
+            expression, i = expression + r"[^" + re.escape( os.sep ) + r"]", i + 1
+        elif pattern[i] == "[" and "]" in pattern[i + 2:]:
+            j = pattern.index( "]", i + 2 )
+            expression, i = expression + r"[" + pattern[i + 1:j].replace( "!", "^", 1 ).replace( "\\", r"\\" ) + r"]", j + 1
+        else:
+            expression, i = expression + re.escape( pattern[i] ), i + 1
+
+    return base, re.compile( expression + r"(?:" + re.escape( os.sep ) + r".*)?\Z" )
+
+
+def resolveInputs( inputs, include = None, exclude = None, verbose = False ):
+
+    '''
+    Resolves a list of inputs (files, directories and glob patterns, where **
+    matches any number of subdirectories) into one ordered list of files.
+    Directories are expanded recursively in sorted order, following symbolic
+    links but never entering a directory twice on the way down, so link loops
+    end. Files are kept if they match any of the include globs (all files if
+    none are given) and none of the exclude globs, matched against both the
+    path and the filename. A file reached more than once, through repeated
+    inputs, overlapping directories or links, is only kept the first time,
+    by device and inode.
+    '''
+
+    include = list( include ) if include else []
+    exclude = list( exclude ) if exclude else []
+
+    files, seen = [], set()
+
+    def add( path ):
+        if include and not _matches( path, include ):
+            return
+        if exclude and _matches( path, exclude ):
+            return
+
+        try:
+            stat = os.stat( path )
+        except OSError:
+            return
+
+        key = ( stat.st_dev, stat.st_ino )
+        if key in seen:
+            if verbose:
+                print( "Skipping {}, already included...".format( path ) )
+            return
+
+        seen.add( key )
+        files.append( path )
+
+    def walk( directory, match = None ):
+        visited = set()
+        for root, dirnames, filenames in os.walk( directory or os.curdir, followlinks = True ):
+
+            # Don't descend into a directory twice (i.e. a link loop)
+            stat = os.stat( root )
+            if ( stat.st_dev, stat.st_ino ) in visited:
+                dirnames[:] = []
+                continue
+            visited.add( ( stat.st_dev, stat.st_ino ) )
+
+            dirnames.sort()
+            for filename in sorted( filenames ):
+                path = os.path.join( root, filename ) if directory else os.path.relpath( os.path.join( root, filename ) )
+                if match is None or match.match( path ):
+                    add( path )
+
+    for input in inputs:
+
+        input = str( input )
+
+        # Recursive globs are walked here, as glob would follow link loops
+        if "**" in input:
+            walk( *_recursiveGlob( input ) )
+            continue
+
+        if glob.has_magic( input ):
+            paths = sorted( glob.glob( input ) )
+            if not paths and verbose:
+                print( "No files match {}...".format( input ) )
+        elif os.path.exists( input ):
+            paths = [ input ]
+        else:
+            raise FileNotFoundError( "{} does not exist.".format( input ) )
+
+        for path in paths:
+            if os.path.isdir( path ):
+                walk( path )
+            elif os.path.isfile( path ):
+                add( path )
+
+    return files
+
+
 # Formats directories from GUI output to console. Need to test on Windows...
 def formatMultipleDirectories( args ):
     if platform.system() == 'Darwin' or 'Linux':
@@ -221,6 +221,7 @@ def plot_contour_pdf( x_val, y_val, contour_data, n_steps = 64, linecolour = 'bl
     yspan = abs( ymax - ymin )
 
 # Set up the plot:
+    import matplotlib.pyplot as plt
     fig = plt.figure( figsize = canvassize )
     ax = fig.add_axes( [xstart, ystart, xend, yend] )
     ax.xaxis.set_tick_params( labelsize = ticklabelsize, pad = 8 )
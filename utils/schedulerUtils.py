@@ -0,0 +1,194 @@
+# Parallel job scheduling utilities, Python 3
+
+# Imports
+import os
+import bisect
+from itertools import accumulate
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Rough ratio of the memory a loaded archive takes up to its file size (16 bit samples are decoded to floats and PyPulse keeps a weighted copy)
+ARCHIVE_MEMORY_FACTOR = 4
+
+# Copies of the decoded data cube a loaded archive holds at its peak (the data and its weighted copy)
+ARCHIVE_COPIES = 2
+
+
+def processCount( processes = None ):
+
+    '''
+    Returns the number of worker processes to use. None or 0 means one per CPU.
+    '''
+
+    if not processes:
+        return os.cpu_count() or 1
+
+    return max( int( processes ), 1 )
+
+
+def runJobs( function, jobs, processes = 1, budget = None, size = None ):
+
+    '''
+    Runs function( job ) for every job and yields ( job, result ) pairs in the
+    order the jobs were given. With more than one process, jobs run in a pool of
+    worker processes and results are sent back to the calling process, so only
+    the caller writes output and workers never contend for the same files.
+    function and the jobs must be picklable (e.g. a module level function or
+    a method of a picklable object).
+    If a size( job ) estimate of each job's memory footprint (in bytes) is given,
+    the largest jobs are started first, to shorten the tail of the run, and with
+    a memory budget (in bytes) jobs are only started while the footprints of the
+    running jobs add up to less than the budget (a job on its own always runs).
+    Jobs start strictly largest first: if the next one doesn't fit, nothing
+    smaller overtakes it and the scheduler waits for running jobs to free
+    memory, so a large job is never left to run last and alone.
+    Results are still yielded in input order.
+    '''
+
+    jobs = list( jobs )
+    processes = min( processCount( processes ), max( len( jobs ), 1 ) )
+
+    if processes == 1:
+        for job in jobs:
+            yield job, function( job )
+        return
+
+    if size is None:
+        with ProcessPoolExecutor( max_workers = processes ) as executor:
+            for job, result in zip( jobs, executor.map( function, jobs ) ):
+                yield job, result
+        return
+
+    sizes = [ size( job ) for job in jobs ]
+    queue = deque( sorted( range( len( jobs ) ), key = lambda i: sizes[i], reverse = True ) )
+    running, results = {}, {}
+    inMemory, nextJob = 0, 0
+
+    with ProcessPoolExecutor( max_workers = processes ) as executor:
+
+        while queue or running:
+
+            # Start the largest jobs in turn while the next one fits in the budget
+            while queue and len( running ) < processes:
+                i = queue[0]
+                if running and budget is not None and inMemory + sizes[i] > budget:
+                    break
+                queue.popleft()
+                running[executor.submit( function, jobs[i] )] = i
+                inMemory += sizes[i]
+
+            done, _ = wait( running, return_when = FIRST_COMPLETED )
+
+            for future in done:
+                i = running.pop( future )
+                inMemory -= sizes[i]
+                results[i] = future.result()
+
+            # Hand back every result that is next in input order
+            while nextJob in results:
+                yield jobs[nextJob], results.pop( nextJob )
+                nextJob += 1
+
+
+def contiguousSlices( jobs, n, size = None ):
+
+    '''
+    Splits the jobs into at most n contiguous, non-empty slices, in order,
+    so results can still be put back together in input order. If a size( job )
+    estimate is given, the slices hold roughly equal shares of the total size,
+    otherwise equal numbers of jobs.
+    '''
+
+    jobs = list( jobs )
+    n = min( max( int( n ), 1 ), len( jobs ) )
+
+    if n <= 1:
+        return [ jobs ] if jobs else []
+
+    sizes = [ size( job ) for job in jobs ] if size is not None else []
+    if sum( sizes ) <= 0:
+        sizes = [ 1 ] * len( jobs )
+
+    cumulative = list( accumulate( sizes ) )
+
+    # Each slice ends on the job that takes it past its share, keeping every slice non-empty
+    bounds = [ 0 ]
+    for k in range( 1, n ):
+        end = bisect.bisect_left( cumulative, cumulative[-1] * k / n ) + 1
+        bounds.append( min( max( end, bounds[-1] + 1 ), len( jobs ) - ( n - k ) ) )
+    bounds.append( len( jobs ) )
+
+    return [ jobs[start:end] for start, end in zip( bounds, bounds[1:] ) ]
+
+
+def fileFootprint( file ):
+
+    '''
+    Returns a rough estimate of the memory (in bytes) a file takes up once loaded as an archive.
+    '''
+
+    return os.path.getsize( file ) * ARCHIVE_MEMORY_FACTOR
+
+
+def archiveFootprint( file ):
+
+    '''
+    Returns an estimate of the memory (in bytes) a PSRFITS file takes up once
+    loaded as an archive, from its SUBINT header: nsubint x npol x nchan x nbin
+    float64 values for each copy of the data cube. Falls back on the file size
+    if the header can't be read. Directories give the footprint of their
+    largest file, as their files are loaded one at a time.
+    '''
+
+    if os.path.isdir( file ):
+        return max( [ archiveFootprint( os.path.join( file, f ) ) for f in os.listdir( file ) ] + [ 0 ] )
+
+    from astropy.io import fits
+
+    try:
+        header = fits.getheader( file, 'SUBINT' )
+        return header['NAXIS2'] * header['NPOL'] * header['NCHAN'] * header['NBIN'] * 8 * ARCHIVE_COPIES
+    except ( OSError, KeyError, IndexError, TypeError ):
+        return fileFootprint( file ) if os.path.isfile( file ) else 0
+
+
+def prefetch( function, jobs, depth = 2, budget = None, size = None ):
+
+    '''
+    Runs function( job ) for the next jobs on background threads while the
+    caller works on the current one, and yields ( job, result ) pairs in the
+    order the jobs were given. Meant for I/O bound work such as reading the
+    next archives while the current one is culled and timed.
+    At most depth jobs are run ahead of the one being yielded. If a memory
+    budget (in bytes) and a size( job ) estimate are given, the jobs run ahead
+    plus the current one never add up to more than the budget, although the
+    current job is always run. Exceptions raised by function are raised when
+    their job is reached.
+    '''
+
+    jobs = list( jobs )
+
+    if depth < 1:
+        for job in jobs:
+            yield job, function( job )
+        return
+
+    sizes = [ size( job ) if size is not None else 0 for job in jobs ]
+    pending = deque()
+    inMemory, submitted = 0, 0
+
+    with ThreadPoolExecutor( max_workers = depth ) as executor:
+
+        for i, job in enumerate( jobs ):
+
+            # Top up the jobs running ahead of this one
+            while submitted < len( jobs ) and ( submitted == i or ( submitted - i <= depth and ( budget is None or inMemory + sizes[submitted] <= budget ) ) ):
+                pending.append( executor.submit( function, jobs[submitted] ) )
+                inMemory += sizes[submitted]
+                submitted += 1
+
+            result = pending.popleft().result()
+            yield job, result
+
+            # The caller is done with this job's result
+            inMemory -= sizes[i]
@@ -0,0 +1,457 @@
+# Timing utilities, Python 3
+
+# Imports
+import os
+import numpy as np
+
+from utils.mathUtils import fourierShifts
+
+
+# Number of seconds in a day
+DAY = 86400.0
+
+# Names and types of the TOA columns used by toaColumns and the TOAStore
+TOA_COLUMNS = [ ( 'imjd', np.int64 ), ( 'fmjd', np.float64 ), ( 'error', np.float64 ), ( 'frequency', np.float64 ),
+                ( 'site', np.str_ ), ( 'filename', np.str_ ), ( 'frontend', np.str_ ), ( 'backend', np.str_ ),
+                ( 'bw', np.float64 ), ( 'tobs', np.float64 ), ( 'template', np.str_ ), ( 'nbin', np.int32 ),
+                ( 'nchan', np.int32 ), ( 'chan', np.int32 ), ( 'subint', np.int32 ), ( 'snr', np.float64 ),
+                ( 'flux', np.float64 ), ( 'fluxerr', np.float64 ), ( 'flags', np.str_ ), ( 'settings', np.str_ ) ]
+
+
+def archiveRecord( archive, weighted = True ):
+
+    '''
+    Returns the scrunched profiles of a loaded PyPulse archive, their weights and
+    the metadata needed to time them as a dictionary. This is the record format
+    used by toaLines, timeRecords and the ProfileCache.
+    If weighted is False, the profiles are left unweighted (and uncopied), as
+    scrunchRecord needs them.
+    '''
+
+    nchan = archive.getNchan()
+
+    # The data are kept weighted so zapped profiles stay zapped
+    record = { 'profiles': np.asarray( archive.getData( squeeze = False, weight = weighted )[:, 0], dtype = np.float32 if weighted else None ),
+               'weights': np.asarray( archive.getWeights( squeeze = False ), dtype = np.float32 ).reshape( -1, nchan ),
+               'imjd': int( archive.header['STT_IMJD'] ),
+               'smjd': float( archive.header['STT_SMJD'] ) + float( archive.header['STT_OFFS'] ),
+               'offsets': np.array( archive.subint_starts, dtype = np.float64 ),
+               'durations': np.array( archive.durations, dtype = np.float64 ),
+               'period': float( archive.getPeriod() ),
+               'nbin': archive.getNbin(),
+               'frequencies': np.array( archive.getAxis( 'F' ), dtype = np.float64 ).reshape( nchan ),
+               'channelDelays': np.array( archive.channel_delays[:nchan], dtype = np.float64 ),
+               'bandwidth': float( archive.getBandwidth() ),
+               'telescope': archive.getTelescope(),
+               'frontend': archive.getFrontend(),
+               'backend': archive.getBackend(),
+               'filename': archive.filename }
+
+    return record
+
+
+def _scrunchFactor( old, new ):
+
+    '''
+    Returns the block width PyPulse scrunches old elements to new with.
+    '''
+
+    new = max( int( new ), 1 )
+
+    return old // new + ( 1 if old % new != 0 else 0 )
+
+
+def _blocks( array, axis, factor ):
+
+    '''
+    Zero pads an axis of an array to a multiple of factor (if needed) and splits
+    it into ( blocks, factor ), so blocks can be reduced with a sum over an axis.
+    '''
+
+    array = np.asarray( array )
+    length = array.shape[axis]
+    padding = -length % factor
+
+    if padding:
+        pad = [ ( 0, 0 ) ] * array.ndim
+        pad[axis] = ( 0, padding )
+        array = np.pad( array, pad )
+
+    return np.reshape( array, array.shape[:axis] + ( ( length + padding ) // factor, factor ) + array.shape[axis + 1:] )
+
+
+def scrunchRecord( record, nsubint = 1, nchan = 1 ):
+
+    '''
+    Scrunches the unweighted profiles of a record (see archiveRecord) down to
+    nsubint sub-integrations and nchan channels straight from the data cube and
+    its weights, giving the same profiles as PyPulse's tscrunch then fscrunch:
+    each new profile is the weighted mean of its block of profiles (blocks are
+    as wide as PyPulse makes them, the last one being shorter if they don't
+    divide evenly). Blocks are reduced with sums over reshaped axes, and blocks
+    whose weights are all zero (fully zapped) are never summed, staying zero so
+    they give no TOA.
+    Returns a new record, weighted as archiveRecord gives it, with the weights
+    summed over time and averaged over frequency (as PyPulse does) and the
+    offsets, durations, frequencies and channel delays of each block.
+    '''
+
+    profiles = np.asarray( record['profiles'] )
+    oldNsubint, oldNchan, nbin = np.shape( profiles )
+    tfactor, ffactor = _scrunchFactor( oldNsubint, nsubint ), _scrunchFactor( oldNchan, nchan )
+
+    # NaNs are zeroed so they aren't counted in the sums (as in PyPulse)
+    if np.isnan( profiles ).any():
+        profiles = np.nan_to_num( profiles )
+    weights = np.nan_to_num( np.asarray( record['weights'], dtype = np.float64 ).reshape( oldNsubint, oldNchan ) )
+    blockWeights = _blocks( _blocks( weights, 1, ffactor ), 0, tfactor )
+    totals = np.sum( blockWeights, axis = ( 1, 3 ) )
+    live = totals > 0
+
+    data = _blocks( _blocks( profiles, 1, ffactor ), 0, tfactor )
+    newNsubint, newNchan = live.shape
+    sums = np.zeros( ( newNsubint, newNchan, nbin ) )
+
+    if np.all( live ):
+        sums = np.einsum( 'itkfb,itkf->ikb', data, blockWeights )
+    elif np.any( live ):
+        # Only the blocks with some weight are gathered and summed
+        i, k = np.nonzero( live )
+        sums[i, k] = np.einsum( 'ntfb,ntf->nb', data[i, :, k], blockWeights[i, :, k] )
+
+    # Weighted means, then weighted by the new weights as archiveRecord's profiles are
+    counts = np.sum( _blocks( np.ones( oldNchan ), 0, ffactor ), axis = 1 )
+    newWeights = totals / counts[np.newaxis, :]
+    means = np.divide( sums, totals[..., np.newaxis], out = np.zeros_like( sums ), where = live[..., np.newaxis] )
+    newProfiles = means * ( newWeights / ( np.sum( newWeights ) if np.sum( newWeights ) > 0 else 1.0 ) )[..., np.newaxis]
+
+    # Each block starts at the duration weighted mean of its offsets and lasts as long as its sub-integrations together
+    durations = np.nan_to_num( np.asarray( record['durations'], dtype = np.float64 ) )
+    offsets = np.asarray( record['offsets'], dtype = np.float64 )[:oldNsubint]
+    newDurations = np.sum( _blocks( durations, 0, tfactor ), axis = 1 )
+    firstOffsets = offsets[::tfactor]
+    newOffsets = np.divide( np.sum( _blocks( offsets * durations, 0, tfactor ), axis = 1 ), newDurations, out = firstOffsets.copy(), where = newDurations > 0 )
+
+    scrunched = dict( record )
+    scrunched.update( { 'profiles': newProfiles.astype( np.float32 ),
+                        'weights': newWeights.astype( np.float32 ),
+                        'offsets': newOffsets,
+                        'durations': newDurations,
+                        'frequencies': np.sum( _blocks( record['frequencies'], 0, ffactor ), axis = 1 ) / counts,
+                        'channelDelays': np.sum( _blocks( np.asarray( record['channelDelays'], dtype = np.float64 )[:oldNchan], 0, ffactor ), axis = 1 ) / counts } )
+
+    return scrunched
+
+
+def templateSpectrum( templateFFT, nbin, nchan = None ):
+
+    '''
+    Prepares a precomputed template FFT (the real FFT of a 1D profile, or of
+    each channel of a 2D portrait) for fftfit.
+    Portraits are summed down to nchan channels in the Fourier domain, which
+    requires the number of portrait channels to be a multiple of nchan.
+    Each template profile is normalized to a peak of 1 so the fitted amplitudes
+    are peak fluxes.
+    '''
+
+    templateFFT = np.asarray( templateFFT )
+
+    if templateFFT.ndim == 2 and nchan is not None:
+        portraitNchan = templateFFT.shape[0]
+        if portraitNchan % nchan != 0:
+            raise ValueError( "Number of portrait channels ({}) must be a multiple of the number of channels being timed ({})".format( portraitNchan, nchan ) )
+        templateFFT = np.sum( np.reshape( templateFFT, ( nchan, portraitNchan // nchan, -1 ) ), axis = 1 )
+
+    peak = np.max( np.fft.irfft( templateFFT, n = nbin, axis = -1 ), axis = -1, keepdims = True )
+
+    return templateFFT / peak
+
+
+def fftfit( profiles, templateFFT, iterations = 8 ):
+
+    '''
+    Vectorized Fourier phase-gradient fit (Taylor 1992) of any number of
+    profiles against a template.
+    profiles has shape (..., nbin) and templateFFT (see templateSpectrum) must
+    broadcast against the real FFTs of the profiles, so one template can be used
+    for every profile or a portrait can give each channel its own.
+    The shift starts at the peak of the cross-correlation and is refined with
+    Newton steps on the phase gradient of the cross spectrum.
+    Returns tauhat and sigma_tau (in bins, positive when the profile lags the
+    template), bhat and sigma_b (template scale factor and its error) and snr,
+    each with the leading shape of profiles. Zapped (all zero) profiles give NaN.
+    '''
+
+    profiles = np.asarray( profiles, dtype = np.float64 )
+    nbin = profiles.shape[-1]
+    spectra = np.fft.rfft( profiles, axis = -1 )
+
+    # Initial shift from the peak of the cross-correlation
+    tau = fourierShifts( spectra, templateFFT, nbin )
+
+    # The DC term only carries the baseline and the Nyquist term has no phase information, so neither is used
+    nharm = ( nbin - 1 ) // 2
+    omega = 2 * np.pi * np.arange( 1, nharm + 1 ) / nbin
+    tempHarm = np.asarray( templateFFT )[..., 1:nharm + 1]
+    profHarm = spectra[..., 1:nharm + 1]
+    cross = profHarm * np.conj( tempHarm )
+
+    with np.errstate( divide = 'ignore', invalid = 'ignore' ):
+
+        # Newton steps towards the maximum of the cross spectrum's real part
+        for i in np.arange( iterations ):
+            rotated = cross * np.exp( 1j * omega * tau[..., np.newaxis] )
+            gradient = -np.sum( omega * rotated.imag, axis = -1 )
+            curvature = -np.sum( ( omega**2 ) * rotated.real, axis = -1 )
+            tau = tau - np.where( curvature < 0, gradient / curvature, 0 )
+
+        rotated = cross * np.exp( 1j * omega * tau[..., np.newaxis] )
+        curvature = np.sum( ( omega**2 ) * rotated.real, axis = -1 )
+        power = np.sum( np.abs( tempHarm )**2, axis = -1 )
+
+        bhat = np.sum( rotated.real, axis = -1 ) / power
+
+        # Noise per harmonic from the residuals of the fit
+        residual = profHarm - ( bhat[..., np.newaxis] * tempHarm * np.exp( -1j * omega * tau[..., np.newaxis] ) )
+        noise = np.mean( np.abs( residual )**2, axis = -1 )
+
+        sigma_tau = np.sqrt( noise / ( 2 * bhat * curvature ) )
+        sigma_b = np.sqrt( noise / ( 2 * power ) )
+        snr = bhat / np.sqrt( noise / nbin )
+
+    # Wrap into [-nbin/2, nbin/2)
+    tauhat = ( tau + ( nbin / 2 ) ) % nbin - ( nbin / 2 )
+
+    zapped = np.all( profiles == 0, axis = -1 )
+    for array in ( tauhat, sigma_tau, bhat, sigma_b, snr ):
+        array[zapped] = np.nan
+
+    return tauhat, sigma_tau, bhat, sigma_b, snr
+
+
+def timeRecordColumns( records, templateFFT, templateName = "None", flags = "", settings = "" ):
+
+    '''
+    Times the scrunched profiles of many records (see archiveRecord) in one
+    batch against a precomputed template FFT and returns all of their TOAs as
+    a dictionary of column arrays (see toaColumns).
+    templateFFT can be the real FFT of a 1D template or of a 2D portrait. With a
+    portrait, each profile is fitted against its own channel after the portrait
+    is summed down to the record's number of channels.
+    '''
+
+    if not records:
+        return concatenateColumns( [] )
+
+    nbin = int( records[0]['nbin'] )
+    if any( int( record['nbin'] ) != nbin for record in records ):
+        raise ValueError( "All records must have the same number of bins to be timed together" )
+
+    templateFFT = np.asarray( templateFFT )
+
+    # Stack every profile of every record into a single (nprofiles x nbin) array
+    shapes = [ record['profiles'].shape[:2] for record in records ]
+    stack = np.concatenate( [ np.reshape( record['profiles'], ( -1, nbin ) ) for record in records ] )
+
+    # Portraits give one template per profile, in the same order as the stack
+    if templateFFT.ndim == 2:
+        templates = np.concatenate( [ np.tile( templateSpectrum( templateFFT, nbin, nchan ), ( nsubint, 1 ) ) for nsubint, nchan in shapes ] )
+    else:
+        templates = templateSpectrum( templateFFT, nbin )
+
+    tauhat, sigma_tau, bhat, sigma_b, snr = fftfit( stack, templates )
+
+    # Split the results back up by record
+    columnsList = []
+    start = 0
+    for record, ( nsubint, nchan ) in zip( records, shapes ):
+        end = start + ( nsubint * nchan )
+        results = [ np.reshape( array[start:end], ( nsubint, nchan ) ) for array in ( tauhat, sigma_tau, snr, bhat, sigma_b ) ]
+        columnsList.append( toaColumns( record, *results, templateName = templateName, flags = flags, settings = settings ) )
+        start = end
+
+    return concatenateColumns( columnsList )
+
+
+def timeRecords( records, templateFFT, templateName = "None", flags = "" ):
+
+    '''
+    Times many records in one batch (see timeRecordColumns) and returns all of
+    their TOAs as TEMPO2 lines.
+    '''
+
+    return tempo2Lines( timeRecordColumns( records, templateFFT, templateName, flags ) )
+
+
+def splitMJD( imjd, seconds ):
+
+    '''
+    Returns the integer and fractional parts of TOA MJDs, given the integer MJD
+    and the seconds after it (which may run over into the next day).
+    The two parts are kept apart so no precision is lost to a single float64 MJD.
+    '''
+
+    seconds = np.atleast_1d( np.asarray( seconds, dtype = np.float64 ) )
+    imjd = np.broadcast_to( np.asarray( imjd, dtype = np.int64 ), seconds.shape )
+
+    days = np.floor( seconds / DAY ).astype( np.int64 )
+    fraction = ( seconds - ( days * DAY ) ) / DAY
+
+    return imjd + days, fraction
+
+
+def mjdStrings( imjd, fmjd ):
+
+    '''
+    Returns MJDs given as integer and fractional day arrays as strings with 15
+    decimal places.
+    '''
+
+    # Rounding to 15 places can carry the fraction over to the next day
+    fractionStrings = [ '{0:.15f}'.format( f ) for f in np.atleast_1d( fmjd ) ]
+    carry = np.array( [ int( f[0] ) for f in fractionStrings ], dtype = np.int64 )
+
+    return [ '{0}{1}'.format( d, f[1:] ) for d, f in zip( np.atleast_1d( imjd ) + carry, fractionStrings ) ]
+
+
+def toaMJDStrings( imjd, seconds ):
+
+    '''
+    Returns TOAs as MJD strings with 15 decimal places, given the integer MJD
+    and the seconds after it.
+    '''
+
+    return mjdStrings( *splitMJD( imjd, seconds ) )
+
+
+def toaColumns( record, tauhat, sigma_tau, snr, bhat, sigma_b, templateName = "None", flags = "", settings = "" ):
+
+    '''
+    Returns the TOAs of one record as a dictionary of column arrays (see
+    TOA_COLUMNS). record holds the metadata of a scrunched archive (see
+    archiveRecord) and the other arrays are the fit results with shape
+    (nsubint, nchan), with tauhat and sigma_tau in bins. Profiles whose tauhat
+    is NaN are skipped.
+    '''
+
+    if isinstance( flags, ( tuple, list, np.ndarray ) ):
+        flags = " ".join( flags )
+    elif flags is None:
+        flags = ""
+
+    nsubint, nchan = np.shape( tauhat )
+    nbin = int( record['nbin'] )
+    period = float( record['period'] )
+    tbin = period / nbin
+
+    # Channels are delayed to the pulse period if their delay is not positive (as in Archive.time)
+    delays = np.array( record['channelDelays'], dtype = np.float64 )
+    delays[delays <= 0] += period
+
+    # Seconds after STT_IMJD for every subint and channel
+    seconds = float( record['smjd'] ) + np.array( record['offsets'], dtype = np.float64 )[:, np.newaxis] + delays[np.newaxis, :] + ( tauhat * tbin )
+
+    valid = np.logical_not( np.isnan( tauhat ) )
+    subints, channels = np.nonzero( valid )
+    imjd, fmjd = splitMJD( int( record['imjd'] ), seconds[valid] )
+    ntoa = len( subints )
+
+    columns = { 'imjd': imjd,
+                'fmjd': fmjd,
+                'error': sigma_tau[valid] * tbin * 1e6,
+                'frequency': np.array( record['frequencies'], dtype = np.float64 )[channels],
+                'site': np.full( ntoa, str( record['telescope'] ) ),
+                'filename': np.full( ntoa, str( record['filename'] ) ),
+                'frontend': np.full( ntoa, str( record['frontend'] ) ),
+                'backend': np.full( ntoa, str( record['backend'] ) ),
+                'bw': np.full( ntoa, abs( float( record['bandwidth'] ) ) / nchan ),
+                'tobs': np.array( record['durations'], dtype = np.float64 )[subints],
+                'template': np.full( ntoa, str( templateName ) ),
+                'nbin': np.full( ntoa, nbin, dtype = np.int32 ),
+                'nchan': np.full( ntoa, nchan, dtype = np.int32 ),
+                'chan': channels.astype( np.int32 ),
+                'subint': subints.astype( np.int32 ),
+                'snr': snr[valid],
+                'flux': bhat[valid],
+                'fluxerr': sigma_b[valid],
+                'flags': np.full( ntoa, flags ),
+                'settings': np.full( ntoa, str( settings ) ) }
+
+    return columns
+
+
+def concatenateColumns( columnsList ):
+
+    '''
+    Joins a list of TOA column dictionaries into one.
+    '''
+
+    if not columnsList:
+        return { key: np.array( [], dtype = dtype ) for key, dtype in TOA_COLUMNS }
+
+    return { key: np.concatenate( [ columns[key] for columns in columnsList ] ) for key, dtype in TOA_COLUMNS }
+
+
+def tempo2Lines( columns ):
+
+    '''
+    Formats TOA columns in the TEMPO2 (IPTA) format written by PyPulse Archive.time.
+    Returns a list of lines.
+    '''
+
+    mjds = mjdStrings( columns['imjd'], columns['fmjd'] )
+
+    lines = []
+    for i, mjd in enumerate( mjds ):
+        lines.append( "%s %f %s   %0.3f  %s   -fe %s -be %s -bw %f -tobs %f -tmplt %s -nbin %i -nch %i -chan %i -subint %i -snr %0.2f -flux %0.2f -fluxerr %0.2f %s\n" % ( columns['filename'][i], columns['frequency'][i], mjd, columns['error'][i], columns['site'][i], columns['frontend'][i], columns['backend'][i], columns['bw'][i], columns['tobs'][i], columns['template'][i], columns['nbin'][i], columns['nchan'][i], columns['chan'][i], columns['subint'][i], columns['snr'][i], columns['flux'][i], columns['fluxerr'][i], columns['flags'][i] ) )
+
+    return lines
+
+
+def toaLines( record, tauhat, sigma_tau, snr, bhat, sigma_b, templateName = "None", flags = "" ):
+
+    '''
+    Formats the TOAs of one record (see toaColumns) in TEMPO2 format.
+    Returns a list of lines.
+    '''
+
+    return tempo2Lines( toaColumns( record, tauhat, sigma_tau, snr, bhat, sigma_b, templateName, flags ) )
+
+
+def writeTOAs( lines, filename, appendto = True ):
+
+    '''
+    Writes TOA lines to a TEMPO2 file, adding the FORMAT 1 header if the file
+    is new or is being overwritten.
+    '''
+
+    output = "".join( lines )
+
+    if appendto and os.path.isfile( filename ):
+        with open( filename, 'a' ) as file:
+            file.write( output )
+    else:
+        with open( filename, 'w' ) as file:
+            file.write( "FORMAT 1\n" + output )
+
+
+def mergeTOAFiles( parts, filename, remove = True ):
+
+    '''
+    Appends the TOAs of several TEMPO2 files, in order, to one file (dropping
+    their FORMAT headers) and by default removes them afterwards. Parts that
+    don't exist are skipped.
+    '''
+
+    for part in parts:
+
+        if not os.path.isfile( part ):
+            continue
+
+        with open( part, 'r' ) as file:
+            lines = [ line for line in file if not line.startswith( "FORMAT" ) ]
+
+        writeTOAs( lines, filename, appendto = True )
+
+        if remove:
+            os.remove( part )